@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+"""
+Computes time-series metrics inside Elasticsearch using aggregations so
+that only the bucketed values are downloaded instead of every activity
+document. Metrics enable this with `server_side: True` in the report
+configuration and fall back to the local pandas calculation when the
+aggregation fails, e.g. when the cluster cannot be reached.
+
+Supported metrics:
+    active users: date_range buckets, one for each window, with a
+                  cardinality of user_id (users.active)
+    counts: date_histogram buckets with terms of a field, e.g. actions per
+            quarter. No figure of this report reads it yet, it is compared
+            with local_counts by benchmark_aggregate.py.
+
+The aggregations target an Elasticsearch 5.x cluster with the mapping of
+configs/logstash/hs-template.json: string fields are analyzed and have no
+fielddata, so they are aggregated and filtered on their not_analyzed
+.raw subfield.
+"""
+
+import pandas
+from datetime import timedelta
+from elasticsearch import Elasticsearch
+
+import spam
+import elastic
+import utilities
+
+
+HOST = 'usagemetrics.hydroshare.org'
+PORT = '8080'
+ACTIVITY_INDEX = '*activity*'
+ACTIVITY_QUERY = '-user_id:None AND -action:visit'
+
+# counts below this threshold are exact, see the elasticsearch
+# documentation of the cardinality aggregation
+PRECISION_THRESHOLD = 40000
+
+
+def raw(field):
+    """
+    Returns the not_analyzed subfield of a string field, which has doc
+    values that can be aggregated.
+    """
+    return f'{field}.raw'
+
+
+def connect(host=HOST, port=PORT):
+    return Elasticsearch([{'host': host, 'port': port}])
+
+
+def _ms(t):
+    return int(pandas.Timestamp(t).value // 10**6)
+
+
+def _timestamp(ms):
+    return pandas.Timestamp(int(ms), unit='ms', tz='UTC')
+
+
+def activity_filter(start_time, end_time, query=ACTIVITY_QUERY,
+                    exclude_users=[]):
+    """
+    Builds the query selecting the activity records that the local
+    calculation uses, i.e. records matching `query` whose day is within
+    [start_time, end_time], excluding spam users.
+    """
+    flt = {'bool': {'filter': [
+        {'query_string': {'query': query}},
+        {'range': {'session_timestamp': {
+            'gte': _ms(pandas.Timestamp(start_time).ceil('D')),
+            'lt': _ms(pandas.Timestamp(end_time).normalize() +
+                      timedelta(days=1)),
+            'format': 'epoch_millis'}}}]}}
+    if len(exclude_users) > 0:
+        flt['bool']['must_not'] = [{'terms': {raw('user_id'):
+                                              [str(u) for u in
+                                               exclude_users]}}]
+    return flt
+
+
+def first_day(es, index, flt):
+    """
+    Returns the day of the earliest record matching the filter, or None
+    if no records match.
+    """
+    body = {'size': 0,
+            'query': flt,
+            'aggs': {'first': {'min': {'field': 'session_timestamp'}}}}
+    res = es.search(index=index, body=body)
+    value = res['aggregations']['first']['value']
+    if value is None:
+        return None
+    return _timestamp(value).normalize()
+
+
+def active_users_body(flt, endpoints, active_range):
+    """
+    Builds a date_range aggregation with one bucket for each window
+    (t - active_range, t] on record days. Buckets overlap, so each one
+    computes the cardinality of user_id independently.
+    """
+    ranges = []
+    for t in endpoints:
+        t = pandas.Timestamp(t).normalize()
+        ranges.append({'from': _ms(t - timedelta(days=active_range - 1)),
+                       'to': _ms(t + timedelta(days=1))})
+
+    return {'size': 0,
+            'query': flt,
+            'aggs': {'windows': {
+                'date_range': {'field': 'session_timestamp',
+                               'format': 'epoch_millis',
+                               'ranges': ranges},
+                'aggs': {'users': {'cardinality': {
+                    'field': raw('user_id'),
+                    'precision_threshold': PRECISION_THRESHOLD}}}}}}
+
+
+def active_users(input_directory, start_time, end_time, active_range,
+                 step, es=None, index=ACTIVITY_INDEX, query=ACTIVITY_QUERY):
+    """
+    Computes users.active in Elasticsearch.
+
+    returns: (window end dates, number of active users in each window)
+    """
+    if es is None:
+        es = connect()
+
+    # spam users are removed from the local data before it is counted
+    exclude = spam.get_filter(input_directory).ids['users'].tolist()
+    flt = activity_filter(start_time, end_time, query, exclude)
+
+    first = first_day(es, index, flt)
+    x = utilities.window_endpoints(
+            None if first is None else first + timedelta(days=active_range),
+            end_time, step)
+    if len(x) == 0:
+        return x, []
+
+    res = es.search(index=index, body=active_users_body(flt, x,
+                                                        active_range))
+    values = {int(float(b['to'])): b['users']['value']
+              for b in res['aggregations']['windows']['buckets']}
+    y = [values.get(_ms(pandas.Timestamp(t).normalize() + timedelta(days=1)),
+                    0) for t in x]
+    return x, y
+
+
+def counts_body(flt, interval, field):
+    """
+    Builds a date_histogram aggregation with the terms of `field` in each
+    bucket. `interval` uses the 5.x syntax, calendar_interval was added
+    in 7.2.
+    """
+    return {'size': 0,
+            'query': flt,
+            'aggs': {'dates': {
+                'date_histogram': {'field': 'session_timestamp',
+                                   'interval': interval,
+                                   'min_doc_count': 0},
+                'aggs': {'terms': {'terms': {'field': raw(field),
+                                             'size': 1000}}}}}}
+
+
+def counts(input_directory, start_time, end_time, field='action',
+           interval='quarter', es=None, index=ACTIVITY_INDEX,
+           query=ACTIVITY_QUERY):
+    """
+    Counts activity records by `field` for each calendar interval (day,
+    week, month, quarter, year) in Elasticsearch.
+
+    returns: DataFrame indexed by interval start date with one column for
+             each value of `field`
+    """
+    if es is None:
+        es = connect()
+
+    exclude = spam.get_filter(input_directory).ids['users'].tolist()
+    flt = activity_filter(start_time, end_time, query, exclude)
+    res = es.search(index=index, body=counts_body(flt, interval, field))
+
+    rows = {}
+    for b in res['aggregations']['dates']['buckets']:
+        rows[_timestamp(b['key'])] = {
+            elastic.convert_binary_string(t['key']): t['doc_count']
+            for t in b['terms']['buckets']}
+    df = pandas.DataFrame.from_dict(rows, orient='index').fillna(0)
+    df.index.name = 'date'
+    return df.astype(int).sort_index(axis=1)
+
+
+# pandas period aliases of the calendar intervals
+INTERVALS = {'day': 'D', 'week': 'W-SUN', 'month': 'M', 'quarter': 'Q',
+             'year': 'A'}
+
+
+def local_counts(df, field='action', interval='quarter'):
+    """
+    Computes `counts` from activity records that have been loaded with
+    users.load_data, i.e. the fallback of the aggregation.
+    """
+    period = df.date.dt.tz_localize(None).dt.to_period(INTERVALS[interval])
+    res = df.groupby([period, df[field]], observed=True).size() \
+            .unstack(fill_value=0)
+
+    # include intervals without records, as min_doc_count=0 does
+    res = res.reindex(pandas.period_range(period.min(), period.max()),
+                      fill_value=0)
+    res.index = res.index.start_time.tz_localize('UTC')
+    res.index.name = 'date'
+    res.columns = pandas.Index(list(res.columns))
+    return res.sort_index(axis=1)
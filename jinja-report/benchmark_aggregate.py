@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""
+Compares the Elasticsearch aggregations in aggregate.py against the local
+pandas calculations using the synthetic index in fake_elastic.py. The
+activity that collect_data.py would download is saved to a temporary
+working directory, then active users and action counts are computed
+from both sources. The script exits with an error if they disagree.
+Aggregation runtimes are those of the stand-in, which evaluates every
+document in python, not of Elasticsearch.
+
+usage:
+    ./benchmark_aggregate.py --size 50000 --years 3 --active-range 30 180
+"""
+
+import os
+import sys
+import time
+import pytz
+import argparse
+import tempfile
+import contextlib
+from datetime import datetime
+
+import pandas
+
+import users
+import elastic
+import aggregate
+import fake_elastic
+
+
+def collect(es, working_dir):
+    """
+    Downloads the synthetic activity and saves it like collect_data.py.
+    """
+    with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f), \
+            contextlib.redirect_stderr(f):
+        df = elastic.get_es_data(None, es=es, outpik=None)
+    query = {'query_string': {'query': aggregate.ACTIVITY_QUERY}}
+    df = df[fake_elastic.match_query(df, query)]
+    df.to_pickle(os.path.join(working_dir, 'activity.pkl'))
+
+    # a few spam users that both methods must exclude
+    pandas.DataFrame({'user_id': ['1', '2', '3']}) \
+          .to_csv(os.path.join(working_dir, 'spam-users.csv'))
+    pandas.DataFrame({'resource_id': []}) \
+          .to_csv(os.path.join(working_dir, 'spam-resources.csv'))
+
+
+def timed(func, *args, **kwargs):
+    with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+        st = time.time()
+        res = func(*args, **kwargs)
+    return res, time.time() - st
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='compare server-side '
+                                                 'aggregations with local '
+                                                 'calculations')
+    parser.add_argument('--size', type=int, default=50000,
+                        help='number of synthetic activity documents')
+    parser.add_argument('--years', type=int, default=3,
+                        help='number of years of activity')
+    parser.add_argument('--step', type=int, default=10,
+                        help='timestep between windows in days')
+    parser.add_argument('--active-range', type=int, nargs='+',
+                        default=[30, 180],
+                        help='window lengths in days')
+    args = parser.parse_args()
+
+    # spread the documents over daily indices covering --years
+    seconds_per_doc = args.years * 365 * 86400 // args.size
+    es = fake_elastic.FakeElasticsearch(total=args.size,
+                                        docs_per_index=86400 //
+                                        seconds_per_doc)
+    es.document = lambda i: fake_elastic.activity_document(
+        i, n_users=2000, seconds_per_doc=seconds_per_doc)
+    st = pytz.utc.localize(datetime(2015, 1, 1))
+    et = st + pandas.Timedelta(days=args.years * 365)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as wrk:
+        collect(es, wrk)
+
+        for active_range in args.active_range:
+            local, local_time = timed(users.active, wrk, st, et,
+                                      active_range, args.step)
+            remote, remote_time = timed(users.active, wrk, st, et,
+                                        active_range, args.step,
+                                        server_side=True, es=es)
+            match = (list(local.x) == list(remote.x) and
+                     list(local.y) == list(remote.y))
+            failed |= not match
+            print(f'--> active users, active_range={active_range} '
+                  f'windows={len(local.x)} local={local_time:.2f}s '
+                  f'aggregation={remote_time:.2f}s match={match}')
+
+        for field, interval in [('action', 'quarter'),
+                                ('user_type', 'month')]:
+            df, _ = timed(users.load_data, wrk, 'activity.pkl')
+            local, local_time = timed(aggregate.local_counts, df,
+                                      field, interval)
+            remote, remote_time = timed(aggregate.counts, wrk, st, et,
+                                        field, interval, es=es)
+            match = local.equals(remote)
+            failed |= not match
+            print(f'--> {field} counts per {interval}, '
+                  f'buckets={len(local)} local={local_time:.2f}s '
+                  f'aggregation={remote_time:.2f}s match={match}')
+
+    if failed:
+        print('--> aggregations do not match the local calculations')
+        sys.exit(1)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+"""
+Measures the throughput and peak memory of collect_data.get_stats_data
+for each dataset (users, resources, activity) against the synthetic
+indices served by fake_elastic.FakeCluster, so that ingestion changes can
+be compared offline. Each dataset and size is collected in a fresh
+process so that the reported peak RSS belongs to that run only. Runs
+that leave scroll contexts open on the fake cluster are reported.
+
+usage:
+    ./benchmark_collect.py --sizes 10000 1000000 10000000
+    ./benchmark_collect.py --sizes 10000 --datasets activity --workers 4
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import multiprocessing
+
+import elastic
+import fake_elastic
+import collect_data
+
+
+DATASETS = ['users', 'resources', 'activity']
+
+
+def run_once(dataset, size, workers, queue):
+
+    # silence the progress output of the collectors
+    sys.stdout = open(os.devnull, 'w')
+    sys.stderr = open(os.devnull, 'w')
+
+    sizes = {k: (size if k == dataset else 0) for k in DATASETS}
+    es = fake_elastic.FakeCluster(**sizes)
+    with tempfile.TemporaryDirectory() as tmp:
+        st = time.time()
+        collect_data.get_stats_data(dirname=tmp, skip=False,
+                                    workers=workers,
+                                    es=es,
+                                    measure_bytes=True,
+                                    **{k: k == dataset for k in DATASETS})
+        elapsed = time.time() - st
+
+        with open(os.path.join(tmp, f'{dataset}.run.json'), 'r') as f:
+            record = json.load(f)
+
+    leaked = sum(len(d._scrolls) for d in es.datasets.values())
+    queue.put(dict(dataset=dataset,
+                   size=size,
+                   rows=record['summary']['rows'],
+                   seconds=elapsed,
+                   rows_per_sec=record['summary']['rows'] / elapsed,
+                   mb=record['summary']['bytes'] / 1024 ** 2,
+                   stages=record['stages'],
+                   open_scrolls=leaked,
+                   peak_rss_mb=elastic.peak_rss_mb()))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='benchmark data collection '
+                                                 'from elasticsearch')
+    parser.add_argument('--sizes',
+                        help='number of synthetic documents to collect',
+                        type=int,
+                        nargs='+',
+                        default=[10000, 1000000, 10000000])
+    parser.add_argument('--datasets',
+                        help='datasets to collect',
+                        choices=DATASETS,
+                        nargs='+',
+                        default=DATASETS)
+    parser.add_argument('--workers',
+                        help='number of concurrent downloads used to '
+                             'collect activity data',
+                        type=int,
+                        default=1)
+    parser.add_argument('--output',
+                        help='save the results to this json file',
+                        default=None)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    print(f'{"dataset":>10} {"documents":>10} {"seconds":>9} '
+          f'{"rows/sec":>10} {"MB":>8} {"peak rss (MB)":>14} '
+          f'{"open scrolls":>13}')
+    results = []
+    for dataset in args.datasets:
+        for size in args.sizes:
+            queue = ctx.Queue()
+            p = ctx.Process(target=run_once,
+                            args=(dataset, size, args.workers, queue))
+            p.start()
+            p.join()
+            if p.exitcode != 0:
+                print(f'{dataset:>10} {size:>10} failed with exit code '
+                      f'{p.exitcode}')
+                continue
+            res = queue.get()
+            results.append(res)
+            print(f'{res["dataset"]:>10} {res["size"]:>10} '
+                  f'{res["seconds"]:>9.2f} {res["rows_per_sec"]:>10.0f} '
+                  f'{res["mb"]:>8.1f} {res["peak_rss_mb"]:>14.1f} '
+                  f'{res["open_scrolls"]:>13}')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'--> results saved to: {args.output}')
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+Measures the memory used by an activity frame as it is downloaded by
+elastic.get_es_data, i.e. with object strings, ids, and dates, and after
+the store.SCHEMA types are applied by store.prepare. The frame is
+downloaded from the synthetic index in fake_elastic.py. The script exits
+with an error if the typed frame does not hold the same values.
+
+usage:
+    ./benchmark_dtypes.py --rows 200000
+"""
+
+import io
+import sys
+import argparse
+import contextlib
+import pandas
+
+import store
+import elastic
+import fake_elastic
+
+
+def column_mb(df):
+    return df.memory_usage(deep=True, index=False) / 1024 ** 2
+
+
+def same_values(raw, typed):
+    """
+    Compares a column before and after it is typed.
+    """
+    if isinstance(typed.dtype, pandas.DatetimeTZDtype):
+        return pandas.to_datetime(raw, utc=True).equals(typed)
+    if str(typed.dtype) in ['Int64', 'float64']:
+        return pandas.to_numeric(raw).astype('float64') \
+                     .equals(typed.astype('float64'))
+    return raw.astype(object).equals(typed.astype(object))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='compare the memory of '
+                                                 'untyped and typed activity '
+                                                 'data')
+    parser.add_argument('--rows', type=int, default=200000,
+                        help='number of synthetic activity records')
+    args = parser.parse_args()
+
+    print(f'--> downloading {args.rows} synthetic activity records')
+    with contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        raw = elastic.get_es_data(
+                None, es=fake_elastic.FakeElasticsearch(total=args.rows),
+                outpik=None)
+    typed = store.prepare(raw.copy(), 'activity')
+
+    before, after = column_mb(raw), column_mb(typed)
+    columns = store.DATE_COLUMNS['activity'] + \
+        [c for c in store.SCHEMA['activity'] if c in raw.columns]
+
+    failed = False
+    print(f'{"column":>20} {"before (MB)":>12} {"after (MB)":>11} '
+          f'{"dtype":>10} {"match":>6}')
+    for col in columns:
+        match = same_values(raw[col], typed[col])
+        failed |= not match
+        print(f'{col:>20} {before[col]:>12.1f} {after[col]:>11.1f} '
+              f'{str(typed[col].dtype)[:10]:>10} {str(match):>6}')
+    print(f'{"total":>20} {before.sum():>12.1f} {after.sum():>11.1f} '
+          f'({100 * (1 - after.sum() / before.sum()):.0f}% less)')
+
+    if failed:
+        print('--> typed values do not match the downloaded values')
+        sys.exit(1)
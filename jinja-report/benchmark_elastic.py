@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""
+Measures the throughput and peak memory of elastic.get_es_data against the
+synthetic scroll stand-in in fake_elastic.py. Each run is executed in a
+fresh process so that the reported peak RSS belongs to that run only.
+With --stream, pages are written to a csv, gzip compressed csv, or
+Parquet file as they are downloaded instead of building the dataframe
+and pickle.
+
+usage:
+    ./benchmark_elastic.py --sizes 10000 100000
+    ./benchmark_elastic.py --sizes 10000 100000 --stream parquet
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import multiprocessing
+
+import elastic
+import fake_elastic
+
+
+def run_once(size, stream, queue):
+
+    # silence the column renaming/dropping output of get_es_data
+    sys.stdout = open(os.devnull, 'w')
+
+    es = fake_elastic.FakeElasticsearch(total=size)
+    with tempfile.TemporaryDirectory() as tmp:
+        st = time.time()
+        if stream is None:
+            df = elastic.get_es_data(None, es=es,
+                                     outpik=os.path.join(tmp,
+                                                         'activity.pkl'))
+            rows = len(df)
+        else:
+            elastic.get_es_data(None, es=es, outpik=None,
+                                outfile=os.path.join(tmp,
+                                                     f'activity.{stream}'),
+                                return_frame=False)
+            rows = size
+        elapsed = time.time() - st
+
+    queue.put(dict(size=size,
+                   rows=rows,
+                   seconds=elapsed,
+                   rows_per_sec=rows / elapsed,
+                   peak_rss_mb=elastic.peak_rss_mb()))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='benchmark elasticsearch '
+                                                 'ingestion')
+    parser.add_argument('--sizes',
+                        help='number of synthetic documents to download',
+                        type=int,
+                        nargs='+',
+                        default=[10000, 100000])
+    parser.add_argument('--stream',
+                        help='write pages to a file of this format as they '
+                             'are downloaded',
+                        choices=['csv', 'csv.gz', 'parquet'],
+                        default=None)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    print(f'{"documents":>12} {"seconds":>10} {"rows/sec":>12} '
+          f'{"peak rss (MB)":>14}')
+    for size in args.sizes:
+        queue = ctx.Queue()
+        p = ctx.Process(target=run_once, args=(size, args.stream, queue))
+        p.start()
+        res = queue.get()
+        p.join()
+        print(f'{res["size"]:>12} {res["seconds"]:>10.2f} '
+              f'{res["rows_per_sec"]:>12.0f} {res["peak_rss_mb"]:>14.1f}')
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+"""
+Compares the approximate active user counts of hll.py with the exact
+counts of utilities.windowed_distinct_counts on synthetic activity data.
+For each error rate, the relative error of every window is reported as
+its root mean square and maximum, along with the runtime of both methods
+and the memory of the daily sketches. The script exits with an error if
+the root mean square error of any error rate exceeds 1.5 times the
+error rate, i.e. the configured bound on the standard error.
+
+usage:
+    ./benchmark_hll.py --rows 2000000 --users 200000 --years 6 --step 1
+"""
+
+import sys
+import time
+import numpy
+import argparse
+from datetime import timedelta
+
+import hll
+import utilities
+import benchmark_users
+
+
+# largest accepted root mean square error, relative to the error rate
+TOLERANCE = 1.5
+
+
+def timed(func, *args, **kwargs):
+    st = time.time()
+    res = func(*args, **kwargs)
+    return res, time.time() - st
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='compare approximate and '
+                                                 'exact active user counts')
+    parser.add_argument('--rows', type=int, default=2000000,
+                        help='number of synthetic activity records')
+    parser.add_argument('--users', type=int, default=200000,
+                        help='number of distinct users')
+    parser.add_argument('--years', type=int, default=6,
+                        help='number of years of activity')
+    parser.add_argument('--step', type=int, default=1,
+                        help='timestep between windows in days')
+    parser.add_argument('--active-range', type=int, nargs='+',
+                        default=[30, 180],
+                        help='window lengths in days')
+    parser.add_argument('--error-rate', type=float, nargs='+',
+                        default=[0.05, 0.02, 0.01],
+                        help='error rates of the approximate counts')
+    args = parser.parse_args()
+
+    dates, ids = benchmark_users.synthetic_activity(args.rows, args.users,
+                                                    args.years)
+    end_time = dates.max() + timedelta(days=1)
+    windows = [(utilities.window_endpoints(
+                    dates.min() + timedelta(days=active_range),
+                    end_time, args.step),
+                timedelta(days=active_range))
+               for active_range in args.active_range]
+
+    exact, exact_time = timed(utilities.windowed_distinct_counts,
+                              dates, ids, windows)
+    print(f'--> exact: {exact_time:.2f}s for {len(windows)} windows')
+
+    failed = False
+    print(f'{"error rate":>10} {"precision":>9} {"sketch MB":>9} '
+          f'{"seconds":>8} {"rms error":>9} {"max error":>9}')
+    for error_rate in args.error_rate:
+        approx, approx_time = timed(hll.windowed_distinct_counts,
+                                    dates, ids, windows, error_rate)
+
+        rel = numpy.concatenate([(a - e) / numpy.maximum(e, 1)
+                                 for a, e in zip(approx, exact)])
+        rms = numpy.sqrt(numpy.mean(rel ** 2)) if len(rel) > 0 else 0
+        worst = numpy.abs(rel).max() if len(rel) > 0 else 0
+        failed |= rms > TOLERANCE * error_rate
+
+        p = hll.precision(error_rate)
+        days = (dates.max() - dates.min()).days + 1
+        print(f'{error_rate:>10} {p:>9} {days * 2 ** p / 1024 ** 2:>9.1f} '
+              f'{approx_time:>8.2f} {rms:>9.4f} {worst:>9.4f}')
+
+    if failed:
+        print('--> approximate counts exceed the configured error rate')
+        sys.exit(1)
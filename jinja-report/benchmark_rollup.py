@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+Measures the daily activity rollup of rollup.py on synthetic activity
+saved to a temporary store: the time to build it, the time to update it
+after a month of activity is appended, and the memory of the data read
+to compute active users from the raw activity and from the rollup. The
+script exits with an error if the active users computed from the two
+sources differ, or if the updated rollup differs from one built from
+scratch.
+
+usage:
+    ./benchmark_rollup.py --rows 1000000 --users 5000 --years 6
+"""
+
+import os
+import sys
+import time
+import numpy
+import pandas
+import argparse
+import tempfile
+from datetime import timedelta
+
+import store
+import rollup
+import utilities
+
+
+ACTIONS = ['login', 'download', 'app_launch', 'create', 'delete']
+
+
+def synthetic_activity(rows, users, years, seed=0):
+    rng = numpy.random.default_rng(seed)
+    start = pandas.Timestamp('2015-01-01', tz='UTC')
+    offsets = numpy.sort(rng.integers(0, years * 365 * 86400, rows))
+    return pandas.DataFrame({
+        'id': numpy.arange(rows),
+        'session_timestamp': start + pandas.to_timedelta(offsets, unit='s'),
+        'user_id': rng.zipf(1.5, rows) % users,
+        'action': rng.choice(ACTIONS, rows, p=[.4, .3, .1, .15, .05])})
+
+
+def active_users(dates, ids, active_range):
+    x = utilities.window_endpoints(dates.min() + timedelta(days=active_range),
+                                   dates.max() + timedelta(days=1), 1)
+    return utilities.windowed_distinct_count(dates, ids, x,
+                                             timedelta(days=active_range))
+
+
+def timed(func, *args, **kwargs):
+    st = time.time()
+    res = func(*args, **kwargs)
+    return res, time.time() - st
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='benchmark the daily '
+                                                 'activity rollup')
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help='number of synthetic activity records')
+    parser.add_argument('--users', type=int, default=5000,
+                        help='number of distinct users')
+    parser.add_argument('--years', type=int, default=6,
+                        help='number of years of activity')
+    parser.add_argument('--active-range', type=int, default=30,
+                        help='window length in days')
+    args = parser.parse_args()
+
+    df = synthetic_activity(args.rows, args.users, args.years)
+    last = df.session_timestamp.dt.strftime('%Y-%m') == \
+        df.session_timestamp.iloc[-1].strftime('%Y-%m')
+
+    failed = False
+    with tempfile.TemporaryDirectory() as wrk:
+        store_dir = os.path.join(wrk, 'store')
+        store.append(df[~last], store_dir, 'activity', key='id')
+
+        months, build_time = timed(rollup.update, store_dir)
+        print(f'--> built the rollup of {len(months)} months in '
+              f'{build_time:.2f}s')
+
+        store.append(df[last], store_dir, 'activity', key='id')
+        months, update_time = timed(rollup.update, store_dir)
+        print(f'--> updated the rollup of {len(months)} month in '
+              f'{update_time:.2f}s')
+
+        raw, raw_time = timed(store.read, store_dir, 'activity',
+                              columns=['user_id', 'session_timestamp'])
+        daily, daily_time = timed(rollup.load, wrk,
+                                  columns=['date', 'user_id'])
+        raw_mb = raw.memory_usage(deep=True).sum() / 1024 ** 2
+        daily_mb = daily.memory_usage(deep=True).sum() / 1024 ** 2
+        print(f'--> activity: {len(raw)} rows, {raw_mb:.1f} MB, '
+              f'read in {raw_time:.2f}s')
+        print(f'--> rollup: {len(daily)} rows, {daily_mb:.1f} MB, '
+              f'read in {daily_time:.2f}s ({raw_mb / daily_mb:.0f}x less '
+              f'memory)')
+
+        y0, t0 = timed(active_users, raw.session_timestamp.dt.normalize(),
+                       raw.user_id, args.active_range)
+        y1, t1 = timed(active_users, daily.date, daily.user_id,
+                       args.active_range)
+        match = numpy.array_equal(y0, y1)
+        failed |= not match
+        print(f'--> active users: activity={t0:.3f}s rollup={t1:.3f}s '
+              f'match={match}')
+
+        full = rollup.daily(store.prepare(df, 'activity'))
+        updated = rollup.load(wrk)[full.columns]
+        match = full.sort_values(rollup.KEYS).reset_index(drop=True).equals(
+            updated.sort_values(rollup.KEYS).reset_index(drop=True))
+        failed |= not match
+        print(f'--> updated rollup matches a full build: {match}')
+
+    if failed:
+        print('--> rollup results do not match the activity data')
+        sys.exit(1)
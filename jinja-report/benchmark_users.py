@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""
+Compares the windowed distinct-count engine used by users.active, new,
+and returning against the original day-stepping loop on synthetic
+activity data, and the single pass over all windows that is used by
+users.user_counts against counting each window separately. The script
+exits with an error if the methods disagree and reports the runtime of
+each.
+
+usage:
+    ./benchmark_users.py --rows 200000 --users 5000 --years 6 --step 1
+"""
+
+import sys
+import time
+import numpy
+import pandas
+import argparse
+from datetime import timedelta
+
+import utilities
+
+
+def loop_distinct_count(dates, ids, start, end_time, active_range, step):
+    """
+    The original implementation of users.active, which masks the full
+    frame and calls nunique for every window.
+    """
+    df = pandas.DataFrame({'date': dates, 'user_id': ids})
+    x, y = [], []
+    t = start
+    while t < end_time:
+        min_active_date = t - timedelta(days=active_range)
+        subdf = df[(df.date <= t) &
+                   (df.date > min_active_date)]
+        x.append(t)
+        y.append(subdf.user_id.nunique())
+        t += timedelta(days=step)
+    return x, y
+
+
+def synthetic_activity(rows, users, years, seed=0):
+    rng = numpy.random.default_rng(seed)
+    start = pandas.Timestamp('2015-01-01', tz='UTC')
+    offsets = rng.integers(0, years * 365 * 86400, rows)
+    dates = (start + pandas.to_timedelta(offsets, unit='s')).normalize()
+    ids = rng.zipf(1.5, rows) % users
+    return pandas.Series(dates), pandas.Series(ids)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='compare and benchmark '
+                                                 'active user calculations')
+    parser.add_argument('--rows', type=int, default=200000,
+                        help='number of synthetic activity records')
+    parser.add_argument('--users', type=int, default=5000,
+                        help='number of distinct users')
+    parser.add_argument('--years', type=int, default=6,
+                        help='number of years of activity')
+    parser.add_argument('--step', type=int, default=1,
+                        help='timestep between windows in days')
+    parser.add_argument('--active-range', type=int, nargs='+',
+                        default=[30, 180],
+                        help='window lengths in days')
+    args = parser.parse_args()
+
+    dates, ids = synthetic_activity(args.rows, args.users, args.years)
+    end_time = dates.max() + timedelta(days=1)
+
+    failed = False
+    for active_range in args.active_range:
+        start = dates.min() + timedelta(days=active_range)
+
+        st = time.time()
+        x0, y0 = loop_distinct_count(dates, ids, start, end_time,
+                                     active_range, args.step)
+        loop_time = time.time() - st
+
+        st = time.time()
+        x1 = utilities.window_endpoints(start, end_time, args.step)
+        y1 = utilities.windowed_distinct_count(dates, ids, x1,
+                                               timedelta(days=active_range))
+        vec_time = time.time() - st
+
+        match = (x0 == x1) and (y0 == y1.tolist())
+        failed |= not match
+        print(f'--> active_range={active_range} windows={len(x1)} '
+              f'loop={loop_time:.2f}s vectorized={vec_time:.3f}s '
+              f'match={match}')
+
+    # all windows in one pass, as users.user_counts computes them
+    windows = [(utilities.window_endpoints(
+                    dates.min() + timedelta(days=active_range),
+                    end_time, args.step),
+                timedelta(days=active_range))
+               for active_range in args.active_range]
+
+    st = time.time()
+    separate = [utilities.windowed_distinct_count(dates, ids, x, w)
+                for x, w in windows]
+    separate_time = time.time() - st
+
+    st = time.time()
+    single = utilities.windowed_distinct_counts(dates, ids, windows)
+    single_time = time.time() - st
+
+    match = all((a == b).all() for a, b in zip(separate, single))
+    failed |= not match
+    print(f'--> {len(windows)} windows: separate={separate_time:.3f}s '
+          f'single pass={single_time:.3f}s match={match}')
+
+    if failed:
+        print('--> vectorized results do not match the original loop')
+        sys.exit(1)
@@ -7,12 +7,20 @@ import yaml
 #import shutil
 import jinja2
 import argparse
+import matplotlib
 #from datetime import datetime
 import series_models as models
 from subprocess import Popen, PIPE
+from concurrent.futures import ProcessPoolExecutor
+
+# render figures without a display, this is required when figures are
+# created in worker processes.
+matplotlib.use('Agg')
 
 import doi
 import plot
+import cache
+import build_cache
 import users
 import users_pie as userpie
 import resources
@@ -42,26 +50,7 @@ def read_config(yaml_path):
     return yaml_data
 
 
-def output_exists(cmd):
-    fname = None
-    wrk = ''
-    for c in cmd:
-        if '--filename' in c:
-            fname = c.split('=')[-1]
-        if '--working-dir' in c:
-            wrk = c.split('=')[-1]
-
-    if fname is not None:
-        if os.path.exists(os.path.join(wrk, fname)):
-            return True
-    return False
-
-
 def run(command):
-    if output_exists(command):
-        print('.. skipping bc output already exists')
-        return
-
     cmd = [sys.executable] + command
 
     p = Popen(cmd, stderr=PIPE)
@@ -75,6 +64,103 @@ def run(command):
             sys.stdout.flush()
 
 
+def build_metric(metric_name, metric_data, outdir, re_build=False,
+                 cache_dir=None, code=None, windows=None):
+    """
+    Computes the series of a metric, renders its figure, and returns the
+    dictionary of data that is passed to the report template. Metrics are
+    independent of each other so this can run in a worker process. When
+    cache_dir is given, the figure and csv are reused from the build cache
+    if the inputs, configuration, and code of the metric have not changed.
+    `windows` are registered with users.register_windows before the
+    series are computed, see series_models.user.windows.
+    """
+    print(f'\nCreating Figure: {metric_name}')
+    outpath = os.path.join(outdir, metric_name + '.png')
+    dat_path = os.path.join(outdir, f'{metric_name}.csv')
+    outputs = [outpath]
+    if metric_data.save_data:
+        outputs.append(dat_path)
+
+    # the key is computed before get_series, which modifies metric_data
+    key = None
+    if cache_dir is not None and not re_build and \
+            build_cache.cacheable(metric_data):
+        key = build_cache.metric_key(metric_data, code)
+
+    if key is not None and build_cache.restore(cache_dir, key, outputs):
+        print('.. reusing figure from the build cache')
+    elif not re_build:
+        if windows:
+            users.register_windows(metric_data.input_directory,
+                                   *metric_data.time_range(), windows)
+
+        # generate the figure
+        series = metric_data.get_series()
+        module = modules().lookup(metric_data.__class__.__name__)
+        plots = []
+
+        # loop through each series that will be plotted to the figure,
+        # compute the data that will be displayed and create line
+        # objects that will be plotted later
+        for series_type, series_data in series.items():
+            method = getattr(module, series_type)
+            pltobj = method(**series_data)
+
+            # some functions return a list of plot objects.
+            # for these, just extend the plots list
+            if type(pltobj) == list:
+                plots.extend(pltobj)
+            else:
+                # if a single plot is returned (most common case),
+                # just append it to the plots list
+                plots.append(pltobj)
+
+        # generate plot figures for each metric. rcParams are scoped to
+        # this figure so the output does not depend on the order in which
+        # a process builds metrics.
+        method = getattr(plot, series_data['figure'].type)
+        with matplotlib.rc_context():
+            method(plots, outpath,
+                   rcParams=metric_data.figure.rcParams,
+                   axis_dict=metric_data.figure.axis,
+                   figure_dict=metric_data.figure.figure)
+
+        # save the plot data for the series in the figure
+        # if indicated in the yaml configuration
+        if metric_data.save_data:
+            # save all series dataframes to the plot_data dict
+            # and pass this dict to the utility function
+            utilities.save_data_to_csv({dat_path: [p.df for p in plots]})
+
+        if key is not None:
+            build_cache.save(cache_dir, key, outputs)
+
+    # initialize a dictionary of data that will be passed to the template
+    template_dict = {'caption': metric_data.figure.caption,
+                     'title': metric_data.figure.title,
+                     'img_path': outpath,
+                     'img_data': None}
+
+    # save path to data file in the template dict so it will be
+    # rendered in the report doc.
+    if metric_data.save_data:
+        template_dict['img_data'] = f'{metric_name}.csv'
+
+    return template_dict
+
+
+def build_metric_worker(*args, **kwargs):
+    """
+    Runs build_metric in a worker process and returns its template data
+    with the dataset cache statistics of the metric, which are kept by
+    each process.
+    """
+    before = dict(cache.stats)
+    template_dict = build_metric(*args, **kwargs)
+    return template_dict, {k: v - before[k] for k, v in cache.stats.items()}
+
+
 if __name__ == '__main__':
 
     p = argparse.ArgumentParser()
@@ -82,6 +168,11 @@ if __name__ == '__main__':
                    help='yaml configuration file')
     p.add_argument('--re-build', action='store_true', default=False,
                    help='rebuild from cache')
+    p.add_argument('--jobs', type=int, default=1,
+                   help='number of processes used to build figures')
+    p.add_argument('--no-cache', action='store_true', default=False,
+                   help='rebuild all figures instead of reusing figures '
+                        'from the build cache')
     args = p.parse_args()
 
     with open(args.yaml_data, 'r') as f:
@@ -99,7 +190,9 @@ if __name__ == '__main__':
              '-s',
              '-d',
              indir,
-             '--de-identify'])
+             '--de-identify',
+             '--config',
+             args.yaml_data])
     outdir = os.path.abspath(report_params['output_directory'])
     if not os.path.exists(outdir):
         print('Could not find output directory so I\'m making one: '
@@ -126,72 +219,50 @@ if __name__ == '__main__':
 
         metrics[k] = _class(**v)
 
-    # loop through parsed metrics and generate figures
-    mods = modules()
-    data = []
+    # the active, new, and returning users of every window of a time range
+    # are computed in one pass, see users.window_counts. worker processes
+    # do not share this registry, so each worker is given the windows of
+    # the metrics that it builds instead.
+    windows = {}
     for metric_name, metric_data in metrics.items():
-        print(f'\nCreating Figure: {metric_name}')
-        series = metric_data.get_series()
-        figure_data = metric_data.figure
-        outpath = os.path.join(outdir, metric_name + '.png')
-        plot_data = {}
-
-        if not args.re_build:
-            # generate the figure
-            module = mods.lookup(metric_data.__class__.__name__)
-            plots = []
-
-            # loop through each series that will be plotted to the figure,
-            # compute the data that will be displayed and create line
-            # objects that will be plotted later
-            for series_type, series_data in series.items():
-                method = getattr(module, series_type)
-                pltobj = method(**series_data)
-
-                # some functions return a list of plot objects.
-                # for these, just extend the plots list
-                if type(pltobj) == list:
-                    plots.extend(pltobj)
-                else:
-                    # if a single plot is returned (most common case),
-                    # just append it to the plots list
-                    plots.append(pltobj)
-
-            # generate plot figures for each metric.
-            method = getattr(plot, series_data['figure'].type)
-            method(plots, outpath,
-                   rcParams=metric_data.figure.rcParams,
-                   axis_dict=metric_data.figure.axis,
-                   figure_dict=metric_data.figure.figure)
-
-        # initialize a dictionary of data that will be passed to the template
-        template_dict = {'caption': metric_data.figure.caption,
-                         'title': metric_data.figure.title,
-                         'img_path': outpath,
-                         'img_data': None}
-
-        # save the plot data for the series in the figure
-        # if indicated in the yaml configuration
-        if metric_data.save_data:
-            dat_path = os.path.join(outdir, f'{metric_name}.csv')
-
-            # only save the data if the plots were created, i.e. the
-            # re-build flag was not passed 
-            if not args.re_build:
-                # save all series dataframes to the plot_data dict
-                # and pass this dict to the utility function
-                plot_data[dat_path] = [p.df for p in plots]
-
-                # save plot data
-                utilities.save_data_to_csv(plot_data)
-
-            # save path to data file in the template dict so it will be
-            # rendered in the report doc.
-            template_dict['img_data'] = f'{metric_name}.csv'
-
-        # append metadata for this figure that will be used to render 
-        # the report later.
-        data.append(template_dict)
+        if isinstance(metric_data, models.user):
+            windows[metric_name] = metric_data.windows()
+            if args.jobs <= 1:
+                users.register_windows(metric_data.input_directory,
+                                       *metric_data.time_range(),
+                                       windows[metric_name])
+
+    # loop through parsed metrics and generate figures. datasets are
+    # loaded once per process and shared between metrics through the cache.
+    cache.clear()
+    cache_dir, code = None, None
+    if not args.no_cache:
+        cache_dir = os.path.join(outdir, '.build-cache')
+        code = build_cache.code_version()
+    if args.jobs > 1:
+        print(f'--> building {len(metrics)} figures using {args.jobs} '
+              'processes')
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [executor.submit(build_metric_worker, metric_name,
+                                       metric_data, outdir, args.re_build,
+                                       cache_dir, code,
+                                       windows.get(metric_name))
+                       for metric_name, metric_data in metrics.items()]
+
+            # collect the template data in the order of the configuration
+            results = [f.result() for f in futures]
+        data = [template_dict for template_dict, _ in results]
+        for _, stats in results:
+            for k, v in stats.items():
+                cache.stats[k] += v
+    else:
+        data = [build_metric(metric_name, metric_data, outdir, args.re_build,
+                             cache_dir, code)
+                for metric_name, metric_data in metrics.items()]
+
+    print(f'--> dataset cache: {cache.stats["misses"]} loaded, '
+          f'{cache.stats["hits"]} reused')
+    cache.clear()
 
     print('Building report html')
     Loader = jinja2.FileSystemLoader('./templates')
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+"""
+Content-addressed cache of report figures. Each metric is identified by
+a hash of the input data it reads, its configuration block (excluding
+the caption and title, which are only used by the report template), and
+the version of the code that builds it. The figure and csv created for a
+metric are saved under that hash, e.g.
+
+    <output_directory>/.build-cache/
+        3f1c...e2/
+            users-active-30-day.png
+            users-active-30-day.csv
+
+so that a rebuild reuses the outputs of every metric whose inputs,
+settings, and code have not changed. Metrics computed on the server
+(server_side) read live Elasticsearch data and are never cached.
+"""
+
+import os
+import glob
+import json
+import shutil
+import hashlib
+import dataclasses
+
+import store
+
+
+# datasets read by each metric type. Paths ending in .csv are data files
+# of the code directory, e.g. the university list.
+INPUTS = {'user': ['users', 'activity'],
+          'userpie': ['users'],
+          'resource': ['resources'],
+          'organization': ['users', 'dat/university-data.csv',
+                           'dat/cuahsi-members.csv'],
+          'doi': ['doi']}
+
+# directory of the report code and its data files
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# files of the code directory that are part of the code version
+CODE_FILES = ['*.py', 'dat/*.py', 'templates/*']
+
+# figure settings that do not change the figure or its data
+TEMPLATE_FIELDS = ['caption', 'title']
+
+
+# digests of input files that have been hashed in this process, by path,
+# size, and modification time
+_digests = {}
+
+
+def file_digest(path):
+    """
+    Returns the sha256 digest of a file's content. Files that are
+    rewritten with the same content, e.g. snapshots that are downloaded
+    again, keep the same digest.
+    """
+    st = os.stat(path)
+    stamp = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if stamp not in _digests:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _digests[stamp] = h.hexdigest()
+    return _digests[stamp]
+
+
+def input_fingerprint(input_directory, datasets):
+    """
+    Describes the input files of a set of datasets by their name and
+    content digest. Store partitions are listed individually so that
+    appending a month of data only changes the fingerprint of the
+    datasets that received it.
+    """
+    store_dir = os.path.join(input_directory, 'store')
+    files = []
+    for dataset in datasets:
+        if dataset.endswith('.csv'):
+            files.append([dataset, file_digest(os.path.join(CODE_DIR,
+                                                            dataset))])
+            continue
+        paths = store.partitions(store_dir, dataset)
+        if len(paths) == 0:
+            paths = glob.glob(os.path.join(input_directory, f'{dataset}.pkl'))
+        files.append([dataset] + [[os.path.basename(p), file_digest(p)]
+                                  for p in paths])
+
+    # spam filters are applied to every dataset
+    for path in sorted(glob.glob(os.path.join(input_directory, 'spam-*.csv'))):
+        files.append([os.path.basename(path), file_digest(path)])
+
+    return files
+
+
+def code_version(code_dir=CODE_DIR):
+    """
+    Returns a hash of the python source and templates used to build the
+    report.
+    """
+    h = hashlib.sha256()
+    for pattern in CODE_FILES:
+        for path in sorted(glob.glob(os.path.join(code_dir, pattern))):
+            h.update(os.path.relpath(path, code_dir).encode('utf-8'))
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def cacheable(metric_data):
+    """
+    Returns False for metrics that have a series computed on the server,
+    whose data is not part of the local inputs.
+    """
+    if getattr(metric_data, 'server_side', False):
+        return False
+    return not any(s.get('server_side', False)
+                   for s in getattr(metric_data, 'series', None) or [])
+
+
+def metric_key(metric_data, code=None):
+    """
+    Computes the cache key of a metric from its configuration, the input
+    data it reads, and the code version.
+
+    args:
+        metric_data (series_models.Base): parsed metric configuration
+        code (str): code version, computed when not provided
+    returns: hex digest identifying the outputs of the metric
+    """
+    config = dataclasses.asdict(metric_data)
+    for k in TEMPLATE_FIELDS:
+        config['figure'].pop(k, None)
+
+    mtype = metric_data.__class__.__name__
+    content = {'type': mtype,
+               'config': config,
+               'inputs': input_fingerprint(metric_data.input_directory,
+                                           INPUTS.get(mtype, [])),
+               'code': code if code is not None else code_version()}
+
+    encoded = json.dumps(content, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def restore(cache_dir, key, outputs):
+    """
+    Copies cached outputs to their destination paths. Returns False, and
+    copies nothing, unless every output is found in the cache.
+    """
+    cached = [os.path.join(cache_dir, key, os.path.basename(p))
+              for p in outputs]
+    if not all(os.path.exists(p) for p in cached):
+        return False
+
+    for src, dst in zip(cached, outputs):
+        if os.path.abspath(src) != os.path.abspath(dst):
+            shutil.copyfile(src, dst)
+    return True
+
+
+def save(cache_dir, key, outputs):
+    """
+    Saves the outputs of a metric in the cache.
+    """
+    path = os.path.join(cache_dir, key)
+    os.makedirs(path, exist_ok=True)
+    for p in outputs:
+        shutil.copyfile(p, os.path.join(path, os.path.basename(p)))
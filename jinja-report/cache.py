@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+"""
+In-process cache of loaded datasets. The metric modules load, filter,
+and normalize the same collected data for many figures in a report.
+Datasets are cached by the loader, working directory, and file they
+were loaded from, e.g. ('users', working directory, 'users.pkl'), with
+all of their columns and records, so that each one is loaded and
+cleaned once per report build. The columns and dates requested by a
+figure are selected from a copy of the cached dataset.
+"""
+
+
+_datasets = {}
+stats = {'hits': 0, 'misses': 0}
+
+
+def get(key, loader, copy=True):
+    """
+    Returns a copy of the dataset cached under `key`, calling `loader()`
+    to create it on first use. A copy is returned so that callers can
+    modify the dataframe without changing the cached version. With
+    copy=False the cached version is returned, and the caller must copy
+    what it selects from it.
+    """
+    if key in _datasets:
+        stats['hits'] += 1
+    else:
+        stats['misses'] += 1
+        _datasets[key] = loader()
+    return _datasets[key].copy() if copy else _datasets[key]
+
+
+def put(key, value):
+    """
+    Caches a value that was computed together with another one, e.g. the
+    user counts of several windows, so that it is not computed again.
+    """
+    _datasets[key] = value
+
+
+def clear():
+    """
+    Removes all cached datasets.
+    """
+    _datasets.clear()
+    stats['hits'] = 0
+    stats['misses'] = 0
@@ -2,15 +2,168 @@
 
 import os
 import sys
+import yaml
 import pandas
+import store
+import rollup
 import elastic
 import argparse
+import importlib
+import build_cache
+import deidentification
 from datetime import datetime
 
 
+# modules that compute each metric_type of the report configuration
+METRIC_MODULES = {'user': 'users',
+                  'resource': 'resources',
+                  'organization': 'organizations'}
+
+# fields read by the metric types that do not have a module declaring them
+METRIC_FIELDS = {'userpie': {'users': None}}
+
+# metric types that do not read data collected from elasticsearch
+EXTERNAL_METRICS = ['doi']
+
+# directory where the pages of interrupted downloads are kept, see
+# elastic.checkpoint_path
+CHECKPOINT_DIR = os.path.join(os.path.expanduser('~'), '.usagemetrics',
+                              'checkpoints')
+
+# columns that are renamed after download, by dataset
+RENAME_COLUMNS = {'resources': {'id': 'resource_id'}}
+
+
+def required_fields(yaml_path):
+    """
+    Determines the fields of each dataset that are read by the metrics in
+    a report configuration, using the FIELDS declared by the metric
+    modules. The column used to partition a dataset in the store is
+    always included.
+
+    returns: dict of field lists by dataset. A dataset maps to None when
+             all of its fields are needed, e.g. when a series does not
+             declare its fields.
+    """
+    with open(yaml_path, 'r') as f:
+        dat = yaml.load(f, Loader=yaml.FullLoader)
+
+    fields = {'users': set(), 'resources': set(), 'activity': set()}
+    for name, metric in dat.get('metrics', {}).items():
+        mtype = metric.get('metric_type', None)
+        if mtype is None or mtype in EXTERNAL_METRICS:
+            continue
+
+        try:
+            if mtype in METRIC_FIELDS:
+                needs = [METRIC_FIELDS[mtype]]
+            else:
+                module = importlib.import_module(METRIC_MODULES[mtype])
+                needs = [module.FIELDS[s['type']] for s in metric['series']]
+        except (KeyError, ImportError, AttributeError) as e:
+            # only the datasets read by this metric type are downloaded
+            # with all of their fields
+            datasets = [d for d in build_cache.INPUTS.get(mtype, fields)
+                        if d in fields]
+            print(f'--> could not determine the fields used by {name} '
+                  f'({e}), all fields of {", ".join(datasets)} will be '
+                  'downloaded')
+            needs = [{d: None for d in datasets}]
+
+        for need in needs:
+            for dataset, cols in need.items():
+                if cols is None or fields[dataset] is None:
+                    fields[dataset] = None
+                else:
+                    fields[dataset].update(cols)
+
+    for dataset, cols in fields.items():
+        if cols is not None:
+            cols.add(store.PARTITION_COLUMNS[dataset])
+            rename = {v: k for k, v in RENAME_COLUMNS.get(dataset, {}).items()}
+            fields[dataset] = sorted(rename.get(c, c) for c in cols)
+
+    return fields
+
+
+def sync_activity(host, port, index, query, store_dir, drop=[],
+                  workers=1, partition='slice', fields=None,
+                  checkpoint_dir=None, es=None, deidentify=None,
+                  measure_bytes=False):
+    """
+    Downloads only the activity records that are newer than the
+    high-water mark saved in the store and appends them to the monthly
+    activity partitions. The first sync downloads the entire index.
+
+    returns: number of records that were downloaded
+    """
+    state = store.read_state(store_dir, 'activity')
+    hwm = state.get('session_timestamp')
+    if hwm is not None:
+        print(f'--> syncing activity since {hwm}')
+        # the range is inclusive so that records sharing the high-water
+        # mark timestamp are not lost, duplicates are removed on append
+        query = f'({query}) AND session_timestamp:["{hwm}" TO *]'
+    else:
+        print('--> no previous sync found, downloading all activity')
+
+    df = elastic.get_es_data(host, port, index, query=query, outpik=None,
+                             drop=drop, slices=workers, workers=workers,
+                             partition=partition, fields=fields,
+                             checkpoint_dir=checkpoint_dir, es=es,
+                             deidentify=deidentify,
+                             measure_bytes=measure_bytes,
+                             run_record=os.path.join(
+                                 store.dataset_dir(store_dir, 'activity'),
+                                 '_run.json'))
+    if len(df) == 0:
+        print('--> activity is up to date')
+        return 0
+
+    months = store.append(df, store_dir, 'activity', key='id')
+    print(f'--> updated activity partitions: {", ".join(months)}')
+
+    # save the new high-water mark. records without a timestamp are
+    # ignored, and the mark is unchanged if none of them has one.
+    ts = pandas.to_datetime(df.session_timestamp, utc=True)
+    latest = ts.dropna().max()
+    if pandas.notnull(latest):
+        state['session_timestamp'] = df.session_timestamp[ts == latest].iloc[0]
+    state['last_sync'] = datetime.utcnow().isoformat()
+    store.write_state(store_dir, 'activity', state)
+
+    return len(df)
+
+
+def save_to_store(pickle_file, store_dir, dataset):
+    """
+    Populates the store from a previously collected pickle file if the
+    dataset has not been saved to the store yet.
+    """
+    if not store.exists(store_dir, dataset) and os.path.exists(pickle_file):
+        print(f'--> saving {pickle_file} to store: {store_dir}')
+        store.overwrite(pandas.read_pickle(pickle_file), store_dir, dataset)
+
+
 def get_stats_data(users=True, resources=True,
                    activity=True, dirname='.',
-                   skip=True, deidentify=False):
+                   skip=True, deidentify=False,
+                   workers=1, partition='slice',
+                   incremental=False, store_dir=None,
+                   fields={}, checkpoint=False,
+                   checkpoint_dir=CHECKPOINT_DIR, es=None,
+                   salt_file=deidentification.SALT_FILE,
+                   measure_bytes=False):
+    """
+    Downloads the users, resources, and activity data. `es` is an optional
+    elasticsearch client that is used instead of connecting to the
+    hydroshare server, e.g. fake_elastic.FakeCluster for benchmarks.
+    When `deidentify` is set, personal information is hashed or removed
+    from every page as it is downloaded, see deidentification.py.
+    `measure_bytes` records the size of the downloaded pages in the run
+    records, see elastic.RunStats. When `checkpoint` is set, pages are
+    saved to `checkpoint_dir` as they are downloaded.
+    """
 
     # standard query parameters
     host = 'usagemetrics.hydroshare.org'
@@ -36,11 +189,27 @@ def get_stats_data(users=True, resources=True,
     aindex = '*activity*'
     aquery = '-user_id:None AND -action:visit'
 
+    # collected data is also saved to a partitioned parquet store that
+    # is read by the metric modules
+    if store_dir is None:
+        store_dir = os.path.join(dirname, 'store')
+
+    # activity pages are saved to checkpoint_dir while they are downloaded
+    # so that an interrupted download can be resumed. it does not depend
+    # on dirname, which is dated by default, so that a download resumes
+    # on another day.
+    if not checkpoint:
+        checkpoint_dir = None
+
+    # the same salt is used for every dataset so that hashed fields can
+    # be joined
+    deid = None
+    if deidentify:
+        deid = deidentification.Deidentifier(
+            deidentification.load_salt(salt_file))
+
     # get user data
     if users:
-        drop = []
-        if deidentify:
-            drop = ['usr_email', 'usr_firstname', 'usr_lastname']
         if os.path.exists(ufile) and skip:
             print(f'--> file exists: {ufile}...skipping')
         else:
@@ -50,11 +219,14 @@ def get_stats_data(users=True, resources=True,
                           index=uindex,
                           outpik=ufile,
                           outfile=ucsv,
-                          drop=drop)
+                          fields=fields.get('users'))
             for k, v in kwargs.items():
                 print(f'--> {k}: {v}')
 
-            elastic.get_es_data(host, **kwargs)
+            df = elastic.get_es_data(host, es=es, deidentify=deid,
+                                     measure_bytes=measure_bytes, **kwargs)
+            store.overwrite(df, store_dir, 'users')
+        save_to_store(ufile, store_dir, 'users')
     else:
         ufile = ''
 
@@ -69,24 +241,48 @@ def get_stats_data(users=True, resources=True,
                           index=rindex,
                           outpik=rfile,
                           outfile=rcsv,
-                          rename_cols={'id': 'resource_id'})
+                          rename_cols=RENAME_COLUMNS['resources'],
+                          fields=fields.get('resources'))
             for k, v in kwargs.items():
                 print(f'--> {k}: {v}')
 
-            elastic.get_es_data(host, **kwargs)
+            df = elastic.get_es_data(host, es=es, deidentify=deid,
+                                     measure_bytes=measure_bytes, **kwargs)
+            store.overwrite(df, store_dir, 'resources')
+        save_to_store(rfile, store_dir, 'resources')
     else:
         rfile = ''
 
     # get activity data
     if activity:
-        if deidentify:
-            drop = ['usr']
-        if os.path.exists(afile) and skip:
+        if incremental:
+            print('--> syncing activity metrics')
+            sync_activity(host, port, aindex, aquery, store_dir,
+                          workers=workers, partition=partition,
+                          fields=fields.get('activity'),
+                          checkpoint_dir=checkpoint_dir, es=es,
+                          deidentify=deid, measure_bytes=measure_bytes)
+
+            # materialize the activity pickle from the store
+            print(f'--> Saving Binary file to: {afile}')
+            store.read(store_dir, 'activity').to_pickle(afile)
+        elif os.path.exists(afile) and skip:
             print(f'--> file exists: {afile}...skipping')
         else:
             print('--> downloading activity metrics')
-            elastic.get_es_data(host, port, aindex, query=aquery,
-                                outpik=afile, outfile=acsv, drop=drop)
+            df = elastic.get_es_data(host, port, aindex, query=aquery,
+                                     outpik=afile, outfile=acsv,
+                                     slices=workers, workers=workers,
+                                     partition=partition,
+                                     fields=fields.get('activity'),
+                                     checkpoint_dir=checkpoint_dir, es=es,
+                                     deidentify=deid,
+                                     measure_bytes=measure_bytes)
+            store.overwrite(df, store_dir, 'activity')
+        save_to_store(afile, store_dir, 'activity')
+
+        # roll up the activity months that changed, see rollup.py
+        rollup.update(store_dir)
     else:
         afile = ''
 
@@ -112,9 +308,56 @@ if __name__ == '__main__':
                         help='directory to save data',
                         default=datetime.now().strftime('%m.%d.%Y'))
     parser.add_argument('--de-identify',
-                        help='de-identify the raw data',
+                        help='hash identifying fields (e.g. email and ip '
+                             'addresses) and remove names as the data are '
+                             'downloaded',
                         action='store_true',
                         default=False)
+    parser.add_argument('--salt-file',
+                        help='file holding the salt used to de-identify '
+                             'data, created if it does not exist. '
+                             f'${deidentification.SALT_VARIABLE} is used '
+                             'instead when it is set',
+                        default=deidentification.SALT_FILE)
+    parser.add_argument('--workers',
+                        help='number of concurrent downloads used to '
+                             'collect activity data',
+                        type=int,
+                        default=1)
+    parser.add_argument('--partition',
+                        help='split the activity download by sliced '
+                             'scroll (slice) or by daily index (index)',
+                        choices=['slice', 'index'],
+                        default='slice')
+    parser.add_argument('--incremental',
+                        help='only download activity that is newer than '
+                             'the last sync and append it to the store',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--store',
+                        help='directory of the partitioned data store '
+                             '(default: <d>/store)',
+                        default=None)
+    parser.add_argument('--checkpoint',
+                        help='save activity pages while downloading so that '
+                             'an interrupted download resumes where it '
+                             'stopped when run again',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--checkpoint-dir',
+                        help='directory where --checkpoint saves pages '
+                             f'(default: {CHECKPOINT_DIR})',
+                        default=CHECKPOINT_DIR)
+    parser.add_argument('--measure-bytes',
+                        help='record the size of the downloaded pages in '
+                             'the run record, which slows down the '
+                             'download',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--config',
+                        help='report configuration (yaml). only the fields '
+                             'used by its metrics are downloaded',
+                        default=None)
 
     args = parser.parse_args()
 
@@ -139,7 +382,23 @@ if __name__ == '__main__':
 
     print('Metrics will be saved into: %s' % datadir)
 
+    fields = {}
+    if args.config is not None:
+        fields = required_fields(args.config)
+        for dataset, cols in fields.items():
+            print(f'--> {dataset} fields: '
+                  f'{"all" if cols is None else ", ".join(cols)}')
+
     data = get_stats_data(dirname=datadir,
                           skip=args.s,
-                          deidentify=args.de_identify)
+                          deidentify=args.de_identify,
+                          workers=args.workers,
+                          partition=args.partition,
+                          incremental=args.incremental,
+                          store_dir=args.store,
+                          fields=fields,
+                          checkpoint=args.checkpoint,
+                          checkpoint_dir=args.checkpoint_dir,
+                          salt_file=args.salt_file,
+                          measure_bytes=args.measure_bytes)
 
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""
+Removes personal information from downloaded records while they are
+ingested. Fields that are used to join or count records, e.g. email
+addresses and ip addresses, are replaced with a salted hash that is the
+same for every occurrence of a value, so records can still be matched
+across datasets and collections. Names, log messages, and locations are
+removed.
+
+The salt is read from the USAGEMETRICS_SALT environment variable, or
+from a file (~/.usagemetrics/salt by default) that is created with a
+random salt the first time it is needed. Keep the same salt to compare
+de-identified collections, and keep it private.
+"""
+
+import os
+import hashlib
+import secrets
+import functools
+
+
+# fields replaced by a salted hash of their value
+HASH_FIELDS = ['usr_email', 'user_ip', 'client_host', 'geoip.ip']
+
+# fields that are removed
+STRIP_FIELDS = ['usr', 'usr_firstname', 'usr_lastname', 'message',
+                'log_message', 'geoip.latitude', 'geoip.longitude',
+                'geoip.location']
+
+SALT_VARIABLE = 'USAGEMETRICS_SALT'
+SALT_FILE = os.path.join(os.path.expanduser('~'), '.usagemetrics', 'salt')
+
+
+def load_salt(path=SALT_FILE):
+    """
+    Returns the salt from the environment, or from `path`, which is
+    created with a new random salt if it does not exist.
+    """
+    salt = os.environ.get(SALT_VARIABLE)
+    if salt:
+        return salt
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+        print(f'--> created a new de-identification salt: {path}')
+
+    with open(path, 'r') as f:
+        salt = f.read().strip()
+    if salt == '':
+        raise Exception(f'De-identification salt is empty: {path}')
+    return salt
+
+
+class Deidentifier(object):
+    """
+    Replaces HASH_FIELDS with salted hashes and removes STRIP_FIELDS from
+    elasticsearch hits, one page at a time. Pages are de-identified after
+    they are flattened into columns (see elastic.ColumnBuffer), and the
+    distinct values of each column are hashed. The digests of the
+    `max_digests` most recently seen values are kept, so values that
+    recur across pages, e.g. the ip addresses of active users, are
+    usually hashed once per download.
+    """
+    def __init__(self, salt, hash_fields=HASH_FIELDS,
+                 strip_fields=STRIP_FIELDS, digest_size=16,
+                 prefix='_source.', max_digests=1000000):
+        self.key = hashlib.sha256(salt.encode('utf-8')).digest()
+        self.hash_columns = [prefix + f for f in hash_fields]
+        self.strip_columns = [prefix + f for f in strip_fields]
+        self.digest_size = digest_size
+        self._digest = functools.lru_cache(maxsize=max_digests)(self.digest)
+
+    @property
+    def fingerprint(self):
+        """
+        Identifies the salt without revealing it, e.g. to keep the
+        checkpoints of downloads that use different salts apart.
+        """
+        return hashlib.sha256(b'fingerprint' + self.key).hexdigest()[:12]
+
+    def digest(self, value):
+        return hashlib.blake2b(value.encode('utf-8'), key=self.key,
+                               digest_size=self.digest_size).hexdigest()
+
+    def page(self, page):
+        """
+        De-identifies a page of flattened hits, i.e. an elastic.ColumnBuffer,
+        in place and returns it. Fields that are objects, e.g.
+        geoip.location, are flattened into several columns that are all
+        removed.
+        """
+        columns = page.columns
+        for col in list(columns.keys()):
+            if any(col == c or col.startswith(c + '.')
+                   for c in self.strip_columns):
+                del columns[col]
+
+        for col in self.hash_columns:
+            if col not in columns:
+                continue
+            values = [None if v is None else str(v) for v in columns[col]]
+            digests = {v: self._digest(v) for v in set(values)
+                       if v is not None}
+            digests[None] = None
+            columns[col] = [digests[v] for v in values]
+
+        return page
@@ -16,7 +16,9 @@ from pandas.plotting import register_matplotlib_converters
 
 
 import plot
+import cache
 import creds
+import store
 import utilities
 
 register_matplotlib_converters()
@@ -24,8 +26,21 @@ requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
 
 
 def load_data(working_dir, pickle_file='doi.pkl'):
+    """
+    Loads published resource data, collecting it from HydroShare if it
+    does not exist. Results are cached for the lifetime of the process.
+    """
+    key = ('doi', os.path.abspath(working_dir), pickle_file)
+    return cache.get(key, lambda: _load_data(working_dir, pickle_file))
+
+
+def _load_data(working_dir, pickle_file='doi.pkl'):
 
     # return existing doi data
+    store_dir = os.path.join(working_dir, 'store')
+    if store.exists(store_dir, 'doi'):
+        return store.read(store_dir, 'doi')
+
     path = os.path.join(working_dir, pickle_file)
     if os.path.exists(path):
         return pd.read_pickle(path)
@@ -62,6 +77,7 @@ def load_data(working_dir, pickle_file='doi.pkl'):
 
     with open(os.path.join(working_dir, 'doi.pkl'), 'wb') as f:
         pickle.dump(df, f)
+    store.overwrite(df, store_dir, 'doi')
 
     return df
 
@@ -1,13 +1,28 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import ast
 import sys
+import json
 import time
+import glob
+import shutil
 import pandas
+import fnmatch
+import hashlib
 import argparse
+import resource
+import threading
+import sinks
+import deidentification
 from tqdm import tqdm
+from datetime import datetime
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from elasticsearch import Elasticsearch
-from pandas.io.json import json_normalize
+from elasticsearch import exceptions as es_exceptions
 
 
 # standard elasticsearch fields to trim from the dataframe
@@ -17,22 +32,564 @@ DEFAULT_TRIM = ['@version', 'beat.hostname', 'beat.name', 'count', 'fields',
                 'syslog_severity', 'syslog_severity_code', 'tags', 'type']
 
 
+# sort keys used to page through results with search_after when downloads
+# are checkpointed, by index pattern. _uid (type#id) is unique, so it is
+# the last key of each sort and documents that tie on the other keys are
+# never skipped at a page boundary. _uid is sortable in elasticsearch 5.x.
+SORT_KEYS = {'*activity*': ['@timestamp', 'session_id', '_uid']}
+DEFAULT_SORT = ['@timestamp', '_uid']
+
+# http status codes of elasticsearch errors that are retried
+TRANSIENT_STATUS = [429, 502, 503, 504]
+
+# bytes literals written by str(bytes), e.g. b'University Faculty'
+BYTES_LITERAL = r"b'.*'|b\".*\""
+
+# bytes literals of printable ascii without escape sequences. these are
+# decoded by removing the b'' wrapper.
+SIMPLE_BYTES_LITERAL = (r"b'[\t\x20-\x26\x28-\x5b\x5d-\x7e]*'|"
+                        r"b\"[\t\x20-\x21\x23-\x5b\x5d-\x7e]*\"")
+
+
 def convert_binary_string(value):
     """
     This function removes the string encapsulated bytestrings that
-    HydroShare sends to ElasticSearch.
-
-    usage: df.applymap(convert_binary_string)
+    HydroShare sends to ElasticSearch. The literal is parsed with
+    ast.literal_eval so the content of the cell is never executed.
+    Values that are not bytes literals are returned unchanged.
     """
     try:
         if type(value) == str:
-            return eval(value).decode('utf-8')
-        else:
-            return value
+            decoded = ast.literal_eval(value)
+            if type(decoded) == bytes:
+                return decoded.decode('utf-8')
+        return value
     except Exception:
         return value
 
 
+def decode_binary_strings(df):
+    """
+    Decodes the string encapsulated bytestrings in a dataframe. Each
+    object column is scanned once with vectorized string matching and
+    columns without bytes literals are skipped. Literals of plain ascii
+    are unwrapped with a string slice, all others are parsed with
+    convert_binary_string.
+
+    returns: number of cells that were rewritten
+    """
+    rewritten = 0
+    for col in df.columns[df.dtypes == object]:
+        s = df[col]
+        try:
+            literal = s.str.fullmatch(BYTES_LITERAL, flags=re.DOTALL,
+                                      na=False)
+        except AttributeError:
+            # object column without strings
+            continue
+        if not literal.any():
+            continue
+
+        simple = s.str.fullmatch(SIMPLE_BYTES_LITERAL, na=False)
+        decoded = s.copy()
+        decoded[simple] = s[simple].str.slice(2, -1)
+        escaped = literal & ~simple
+        decoded[escaped] = s[escaped].map(convert_binary_string)
+
+        changed = simple | (escaped & (decoded != s))
+        rewritten += int(changed.sum())
+        df[col] = decoded
+
+    return rewritten
+
+
+def flatten_hit(hit, parent_key='', sep='.'):
+    """
+    Flattens a single elasticsearch hit into a dictionary of dotted
+    column names, e.g. {'_source': {'beat': {'name': x}}} becomes
+    {'_source.beat.name': x}. This mirrors the column naming of
+    json_normalize without building a dataframe for every page.
+    """
+    items = {}
+    for k, v in hit.items():
+        key = f'{parent_key}{sep}{k}' if parent_key else k
+        if isinstance(v, dict):
+            items.update(flatten_hit(v, key, sep=sep))
+        else:
+            items[key] = v
+    return items
+
+
+class ColumnBuffer(object):
+    """
+    Collects scroll pages into per-column lists so that the full result
+    set is turned into a dataframe exactly once, rather than
+    concatenating a new dataframe onto the results for every page.
+    """
+    def __init__(self, columns=None):
+        self.columns = OrderedDict(columns or {})
+        self.nrows = len(next(iter(self.columns.values()), []))
+
+    def __len__(self):
+        return self.nrows
+
+    def append(self, hits):
+        """
+        Appends a page of elasticsearch hits to the column buffers.
+        Columns that are missing from the page are padded with None.
+        """
+        rows = [flatten_hit(hit) for hit in hits]
+        if len(rows) == 0:
+            return
+
+        # collect the columns found in this page, preserving order
+        page_cols = OrderedDict()
+        for row in rows:
+            for k in row.keys():
+                page_cols[k] = None
+
+        # create buffers for columns that have not been seen before
+        for col in page_cols.keys():
+            if col not in self.columns:
+                self.columns[col] = [None] * self.nrows
+
+        for col, values in self.columns.items():
+            if col in page_cols:
+                values.extend([row.get(col) for row in rows])
+            else:
+                values.extend([None] * len(rows))
+
+        self.nrows += len(rows)
+
+    def extend(self, other):
+        """
+        Appends the contents of another ColumnBuffer to this one.
+        """
+        for col in other.columns.keys():
+            if col not in self.columns:
+                self.columns[col] = [None] * self.nrows
+
+        for col, values in self.columns.items():
+            if col in other.columns:
+                values.extend(other.columns[col])
+            else:
+                values.extend([None] * other.nrows)
+
+        self.nrows += other.nrows
+
+    def to_frame(self):
+        """
+        Builds a dataframe from the buffered columns and releases the
+        buffers.
+        """
+        df = pandas.DataFrame(self.columns, columns=list(self.columns.keys()))
+        self.columns = OrderedDict()
+        self.nrows = 0
+        return df
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident memory of this process in megabytes.
+    """
+    # ru_maxrss is reported in kilobytes on linux and bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 1024 ** 2
+    return rss / 1024
+
+
+class RunStats(object):
+    """
+    Collects the timing and size of every page and processing stage of a
+    download, which is saved as a json run record, e.g. activity.run.json.
+    When `measure_bytes` is set, page sizes are measured as the length of
+    the page's hits serialized to json, which approximates the bytes
+    received from elasticsearch. Serializing every page slows down the
+    download, so sizes are not measured by default and are None.
+    """
+    def __init__(self, measure_bytes=False, **params):
+        self.started = time.time()
+        self.measure_bytes = measure_bytes
+        self.params = params
+        self.pages = []
+        self.stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def page(self, index, latency, hits):
+        """
+        Records a page of hits and the latency of the request for it.
+        """
+        size = None
+        if self.measure_bytes:
+            size = len(json.dumps(hits, default=str))
+        with self._lock:
+            self.pages.append({'index': index,
+                               'latency': round(latency, 4),
+                               'rows': len(hits),
+                               'bytes': size})
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Records the time spent in a block of code. Time spent in the same
+        stage more than once, e.g. for every page, is summed.
+        """
+        st = time.time()
+        yield
+        with self._lock:
+            self.stages[name] = round(self.stages.get(name, 0) +
+                                      time.time() - st, 4)
+
+    def summary(self):
+        elapsed = time.time() - self.started
+        rows = sum(p['rows'] for p in self.pages)
+        latency = pandas.Series([p['latency'] for p in self.pages],
+                                dtype=float)
+        return OrderedDict(
+            seconds=round(elapsed, 4),
+            rows=rows,
+            rows_per_sec=round(rows / elapsed, 1) if elapsed > 0 else None,
+            bytes=(sum(p['bytes'] for p in self.pages)
+                   if self.measure_bytes else None),
+            pages=len(self.pages),
+            page_latency_mean=round(latency.mean(), 4) if len(latency) else None,
+            page_latency_p95=round(latency.quantile(.95), 4) if len(latency) else None,
+            page_latency_max=round(latency.max(), 4) if len(latency) else None,
+            peak_rss_mb=round(peak_rss_mb(), 1))
+
+    def save(self, path):
+        record = OrderedDict(
+            started=datetime.utcfromtimestamp(self.started).isoformat(),
+            params=self.params,
+            summary=self.summary(),
+            stages=self.stages,
+            pages=self.pages)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(record, f, indent=2, default=str)
+
+
+def get_partitions(es, index, slices=1, partition='slice'):
+    """
+    Splits a query into independent partitions that can be scrolled
+    concurrently. Partitions are returned as a list of (index, body)
+    tuples, in the order that their results should be merged.
+
+    partition='slice': uses elasticsearch sliced scroll to split the
+                       query into `slices` partitions.
+    partition='index': creates one partition for every index that matches
+                       the index pattern, e.g. the daily
+                       www-activity-YYYY.MM.DD indices, sorted by name.
+    """
+    if partition == 'index':
+        names = sorted(es.indices.get(index=index).keys())
+        return [(name, None) for name in names]
+
+    if partition != 'slice':
+        raise Exception(f'Unknown partition type: {partition}. '
+                        'Please choose from: slice, index')
+
+    if slices > 1:
+        return [(index, {'slice': {'id': i, 'max': slices}})
+                for i in range(slices)]
+    return [(index, None)]
+
+
+def scroll_partition(es, index, query, scroll_size, body=None, pbar=None,
+                     fields=None, stats=None, buf=None, deidentify=None):
+    """
+    Walks a single scroll cursor until it is exhausted, clears it, and
+    returns the hits in `buf`, a new ColumnBuffer by default or a
+    PageWriter. `body` is passed to the initial search, e.g. to request
+    a slice of the results. When `fields` is given, only these fields of
+    each document's _source are downloaded. `deidentify` is a
+    deidentification.Deidentifier applied to each page, after it is
+    flattened into columns, before it is buffered.
+    """
+    if fields is not None:
+        body = dict(body or {}, _source=list(fields))
+
+    kwargs = dict(index=index, q=query, scroll='10m', size=scroll_size)
+    if body is not None:
+        kwargs['body'] = body
+
+    if buf is None:
+        buf = ColumnBuffer()
+    st = time.time()
+    response = es.search(**kwargs)
+    while len(response['hits']['hits']) > 0:
+        if stats is not None:
+            stats.page(index, time.time() - st, response['hits']['hits'])
+        page = ColumnBuffer()
+        page.append(response['hits']['hits'])
+        if deidentify is not None:
+            deidentify.page(page)
+        buf.extend(page)
+        if pbar is not None:
+            pbar.update(len(response['hits']['hits']))
+
+        # make the next request using the previous _scroll_id
+        st = time.time()
+        response = es.scroll(scroll_id=response['_scroll_id'], scroll='10m')
+
+    # release the search context instead of holding it on the server until
+    # the scroll expires. the data has been downloaded, so errors are
+    # ignored.
+    try:
+        es.clear_scroll(scroll_id=response['_scroll_id'])
+    except Exception as e:
+        print(f'\n--> [skip] could not clear scroll: {e}')
+
+    return buf
+
+
+def is_transient(e):
+    """
+    Returns True for errors that are likely to succeed when the request
+    is repeated, e.g. connection failures, timeouts, and overloaded nodes.
+    """
+    if isinstance(e, (es_exceptions.ConnectionError, ConnectionError,
+                      TimeoutError)):
+        return True
+    if isinstance(e, es_exceptions.TransportError):
+        return e.status_code in TRANSIENT_STATUS
+    return False
+
+
+def with_retries(func, retries=5, backoff=1.0):
+    """
+    Calls `func()`, retrying transient errors up to `retries` times. The
+    wait between attempts doubles after every failure, starting with
+    `backoff` seconds.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == retries or not is_transient(e):
+                raise
+            wait = backoff * 2 ** attempt
+            print(f'\n--> request failed ({e}), retrying in {wait:.1f}s')
+            time.sleep(wait)
+
+
+def sort_key(index):
+    """
+    Returns the search_after sort of an index, see SORT_KEYS.
+    """
+    for pattern, sort in SORT_KEYS.items():
+        if fnmatch.fnmatch(index, pattern):
+            return sort
+    return DEFAULT_SORT
+
+
+def checkpoint_path(checkpoint_dir, index, query, fields, sort,
+                    salt_fingerprint=None):
+    """
+    Returns the directory holding the checkpoints of a download. Each
+    combination of index, query, fields, sort key, and de-identification
+    salt (see Deidentifier.fingerprint) has its own directory so that a
+    resumed download never mixes different requests, or hashes made with
+    different salts.
+    """
+    request = [index, query, fields, sort]
+    if salt_fingerprint is not None:
+        request.append(f'deidentified:{salt_fingerprint}')
+    request = json.dumps(request)
+    digest = hashlib.sha1(request.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(checkpoint_dir, digest)
+
+
+def checkpoint_partition(es, index, query, page_size, checkpoint, sort,
+                         pbar=None, fields=None, retries=5, backoff=1.0,
+                         stats=None, buf=None, deidentify=None):
+    """
+    Downloads a partition page by page using search_after on the `sort`
+    key and returns the hits in `buf`, a new ColumnBuffer by default or a
+    PageWriter. Every page is saved to the `checkpoint` directory before
+    the next one is requested, so an interrupted download resumes after
+    the last saved page. Requests are retried with exponential backoff.
+    Pages are flattened into columns and de-identified by `deidentify`
+    before they are saved.
+    """
+    path = os.path.join(checkpoint, re.sub(r'[^\w.-]', '_', index))
+    os.makedirs(path, exist_ok=True)
+
+    # load the pages saved by a previous attempt
+    if buf is None:
+        buf = ColumnBuffer()
+    search_after = None
+    pages = sorted(glob.glob(os.path.join(path, 'page-*.json')))
+    for page_file in pages:
+        with open(page_file, 'r') as f:
+            dat = json.load(f)
+        page = ColumnBuffer(dat['columns'])
+        buf.extend(page)
+        search_after = dat['search_after']
+        if pbar is not None:
+            pbar.update(len(page))
+    if os.path.exists(os.path.join(path, '_complete')):
+        return buf
+    if len(pages) > 0:
+        print(f'\n--> resuming {index} after {len(buf)} saved records')
+
+    body = {'sort': [{k: 'asc'} for k in sort]}
+    if fields is not None:
+        body['_source'] = list(fields)
+
+    n = len(pages)
+    while True:
+        if search_after is not None:
+            body['search_after'] = search_after
+        st = time.time()
+        response = with_retries(lambda: es.search(index=index, q=query,
+                                                  size=page_size,
+                                                  body=body),
+                                retries, backoff)
+        hits = response['hits']['hits']
+        if len(hits) == 0:
+            break
+        if stats is not None:
+            stats.page(index, time.time() - st, hits)
+
+        # the sort values are only needed to request the next page, they
+        # are not a column of the data
+        search_after = hits[-1]['sort']
+        for hit in hits:
+            hit.pop('sort', None)
+        page = ColumnBuffer()
+        page.append(hits)
+        if deidentify is not None:
+            deidentify.page(page)
+
+        # save the page, writing to a temporary file first so that a
+        # crash cannot leave a partial page behind
+        n += 1
+        page_file = os.path.join(path, f'page-{n:06d}.json')
+        with open(page_file + '.tmp', 'w') as f:
+            json.dump({'columns': page.columns,
+                       'search_after': search_after}, f)
+        os.replace(page_file + '.tmp', page_file)
+
+        buf.extend(page)
+        if pbar is not None:
+            pbar.update(len(page))
+
+    open(os.path.join(path, '_complete'), 'w').close()
+    return buf
+
+
+def clean_frame(df, stats, prefix={'_source.': '', '_': ''}, drop=[],
+                rename_cols={}):
+    """
+    Decodes bytestrings, removes the prefixes of column names, drops
+    columns, and renames columns of a dataframe of downloaded hits.
+
+    returns: (dataframe, dict listing the changes that were made)
+    """
+    with stats.stage('decode'):
+        decoded = decode_binary_strings(df)
+
+    with stats.stage('clean'):
+        # remove the prefixes of column names
+        renamed = OrderedDict()
+        for col in df.columns.values:
+            for pre in prefix.keys():
+                if pre in col:
+                    renamed[col] = col.replace(pre, prefix[pre])
+                    break
+        df.rename(columns=renamed, inplace=True)
+
+        dropped = [c for c in drop if c in df.columns.values]
+        df.drop(dropped, axis=1, inplace=True)
+
+        # rename columns any other columns that were specified in input args
+        found = []
+        for old_name, new_name in rename_cols.items():
+            if old_name in df.columns.values:
+                df.rename(columns={old_name: new_name}, inplace=True)
+                found.append(old_name)
+
+    return df, dict(decoded=decoded,
+                    prefixes=list(renamed.keys()),
+                    dropped=dropped,
+                    renamed=found)
+
+
+def merge_changes(changes, other):
+    """
+    Combines the changes made by clean_frame to different pages.
+    """
+    merged = dict(decoded=changes['decoded'] + other['decoded'])
+    for k in ['prefixes', 'dropped', 'renamed']:
+        merged[k] = list(dict.fromkeys(changes[k] + other[k]))
+    return merged
+
+
+def print_cleaning(changes, drop, rename_cols):
+    """
+    Reports the changes made by clean_frame.
+    """
+    print(f'--> decoded {changes["decoded"]} bytestring values')
+    print(f'--> removed prefixes from {len(changes["prefixes"])} column names')
+
+    missing = [c for c in drop if c not in changes['dropped']]
+    if len(changes['dropped']) > 0:
+        print(f'--> dropped columns: {", ".join(changes["dropped"])}')
+    if len(missing) > 0:
+        print(f'--> [skip] could not find columns to drop: '
+              f'{", ".join(missing)}')
+
+    for old_name, new_name in rename_cols.items():
+        if old_name in changes['renamed']:
+            print(f'--> renaming column {old_name} -> {new_name}')
+        else:
+            print(f'--> could not find column {old_name}, skipping rename operation')
+
+
+class PageWriter(object):
+    """
+    Cleans each page of hits as it is downloaded and writes it to a sink
+    (see sinks.py), so that memory is bounded by the size of a page
+    rather than the result set. Used in place of a ColumnBuffer by
+    scroll_partition and checkpoint_partition.
+    """
+    def __init__(self, sink, stats, **clean_args):
+        self.sink = sink
+        self.stats = stats
+        self.clean_args = clean_args
+        self.nrows = 0
+        self.changes = dict(decoded=0, prefixes=[], dropped=[], renamed=[])
+
+    def __len__(self):
+        return self.nrows
+
+    def append(self, hits):
+        page = ColumnBuffer()
+        page.append(hits)
+        self.extend(page)
+
+    def extend(self, page):
+        """
+        Cleans and writes a page that has been flattened into a
+        ColumnBuffer.
+        """
+        if len(page) == 0:
+            return
+
+        with self.stats.stage('normalize'):
+            df = page.to_frame()
+        df, changes = clean_frame(df, self.stats, **self.clean_args)
+        with self.stats.stage('write'):
+            self.sink.write(df)
+        self.nrows += len(df)
+        self.changes = merge_changes(self.changes, changes)
+
+    def close(self):
+        return self.sink.close()
+
+
 def print_progress(iteration, total, prefix='', suffix='',
                    decimals=1, length=100, fill='█'):
     percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
@@ -54,14 +611,83 @@ def get_es_data(host,
                 drop_standard=True,
                 drop=[],
                 deidentify=False,
-                rename_cols={}):
-    
-    # connect to the hydroshare elasticsearch server
-    es = Elasticsearch([{'host': host, 'port': port}])
+                rename_cols={},
+                es=None,
+                slices=1,
+                workers=1,
+                partition='slice',
+                fields=None,
+                checkpoint_dir=None,
+                retries=5,
+                backoff=1.0,
+                sort=None,
+                run_record=None,
+                return_frame=True,
+                measure_bytes=False):
+    """
+    Downloads the hits of a query into a dataframe, which is saved to
+    `outpik` and returned. `outfile` additionally saves the data as csv,
+    gzip compressed csv, or Parquet based on its extension (see sinks.py).
+
+    When `outpik` is None and `return_frame` is False the dataframe is
+    never built. Instead, each page is cleaned and appended to `outfile`
+    as it is downloaded, so the memory used does not grow with the size
+    of the index, and None is returned.
+
+    `deidentify` removes personal information from each page as it is
+    downloaded (see deidentification.py). It is a Deidentifier, or True
+    to use the configured salt.
+
+    `measure_bytes` records the approximate size of every page in the run
+    record, see RunStats.
+
+    `sort` is the search_after sort of checkpointed downloads, which is
+    chosen from the index by default (see sort_key).
+    """
+
+    # connect to the hydroshare elasticsearch server. An existing client
+    # (or a stand-in such as fake_elastic.FakeElasticsearch) can be
+    # provided instead.
+    if es is None:
+        es = Elasticsearch([{'host': host, 'port': port}])
+
+    if sort is None:
+        sort = sort_key(index)
+
+    if deidentify is True:
+        deidentify = deidentification.Deidentifier(
+            deidentification.load_salt())
+    elif deidentify is False:
+        deidentify = None
+
+    # timings and sizes of this download are saved to a json run record
+    stats = RunStats(measure_bytes=measure_bytes,
+                     host=host, index=index, query=query, slices=slices,
+                     workers=workers, partition=partition, fields=fields,
+                     checkpoint=checkpoint_dir is not None,
+                     deidentify=deidentify is not None)
+    if run_record is None and outpik is not None:
+        run_record = os.path.splitext(outpik)[0] + '.run.json'
+
+    # write pages to outfile as they arrive unless the entire dataframe
+    # is needed
+    stream = outpik is None and not return_frame
+    if stream and outfile is None:
+        raise Exception('An outfile is required when the data are not '
+                        'saved to a pickle or returned')
+
+    # columns to drop. copy the input list so the default argument is not
+    # modified between calls.
+    drop = list(drop)
+    if drop_standard:
+        drop.extend(DEFAULT_TRIM)
 
     # perform search
     try:
-        temp_r = es.search(index=index, q=query, scroll='10m', size=10)
+        with stats.stage('count'):
+            temp_r = with_retries(lambda: es.search(index=index, q=query,
+                                                    size=0),
+                                  retries, backoff)
     except Exception:
         print('Failed to complete search.')
         sys.exit(1)
@@ -76,87 +702,122 @@ def get_es_data(host,
     print('--> total number of records = %d' % total_size)
     print('--> scroll_size = %d' % scroll_size)
 
-    # execute the first elasticsearch query and increment the doc_size
-    response = es.search(index=index, q=query, scroll='10m', size=scroll_size)
-
-    # save the results in a pandas dataframe
-    df = json_normalize(response['hits']['hits'])
-    df = df.applymap(convert_binary_string)
+    # split the query into partitions that can be downloaded concurrently.
+    # checkpointed downloads page with search_after, which cannot be
+    # combined with sliced scroll, so they are partitioned by index.
+    if checkpoint_dir is not None and partition == 'slice' and slices > 1:
+        print('--> checkpointed downloads are partitioned by index')
+        partition = 'index'
+    partitions = get_partitions(es, index, slices=slices, partition=partition)
+    print(f'--> downloading {len(partitions)} partition(s) using '
+          f'{workers} worker(s)')
+    if fields is not None:
+        print(f'--> downloading fields: {", ".join(fields)}')
+    if deidentify is not None:
+        print('--> de-identifying records as they are downloaded')
 
     # initialize the progress bar, using ascii so it doesn't break
     # when called from a subprocess.
     pbar = tqdm(ascii=True, total=total_size)
-    while 1:
-        try:
-            # update progress. this is at the beginning because the first
-            # call is made before the loop begins
-            pbar.update(scroll_size)
-
-            # make the next request using the previous _scroll_id
-            sid = response['_scroll_id']
-            response = es.scroll(scroll_id=sid, scroll='10m')
-
-            # get the scroll_size of the previous query and exit
-            # if it is zero
-            scroll_size = len(response['hits']['hits'])
-
-            if scroll_size > 0:
-                # save the results in a pandas dataframe and append
-                # to previous results
-                new_df = json_normalize(response['hits']['hits'])
-                new_df = new_df.applymap(convert_binary_string)
-                df = pandas.concat([df, new_df], sort=False)
-            else:
-                break
 
-        except Exception as e:
-            print('\nFailed to normalize elasticsearch response.')
-            print(e)
-            sys.exit(1)
+    # download each partition and merge them in the order they were
+    # defined so the output does not depend on which worker finishes first.
+    if stream:
+        outputs = [outfile]
+        if len(partitions) > 1:
+            outputs = sinks.part_paths(outfile, len(partitions))
+        print(f'--> writing pages to: {outfile}')
+        bufs = [PageWriter(sinks.open_sink(p), stats, prefix=prefix,
+                           drop=drop, rename_cols=rename_cols)
+                for p in outputs]
+    else:
+        bufs = [ColumnBuffer() for _ in partitions]
+    checkpoint = None
+    if checkpoint_dir is not None:
+        checkpoint = checkpoint_path(checkpoint_dir, index, query, fields,
+                                     sort, None if deidentify is None
+                                     else deidentify.fingerprint)
+        print(f'--> saving downloaded pages to {checkpoint}')
+    try:
+        with stats.stage('download'), \
+                ThreadPoolExecutor(max_workers=workers) as pool:
+            if checkpoint is None:
+                futures = [pool.submit(scroll_partition, es, idx, query,
+                                       scroll_size, body, pbar, fields,
+                                       stats, buf, deidentify)
+                           for (idx, body), buf in zip(partitions, bufs)]
+            else:
+                futures = [pool.submit(checkpoint_partition, es, idx, query,
+                                       scroll_size, checkpoint, sort, pbar,
+                                       fields, retries, backoff, stats, buf,
+                                       deidentify)
+                           for (idx, body), buf in zip(partitions, bufs)]
+            for future in futures:
+                future.result()
+    except Exception as e:
+        print('\nFailed to normalize elasticsearch response.')
+        print(e)
+        if checkpoint is not None:
+            print(f'--> downloaded pages are saved in {checkpoint}, run '
+                  'again with the same arguments to resume')
+        sys.exit(1)
 
     # close the progress bar
     pbar.close()
 
-    # clean and trim the pandas table
-    for col in df.columns.values:
-        for pre in prefix.keys():
-            if pre in col:
-                new_name = col.replace(pre, prefix[pre])
-                print(f'--> renaming column {col} -> {new_name}')
-                df.rename(columns={col: new_name}, inplace=True)
-                time.sleep(.05)
-                break
-
-    # drop any specified columns
-    if drop_standard:
-        drop.extend(DEFAULT_TRIM)
-
-    for dropcol in drop:
-        if dropcol in df.columns.values:
-            print('--> dropping column: %s' % dropcol)
-            time.sleep(.05)
-            df.drop(dropcol, axis=1, inplace=True)
-        else:
-            print('--> [skip] drop column.  Could not find %s' % dropcol)
-
-    # rename columns any other columns that were specified in input args
-    col_names = df.columns.values
-    for old_name, new_name in rename_cols.items():
-        if old_name in col_names:
-            print(f'--> renaming column {old_name} -> {new_name}')
-            df.rename(columns={old_name: new_name}, inplace=True)
-        else:
-            print(f'--> could not find column {old_name}, skipping rename operation')
-
-    # write the dataframe to file if requested
-    if outfile is not None:
-        print('--> Saving CSV file to: %s' % outfile)
-        df.to_csv(outfile)
-
-    if os.path.exists(outpik):
-        os.remove(outpik)
-    print('--> Saving Binary file to: %s' % outpik)
-    df.to_pickle(outpik)
+    if stream:
+        # combine the outputs of the partitions in the order they were
+        # defined
+        df = None
+        with stats.stage('write'):
+            for buf in bufs:
+                buf.close()
+        if len(outputs) > 1:
+            with stats.stage('merge'):
+                sinks.concat(outputs, outfile)
+        changes = bufs[0].changes
+        for buf in bufs[1:]:
+            changes = merge_changes(changes, buf.changes)
+        print_cleaning(changes, drop, rename_cols)
+        print(f'--> saved {sum(len(b) for b in bufs)} records to: {outfile}')
+    else:
+        # build the dataframe and clean it once for all pages
+        buf = ColumnBuffer()
+        for b in bufs:
+            buf.extend(b)
+        with stats.stage('normalize'):
+            df = buf.to_frame()
+        df, changes = clean_frame(df, stats, prefix, drop, rename_cols)
+        print_cleaning(changes, drop, rename_cols)
+
+        # write the dataframe to file if requested
+        with stats.stage('write'):
+            if outfile is not None:
+                print('--> Saving file to: %s' % outfile)
+                sink = sinks.open_sink(outfile)
+                sink.write(df)
+                sink.close()
+
+            if outpik is not None:
+                if os.path.exists(outpik):
+                    os.remove(outpik)
+                print('--> Saving Binary file to: %s' % outpik)
+                df.to_pickle(outpik)
+
+    # the download is complete, remove its checkpoints
+    if checkpoint is not None:
+        shutil.rmtree(checkpoint)
+
+    summary = stats.summary()
+    size = ''
+    if summary['bytes'] is not None:
+        size = f'{summary["bytes"] / 1024 ** 2:.1f} MB, '
+    print(f'--> downloaded {summary["rows"]} records in '
+          f'{summary["seconds"]:.1f}s ({summary["rows_per_sec"]} rows/sec, '
+          f'{size}peak memory {summary["peak_rss_mb"]} MB)')
+    if run_record is not None:
+        stats.save(run_record)
+        print(f'--> run record saved to: {run_record}')
 
     return df
 
@@ -170,15 +831,33 @@ if __name__ == "__main__":
     parser.add_argument('-i', '--index', help='elasticsearch index to query', default='*')
     parser.add_argument('-q', '--query', help='elasticsearch query string', default='*')
     parser.add_argument('-x', '--prefix', help='prefix for the fields to return', default=['_source.'], nargs='*')
-    parser.add_argument('-f', '--file', help='output file', default=None)
+    parser.add_argument('-f', '--file', help='output file (.csv, .csv.gz, or .parquet)', default=None)
     parser.add_argument('-b', '--binary-file', help='output binary file', default='usage.pkl')
     parser.add_argument('-d', '--drop', help='specific columns to drop', default=[], nargs='*')
     parser.add_argument('-s', '--drop-standard', help='indcates whether or not to drop a standard set of elasticsearch columns', default=True)
+    parser.add_argument('--slices', help='number of sliced scroll partitions to download', type=int, default=1)
+    parser.add_argument('--workers', help='number of partitions to download concurrently', type=int, default=1)
+    parser.add_argument('--partition', help='how to partition the query: slice or index', choices=['slice', 'index'], default='slice')
+    parser.add_argument('--fields', help='_source fields to download, all fields are downloaded by default', default=None, nargs='*')
+    parser.add_argument('--checkpoint-dir', help='save downloaded pages to this directory so that an interrupted download can be resumed', default=None)
+    parser.add_argument('--retries', help='number of times a failed request is retried', type=int, default=5)
+    parser.add_argument('--de-identify', help='hash or remove personal information as records are downloaded, using the salt in $USAGEMETRICS_SALT or ~/.usagemetrics/salt', action='store_true', default=False)
+    parser.add_argument('--no-binary', help='do not save the binary file. pages are written to the output file as they are downloaded, which limits the memory used', action='store_true', default=False)
+    parser.add_argument('--measure-bytes', help='record the size of every downloaded page in the run record, which slows down the download', action='store_true', default=False)
     args = parser.parse_args()
 
+    if args.no_binary:
+        args.binary_file = None
+
     res = get_es_data(args.host, args.port, args.index, args.query, args.file, 
                       args.binary_file, list(args.prefix), args.drop_standard, 
-                      list(args.drop))
+                      list(args.drop), slices=args.slices,
+                      workers=args.workers, partition=args.partition,
+                      fields=args.fields, checkpoint_dir=args.checkpoint_dir,
+                      retries=args.retries,
+                      deidentify=args.de_identify,
+                      return_frame=not args.no_binary,
+                      measure_bytes=args.measure_bytes)
 
 
 
@@ -0,0 +1,666 @@
+#!/usr/bin/env python3
+
+"""
+A local, in-memory stand-in for the parts of the Elasticsearch client that
+are used by elastic.get_es_data. Documents are generated on demand from
+their position in the index so large synthetic indices can be served
+without holding them in memory. Search, scroll, clear_scroll, sliced
+scroll and indices.get are supported, as well as the queries and
+aggregations that are used by aggregate.py.
+
+usage:
+    es = FakeElasticsearch(total=10000)
+    elastic.get_es_data(None, es=es, outpik='activity.pkl')
+
+    # users, resources, and activity indices for collect_data.py
+    es = FakeCluster(users=1000, resources=2000, activity=10000)
+    collect_data.get_stats_data(dirname='data', es=es)
+"""
+
+import uuid
+import bisect
+import fnmatch
+import functools
+import itertools
+import pandas
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+
+ACTIONS = ['login', 'download', 'create', 'delete', 'app_launch', 'visit']
+
+USER_TYPES = ['University Faculty',
+              'University Graduate Student',
+              'University Professional or Research Staff',
+              'Government Official',
+              'Commercial/Professional',
+              'Unspecified',
+              'Other']
+
+EMAIL_DOMAINS = ['usu.edu', 'byu.edu', 'cuahsi.org', 'gmail.com', 'None']
+
+ORGANIZATIONS = ['Utah State University', 'Brigham Young University',
+                 'CUAHSI', 'University of Virginia', 'None']
+
+RESOURCE_TYPES = ['CompositeResource', 'GenericResource',
+                  'ModelInstanceResource', 'TimeSeriesResource',
+                  'CollectionResource']
+
+PUBLICATION_STATUS = ['private', 'public', 'discoverable', 'published']
+
+
+def users_document(i, report_date=None, start=datetime(2015, 1, 1),
+                   seconds_per_doc=3600):
+    """
+    Creates the i-th synthetic user document, shaped like the output of
+    the logstash hs-statistics-user filter. Users are numbered from 1 so
+    that they match the user_id of the activity documents.
+    """
+    if report_date is None:
+        report_date = datetime.today()
+    created = start + timedelta(seconds=i * seconds_per_doc,
+                                microseconds=i % 1000000)
+    login = created + timedelta(days=(i * 7919) % 365)
+    usr_id = i + 1
+    rpt = report_date.strftime('%m/%d/%Y')
+    created_str = created.strftime('%m/%d/%Y %H:%M:%S.%f')
+    login_str = login.strftime('%m/%d/%Y')
+    message = (f'{rpt},{created_str},first{usr_id},last{usr_id},'
+               f'user{usr_id}@{EMAIL_DOMAINS[usr_id % len(EMAIL_DOMAINS)]},'
+               f'{USER_TYPES[usr_id % len(USER_TYPES)]},'
+               f'{ORGANIZATIONS[usr_id % len(ORGANIZATIONS)]},'
+               f'{login_str},{usr_id}')
+    return {'@timestamp': report_date.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            '@version': '1',
+            'beat': {'hostname': 'hs-www', 'name': 'www.hydroshare.org'},
+            'count': 1,
+            'host': 'hs-www',
+            'indextag': 'www',
+            'input_type': 'log',
+            'logname': report_date.strftime('users-details.%m.%d.%Y'),
+            'message': message,
+            'source': report_date.strftime('/var/hydroshare/log/'
+                                           'users-details.%m.%d.%Y.log'),
+            'type': 'syslog',
+            'rpt_dt_str': rpt,
+            'usr_created_dt_str': created_str,
+            'usr_firstname': f'first{usr_id}',
+            'usr_lastname': f'last{usr_id}',
+            'usr_email': f'user{usr_id}@'
+                         f'{EMAIL_DOMAINS[usr_id % len(EMAIL_DOMAINS)]}',
+            'usr_type': USER_TYPES[usr_id % len(USER_TYPES)],
+            'usr_organization': ORGANIZATIONS[usr_id % len(ORGANIZATIONS)],
+            'usr_last_login_dt_str': login_str,
+            'usr_id': str(usr_id),
+            'usr_created_date': created.strftime('%Y-%m-%dT%H:%M:%S.') +
+            f'{created.microsecond // 1000:03d}Z',
+            'usr_last_login_date': login.strftime('%Y-%m-%dT00:00:00.000Z'),
+            'report_date': report_date.strftime('%Y-%m-%dT00:00:00.000Z')}
+
+
+def resources_document(i, n_users=5000, report_date=None,
+                       start=datetime(2015, 1, 1), seconds_per_doc=1800):
+    """
+    Creates the i-th synthetic resource document, shaped like the output
+    of the logstash hs-statistics-resources filter.
+    """
+    if report_date is None:
+        report_date = datetime.today()
+    created = start + timedelta(seconds=i * seconds_per_doc,
+                                microseconds=(i * 7) % 1000000)
+    usr_id = (i * 2654435761) % n_users + 1
+    rpt = report_date.strftime('%m/%d/%Y')
+    created_str = created.strftime('%m/%d/%Y %H:%M:%S.%f')
+    res_type = RESOURCE_TYPES[(i * 40503) % len(RESOURCE_TYPES)]
+    size = float((i * 2654435761) % 10**9)
+    status = PUBLICATION_STATUS[(i * 7919) % len(PUBLICATION_STATUS)]
+    usr_type = USER_TYPES[usr_id % len(USER_TYPES)]
+    message = (f'{rpt},{created_str},Resource {i},{res_type},{size:.0f},'
+               f'{status},{usr_type},{usr_id}')
+    return {'@timestamp': report_date.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            '@version': '1',
+            'beat': {'hostname': 'hs-www', 'name': 'www.hydroshare.org'},
+            'count': 1,
+            'host': 'hs-www',
+            'indextag': 'www',
+            'input_type': 'log',
+            'logname': report_date.strftime('resources-details.%m.%d.%Y'),
+            'message': message,
+            'source': report_date.strftime('/var/hydroshare/log/'
+                                           'resources-details.%m.%d.%Y.log'),
+            'type': 'syslog',
+            'rpt_dt_str': rpt,
+            'report_date': report_date.strftime('%Y-%m-%dT00:00:00.000Z'),
+            'res_created_dt_str': created_str,
+            'res_date_created': created.strftime('%Y-%m-%dT%H:%M:%S.') +
+            f'{created.microsecond // 1000:03d}Z',
+            'res_title': f'Resource {i}',
+            'res_size': size,
+            'res_pub_status': status,
+            'res_type': res_type,
+            'usr_type': usr_type,
+            'usr_id': str(usr_id)}
+
+
+def activity_document(i, n_users=5000, start=datetime(2015, 1, 1),
+                      seconds_per_doc=30):
+    """
+    Creates the i-th synthetic activity document, shaped like the output
+    of the logstash hs-statistics-session filter. Documents are ordered
+    by session_timestamp.
+    """
+    ts = start + timedelta(seconds=i * seconds_per_doc)
+    user_id = (i * 2654435761) % n_users + 1
+    action = ACTIONS[(i * 40503) % len(ACTIONS)]
+    user_type = USER_TYPES[user_id % len(USER_TYPES)]
+    domain = EMAIL_DOMAINS[user_id % len(EMAIL_DOMAINS)]
+    res_id = uuid.UUID(int=(i * 11400714819323198485) % (1 << 128)).hex
+    iso = ts.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    log_message = (f'user_id={user_id} session_id={i} action={action} '
+                   f'user_ip=10.0.{user_id % 255}.{i % 255} http_method=GET '
+                   f'http_code=200 user_type={user_type} '
+                   f'user_email_domain={domain} '
+                   f'request_url=/resource/{res_id}/')
+    return {'@timestamp': iso,
+            '@version': '1',
+            'beat': {'hostname': 'hs-www', 'name': 'www.hydroshare.org'},
+            'count': 1,
+            'host': 'hs-www',
+            'indextag': 'www',
+            'input_type': 'log',
+            'logname': 'activity',
+            'message': ts.strftime('%Y-%m-%d %H:%M:%S.000000+00:00 ') +
+            log_message,
+            'source': '/var/hydroshare/log/activity.log',
+            'tags': ['_grokparsefailure'],
+            'type': 'syslog',
+            'activity_date_index': ts.strftime('%Y.%m.%d'),
+            'log_message': log_message,
+            'action': action,
+            'session_id': i,
+            'session_timestamp': iso,
+            'user_id': user_id,
+            'user_ip': f'10.0.{user_id % 255}.{i % 255}',
+            'user_type': f"b'{user_type}'",
+            'user_email_domain': f"b'{domain}'",
+            'http_method': 'GET',
+            'http_code': '200',
+            'request_url': f'/resource/{res_id}/',
+            'resource_id': res_id}
+
+
+# fields that are not analyzed strings in configs/logstash/hs-template.json,
+# i.e. dates and the fields converted to numbers by logstash. Other string
+# fields are analyzed without fielddata, so they can only be aggregated,
+# sorted, or matched by terms through their not_analyzed .raw subfield.
+DOC_VALUE_FIELDS = ['@timestamp', 'session_timestamp', 'report_date',
+                    'usr_created_date', 'usr_last_login_date',
+                    'res_date_created', 'session_id', 'usr_id', 'res_size',
+                    'count']
+
+
+def _doc_value_field(field):
+    """
+    Returns the document field holding the doc values of `field` and
+    whether they are the strings of a .raw subfield. Analyzed fields
+    raise an exception, as elasticsearch does.
+    """
+    if field.endswith('.raw'):
+        return field[:-4], True
+    if field not in DOC_VALUE_FIELDS:
+        raise Exception(f'Fielddata is disabled on text fields by default, '
+                        f'use the not_analyzed subfield {field}.raw')
+    return field, False
+
+
+def doc_values(df, field):
+    """
+    Returns the doc values of a field as elasticsearch would use them in
+    aggregations and terms queries.
+    """
+    name, raw = _doc_value_field(field)
+    return df[name].astype(str) if raw else df[name]
+
+
+# pandas period aliases of the date_histogram calendar intervals
+CALENDAR_INTERVALS = {'day': 'D', '1d': 'D', 'week': 'W-SUN', '1w': 'W-SUN',
+                      'month': 'M', '1M': 'M', 'quarter': 'Q', '1q': 'Q',
+                      'year': 'A', '1y': 'A'}
+
+
+def _epoch_ms(dates):
+    return pandas.to_datetime(dates, utc=True).astype('int64') // 10**6
+
+
+def _bound(value):
+    if isinstance(value, str) and not value.isdigit():
+        return pandas.Timestamp(value).value // 10**6
+    return int(value)
+
+
+def match_query(df, query):
+    """
+    Evaluates a query on a dataframe of documents and returns a boolean
+    mask. Supports bool (filter, must, must_not), match_all, terms, range
+    on dates, and query_string queries made of field:value clauses
+    joined by AND, e.g. -user_id:None AND -action:visit.
+    """
+    mask = pandas.Series(True, index=df.index)
+    if query is None or 'match_all' in query:
+        return mask
+
+    if 'bool' in query:
+        for q in query['bool'].get('filter', []) + \
+                query['bool'].get('must', []):
+            mask &= match_query(df, q)
+        for q in query['bool'].get('must_not', []):
+            mask &= ~match_query(df, q)
+        return mask
+
+    if 'terms' in query:
+        (field, values), = query['terms'].items()
+        return doc_values(df, field).isin(values)
+
+    if 'range' in query:
+        (field, bounds), = query['range'].items()
+        ms = _epoch_ms(df[field])
+        ops = {'gte': ms.ge, 'gt': ms.gt, 'lte': ms.le, 'lt': ms.lt}
+        for op, value in bounds.items():
+            if op in ops:
+                mask &= ops[op](_bound(value))
+        return mask
+
+    if 'query_string' in query:
+        q = query['query_string']['query'].strip()
+        if q == '*':
+            return mask
+        for clause in q.split(' AND '):
+            negate = clause.startswith('-')
+            field, value = clause.lstrip('-').split(':', 1)
+            if field not in df.columns or any(c in value for c in '[]()*"'):
+                raise Exception(f'Unsupported query_string clause: {clause}')
+            match = df[field].astype(str) == value
+            mask &= ~match if negate else match
+        return mask
+
+    raise Exception(f'Unsupported query: {list(query)}')
+
+
+def aggregate(df, aggs):
+    """
+    Evaluates min, cardinality, terms, date_range, and date_histogram
+    aggregations, including sub-aggregations, on a dataframe of documents.
+    """
+    result = {}
+    for name, agg in aggs.items():
+        sub = agg.get('aggs', agg.get('aggregations', {}))
+
+        if 'min' in agg:
+            field = agg['min']['field']
+            value = _epoch_ms(df[field]).min() if len(df) else None
+            result[name] = {'value': None if value is None
+                            else float(value)}
+
+        elif 'cardinality' in agg:
+            result[name] = {'value': int(doc_values(
+                df, agg['cardinality']['field']).nunique())}
+
+        elif 'terms' in agg:
+            field = agg['terms']['field']
+            size = agg['terms'].get('size', 10)
+            values = doc_values(df, field)
+            counts = values.value_counts()
+            counts = sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))
+            buckets = []
+            for key, count in counts[:size]:
+                bucket = {'key': key, 'doc_count': int(count)}
+                bucket.update(aggregate(df[values == key], sub))
+                buckets.append(bucket)
+            result[name] = {'buckets': buckets}
+
+        elif 'date_range' in agg:
+            ms = _epoch_ms(df[agg['date_range']['field']])
+            buckets = []
+            for r in agg['date_range']['ranges']:
+                mask = pandas.Series(True, index=df.index)
+                bucket = {}
+                if 'from' in r:
+                    bucket['from'] = float(_bound(r['from']))
+                    mask &= ms >= bucket['from']
+                if 'to' in r:
+                    bucket['to'] = float(_bound(r['to']))
+                    mask &= ms < bucket['to']
+                bucket['doc_count'] = int(mask.sum())
+                bucket.update(aggregate(df[mask], sub))
+                buckets.append(bucket)
+            buckets.sort(key=lambda b: (b.get('from', float('-inf')),
+                                        b.get('to', float('inf'))))
+            result[name] = {'buckets': buckets}
+
+        elif 'date_histogram' in agg:
+            hist = agg['date_histogram']
+            interval = hist.get('calendar_interval', hist.get('interval'))
+            dates = pandas.to_datetime(df[hist['field']], utc=True) \
+                          .dt.tz_localize(None)
+            periods = dates.dt.to_period(CALENDAR_INTERVALS[interval])
+            buckets = []
+            if len(df):
+                for p in pandas.period_range(periods.min(), periods.max()):
+                    mask = periods == p
+                    if mask.sum() < hist.get('min_doc_count', 0):
+                        continue
+                    key = pandas.Timestamp(p.start_time, tz='UTC')
+                    bucket = {'key_as_string': key.isoformat(),
+                              'key': key.value // 10**6,
+                              'doc_count': int(mask.sum())}
+                    bucket.update(aggregate(df[mask], sub))
+                    buckets.append(bucket)
+            result[name] = {'buckets': buckets}
+
+        else:
+            raise Exception(f'Unsupported aggregation: {list(agg)}')
+
+    return result
+
+
+def project(doc, includes):
+    """
+    Returns the fields of a document that match the _source includes,
+    e.g. ['user_id', 'beat.*'].
+    """
+    out = {}
+    for k, v in doc.items():
+        if any(fnmatch.fnmatch(k, p) for p in includes):
+            out[k] = v
+        elif isinstance(v, dict):
+            nested = [p[len(k) + 1:] for p in includes
+                      if p.startswith(k + '.')]
+            if len(nested) > 0:
+                out[k] = project(v, nested)
+    return out
+
+
+class FakeIndices(object):
+    """
+    Stand-in for the Elasticsearch.indices namespace.
+    """
+    def __init__(self, es):
+        self.es = es
+
+    def get(self, index='*', **kwargs):
+        return {name: {} for name, _ in self.es._matching(index)}
+
+
+class FakeElasticsearch(object):
+    """
+    Serves paged hits through search/scroll for a synthetic index of
+    `total` documents created by `document(i)`. Documents are split into
+    consecutive indices of `docs_per_index` documents named by
+    `index_name(k)`, which by default mirrors the daily activity indices
+    written by logstash, i.e. %{indextag}-%{logname}-%{activity_date_index}.
+    Sliced scroll requests, _source includes, and ascending sort with
+    search_after are supported through the search body, and search bodies
+    with aggregations are evaluated on all documents.
+
+    Failures can be injected to test retries and resumed downloads: every
+    `fail_every`-th request raises a ConnectionError, and once
+    `fail_after` requests have been made all further requests fail.
+    """
+    def __init__(self, total=10000, document=activity_document,
+                 docs_per_index=2880, index_name=None, fail_every=None,
+                 fail_after=None):
+        self.total = total
+        self.fail_every = fail_every
+        self.fail_after = fail_after
+        self.requests = 0
+        self._sorted = {}
+        self.document = document
+        self.docs_per_index = docs_per_index
+        if index_name is None:
+            def index_name(k):
+                day = datetime(2015, 1, 1) + timedelta(days=k)
+                return day.strftime('www-activity-%Y.%m.%d')
+        self.index_name = index_name
+        self.indices = FakeIndices(self)
+        self._scrolls = {}
+
+    def _matching(self, index):
+        """
+        Returns (name, range) pairs for every index that matches the
+        comma separated index pattern.
+        """
+        patterns = index.split(',')
+        n_indices = -(-self.total // self.docs_per_index)
+        matches = []
+        for k in range(n_indices):
+            name = self.index_name(k)
+            if any(fnmatch.fnmatch(name, p) for p in patterns):
+                st = k * self.docs_per_index
+                matches.append((name, range(st, min(st + self.docs_per_index,
+                                                    self.total))))
+        return matches
+
+    def _positions(self, index, body):
+        """
+        Returns the document positions that satisfy the request as a list
+        of ranges.
+        """
+        ranges = [r for _, r in self._matching(index)]
+        sl = (body or {}).get('slice')
+        if sl is not None:
+            sid, smax = sl['id'], sl['max']
+            ranges = [range(r.start + (sid - r.start) % smax, r.stop, smax)
+                      for r in ranges]
+        return ranges
+
+    def _hit(self, i, includes=None):
+        k = i // self.docs_per_index
+        source = self.document(i)
+        if includes is not None:
+            source = project(source, includes)
+        return {'_index': self.index_name(k),
+                '_type': 'doc',
+                '_id': str(i),
+                '_score': 1.0,
+                '_source': source}
+
+    def _page(self, scroll_id):
+        positions, total, size, includes = self._scrolls[scroll_id]
+        hits = [self._hit(i, includes)
+                for i in itertools.islice(positions, size)]
+        return {'_scroll_id': scroll_id,
+                'took': 1,
+                'timed_out': False,
+                'hits': {'total': total,
+                         'max_score': 1.0,
+                         'hits': hits}}
+
+    def _request(self):
+        self.requests += 1
+        if self.fail_after is not None and self.requests > self.fail_after:
+            raise ConnectionError('injected failure: node is unavailable')
+        if self.fail_every is not None and \
+                self.requests % self.fail_every == 0:
+            raise ConnectionError('injected failure: connection reset')
+
+    def _sort_value(self, doc, i, field):
+        if field == '_uid':
+            return f'doc#{i}'
+        name, raw = _doc_value_field(field)
+        value = doc.get(name)
+        return str(value) if raw and value is not None else value
+
+    def _sort_keys(self, index, fields):
+        """
+        Returns the document positions of the matching indices ordered by
+        the sort fields, and the sort values of each position.
+        """
+        key = (index, tuple(fields))
+        if key not in self._sorted:
+            keys = []
+            for r in self._positions(index, None):
+                for i in r:
+                    doc = self.document(i)
+                    keys.append([self._sort_value(doc, i, f)
+                                 for f in fields] + [i])
+            keys.sort()
+            self._sorted[key] = ([k[-1] for k in keys],
+                                 [k[:-1] for k in keys])
+        return self._sorted[key]
+
+    def _search_after(self, index, size, body):
+        fields = [list(s)[0] if isinstance(s, dict) else s
+                  for s in body['sort']]
+        positions, keys = self._sort_keys(index, fields)
+        st = 0
+        if body.get('search_after') is not None:
+            st = bisect.bisect_right(keys, list(body['search_after']))
+        includes = body.get('_source')
+        hits = []
+        for j in range(st, min(st + size, len(positions))):
+            hit = self._hit(positions[j], includes)
+            hit['sort'] = keys[j]
+            hits.append(hit)
+        return {'took': 1,
+                'timed_out': False,
+                'hits': {'total': len(positions),
+                         'max_score': None,
+                         'hits': hits}}
+
+    def _aggregate(self, index, body):
+        """
+        Evaluates the query and aggregations of a search body on every
+        document of the matching indices.
+        """
+        docs = pandas.DataFrame([self.document(i)
+                                 for r in self._positions(index, None)
+                                 for i in r])
+        docs = docs[match_query(docs, body.get('query'))]
+        return {'took': 1,
+                'timed_out': False,
+                'hits': {'total': len(docs), 'max_score': 0.0, 'hits': []},
+                'aggregations': aggregate(docs, body.get('aggs',
+                                          body.get('aggregations', {})))}
+
+    def search(self, index='*', q='*', scroll=None, size=10, body=None,
+               **kwargs):
+        self._request()
+        if body is not None and ('aggs' in body or 'aggregations' in body):
+            return self._aggregate(index, body)
+        if body is not None and 'sort' in body and scroll is None:
+            return self._search_after(index, size, body)
+
+        ranges = self._positions(index, body)
+        total = sum(len(r) for r in ranges)
+        scroll_id = uuid.uuid4().hex
+        includes = (body or {}).get('_source')
+        self._scrolls[scroll_id] = (itertools.chain(*ranges), total, size,
+                                    includes)
+        response = self._page(scroll_id)
+        if scroll is None:
+            del self._scrolls[scroll_id]
+        return response
+
+    def scroll(self, scroll_id, scroll=None, **kwargs):
+        self._request()
+        if scroll_id not in self._scrolls:
+            raise Exception(f'No search context found for id [{scroll_id}]')
+        return self._page(scroll_id)
+
+    def clear_scroll(self, scroll_id=None, body=None, **kwargs):
+        """
+        Releases search contexts. Contexts that were never cleared remain
+        in `_scrolls`, which can be used to check for leaked cursors.
+        """
+        self._request()
+        ids = scroll_id if scroll_id is not None else \
+            (body or {}).get('scroll_id', [])
+        if isinstance(ids, str):
+            ids = ids.split(',')
+        freed = 0
+        for sid in ids:
+            if self._scrolls.pop(sid, None) is not None:
+                freed += 1
+        return {'succeeded': True, 'num_freed': freed}
+
+
+def _fixed_name(name):
+    return lambda k: name
+
+
+class FakeCluster(object):
+    """
+    Serves the users, resources, and activity indices queried by
+    collect_data.py, each backed by a FakeElasticsearch. Requests are
+    routed to the dataset whose indices match the index pattern, e.g.
+    *user*latest* or *activity*. Users and resources are single "latest"
+    indices stamped with `report_date`, and activity is split into daily
+    indices. Other keyword arguments, e.g. fail_every, are passed to
+    every dataset.
+    """
+    def __init__(self, users=1000, resources=1000, activity=10000,
+                 report_date=None, **kwargs):
+        n_users = max(users, 1)
+        self.datasets = OrderedDict([
+            ('users', FakeElasticsearch(
+                total=users,
+                document=functools.partial(users_document,
+                                           report_date=report_date),
+                docs_per_index=max(users, 1),
+                index_name=_fixed_name('www-users-details-latest'),
+                **kwargs)),
+            ('resources', FakeElasticsearch(
+                total=resources,
+                document=functools.partial(resources_document,
+                                           n_users=n_users,
+                                           report_date=report_date),
+                docs_per_index=max(resources, 1),
+                index_name=_fixed_name('www-resources-details-latest'),
+                **kwargs)),
+            ('activity', FakeElasticsearch(
+                total=activity,
+                document=functools.partial(activity_document,
+                                           n_users=n_users),
+                **kwargs))])
+        self.indices = FakeIndices(self)
+
+    @property
+    def requests(self):
+        return sum(es.requests for es in self.datasets.values())
+
+    def _matching(self, index):
+        return [m for es in self.datasets.values()
+                for m in es._matching(index)]
+
+    def _route(self, index):
+        matches = [es for es in self.datasets.values() if es._matching(index)]
+        if len(matches) > 1:
+            raise Exception(f'Index pattern {index} matches more than one '
+                            'dataset')
+        if len(matches) == 0:
+            # no indices match, which returns no hits
+            return FakeElasticsearch(total=0)
+        return matches[0]
+
+    def _owner(self, scroll_id):
+        for es in self.datasets.values():
+            if scroll_id in es._scrolls:
+                return es
+        raise Exception(f'No search context found for id [{scroll_id}]')
+
+    def search(self, index='*', **kwargs):
+        return self._route(index).search(index=index, **kwargs)
+
+    def scroll(self, scroll_id, **kwargs):
+        return self._owner(scroll_id).scroll(scroll_id, **kwargs)
+
+    def clear_scroll(self, scroll_id=None, body=None, **kwargs):
+        ids = scroll_id if scroll_id is not None else \
+            (body or {}).get('scroll_id', [])
+        if isinstance(ids, str):
+            ids = ids.split(',')
+        freed = 0
+        for sid in ids:
+            freed += self._owner(sid).clear_scroll(scroll_id=sid,
+                                                   **kwargs)['num_freed']
+        return {'succeeded': True, 'num_freed': freed}
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+"""
+Approximate windowed distinct counts using HyperLogLog sketches. Each
+day of records is summarized by a sketch of 2^p one-byte registers, and
+the sketch of a window is the element-wise maximum of the sketches of
+its days. The count of distinct ids in the window is estimated from
+that merged sketch. Memory depends on the number of days and the
+precision, not on the number of records or ids.
+
+The precision is chosen from the requested error rate. The relative
+standard error of an estimate is about 1.04 / sqrt(2^p), so an error
+rate of 0.02 uses 2^12 registers per day. Small counts are estimated by
+linear counting, which is close to exact.
+
+usage:
+    y = hll.windowed_distinct_count(dates, ids, endpoints,
+                                    timedelta(days=30), error_rate=0.02)
+"""
+
+import math
+import numpy
+import pandas
+from datetime import timedelta
+
+
+# default relative standard error of the estimates
+ERROR_RATE = 0.02
+
+# range of supported precisions, i.e. log2 of the number of registers
+MIN_PRECISION = 4
+MAX_PRECISION = 18
+
+DAY = pandas.Timedelta(days=1).value
+
+
+def precision(error_rate=ERROR_RATE):
+    """
+    Returns the number of index bits p whose standard error,
+    1.04 / sqrt(2^p), is at most `error_rate`.
+    """
+    if error_rate <= 0:
+        raise Exception(f'HyperLogLog error rate must be positive: '
+                        f'{error_rate}')
+    p = math.ceil(math.log2((1.04 / error_rate) ** 2))
+    return min(max(p, MIN_PRECISION), MAX_PRECISION)
+
+
+def _bit_length(x):
+    """
+    Returns the number of bits needed to represent each value of a
+    uint64 array, computed exactly from its 32-bit halves.
+    """
+    high = (x >> numpy.uint64(32)).astype('float64')
+    low = (x & numpy.uint64(0xFFFFFFFF)).astype('float64')
+    return numpy.where(high > 0, numpy.frexp(high)[1] + 32,
+                       numpy.frexp(low)[1])
+
+
+def registers(ids, p):
+    """
+    Hashes ids to 64 bits and returns the register index (the first p
+    bits) and the rank (the position of the first 1 in the other bits)
+    of each id.
+    """
+    h = pandas.util.hash_pandas_object(pandas.Series(ids), index=False) \
+              .values.astype('uint64')
+    index = (h >> numpy.uint64(64 - p)).astype('int64')
+    rest = h & numpy.uint64((1 << (64 - p)) - 1)
+    rank = (64 - p) - _bit_length(rest) + 1
+    return index, rank.astype('uint8')
+
+
+def daily_sketches(dates, ids, p):
+    """
+    Builds one sketch for each day between the first and last record.
+
+    returns: (first day in ns since epoch, array of shape (days, 2^p)).
+             The first day is None if there are no records.
+    """
+    ids = pandas.Series(ids).reset_index(drop=True)
+    t = pandas.DatetimeIndex(dates)
+    if t.tz is not None:
+        t = t.tz_convert('UTC').tz_localize(None)
+    t = t.normalize().asi8
+
+    valid = ids.notnull().values & (t != pandas.NaT.value)
+    if not valid.any():
+        return None, numpy.zeros((0, 1 << p), dtype='uint8')
+
+    t, ids = t[valid], ids[valid]
+    first = t.min()
+    day = (t - first) // DAY
+    index, rank = registers(ids, p)
+
+    sketches = numpy.zeros((day.max() + 1, 1 << p), dtype='uint8')
+    numpy.maximum.at(sketches, (day, index), rank)
+    return first, sketches
+
+
+def window_max(sketches, last_days, length):
+    """
+    Merges the sketches of `length` consecutive days ending at each of
+    `last_days`. Days outside of the sketches are empty. The maxima are
+    found with the van Herk/Gil-Werman algorithm: the days are split into
+    blocks of `length`, and a window is the union of the suffix of one
+    block and the prefix of the next, so each window needs two lookups.
+
+    returns: array of shape (len(last_days), 2^p)
+    """
+    m = sketches.shape[1]
+
+    # pad the days so that every window is inside of the array and the
+    # number of days is a multiple of the block length
+    front = length - 1
+    end = max(int(numpy.max(last_days)) + 1, sketches.shape[0])
+    blocks = -(-(front + end) // length)
+    padded = numpy.zeros((blocks * length, m), dtype='uint8')
+    padded[front:front + sketches.shape[0]] = sketches
+
+    padded = padded.reshape(blocks, length, m)
+    prefix = numpy.maximum.accumulate(padded, axis=1).reshape(-1, m)
+    suffix = numpy.maximum.accumulate(padded[:, ::-1], axis=1)[:, ::-1] \
+                  .reshape(-1, m)
+
+    r = numpy.asarray(last_days) + front
+    return numpy.maximum(suffix[r - length + 1], prefix[r])
+
+
+def estimate(sketches):
+    """
+    Estimates the number of distinct ids of each sketch (row).
+    """
+    m = sketches.shape[1]
+    alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+
+    # sum 2^-register of each row, a block of rows at a time to limit the
+    # memory of the float copy
+    powers = numpy.ldexp(1.0, -numpy.arange(65))
+    total = numpy.concatenate(
+        [powers[sketches[i:i + 256]].sum(axis=1)
+         for i in range(0, sketches.shape[0], 256)] + [numpy.zeros(0)])
+    raw = alpha * m ** 2 / total
+
+    # use linear counting for small counts
+    zeros = numpy.sum(sketches == 0, axis=1)
+    small = (raw <= 2.5 * m) & (zeros > 0)
+    linear = m * numpy.log(m / numpy.maximum(zeros, 1))
+    return numpy.where(small, linear, raw)
+
+
+def windowed_distinct_counts(dates, ids, windows, error_rate=ERROR_RATE):
+    """
+    Approximates utilities.windowed_distinct_counts, i.e. the number of
+    distinct ids within (t - window, t] for the endpoints t of several
+    windows. Daily sketches are built once for all windows. Windows are
+    rounded to whole days.
+
+    args:
+        dates (Series): date of each record
+        ids (Series): id of each record, e.g. user_id
+        windows (list): (endpoints, window) tuples, where endpoints is a
+                        list of window end dates and window a timedelta
+        error_rate (float): relative standard error of the counts
+    returns: list of numpy arrays of counts, one for each window
+    """
+    first, sketches = daily_sketches(dates, ids, precision(error_rate))
+
+    counts = []
+    for endpoints, window in windows:
+        if len(endpoints) == 0 or first is None:
+            counts.append(numpy.zeros(len(endpoints), dtype=int))
+            continue
+
+        e = pandas.DatetimeIndex(endpoints)
+        if e.tz is not None:
+            e = e.tz_convert('UTC').tz_localize(None)
+        last_days = (e.normalize().asi8 - first) // DAY
+        length = max(int(pandas.Timedelta(window) // timedelta(days=1)), 1)
+
+        # windows that end before the first record are empty
+        merged = window_max(sketches, numpy.maximum(last_days, 0), length)
+        merged[last_days < 0] = 0
+        counts.append(numpy.rint(estimate(merged)).astype(int))
+    return counts
+
+
+def windowed_distinct_count(dates, ids, endpoints, window,
+                            error_rate=ERROR_RATE):
+    """
+    Approximates utilities.windowed_distinct_count for one window.
+    """
+    return windowed_distinct_counts(dates, ids, [(endpoints, window)],
+                                    error_rate)[0]
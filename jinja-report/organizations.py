@@ -6,23 +6,51 @@ from datetime import datetime
 from pandas.plotting import register_matplotlib_converters
 
 import plot
+import cache
+import store
+import utilities
 
 register_matplotlib_converters()
 
 
-def load_data(workingdir):
+# fields of the collected datasets that are read by each series, see
+# collect_data.required_fields
+_fields = {'users': ['usr_created_date', 'usr_organization']}
+FIELDS = {'total': _fields,
+          'us_universities': _fields,
+          'international_universities': _fields,
+          'cuahsi_members': _fields}
+
+
+def load_data(workingdir, columns=None, start_time=None, end_time=None):
+    """
+    Loads user data. The cleaned data are cached for the lifetime of the
+    process, and the columns and monthly partitions are selected from a
+    copy of them (see store.select).
+    """
+    key = ('organizations', os.path.abspath(workingdir))
+    df = cache.get(key, lambda: _load_data(workingdir), copy=False)
+
+    # always include the account creation date
+    if columns is not None:
+        columns = columns + ['usr_created_date', 'date']
+    return store.select(df, 'users', columns, start_time, end_time).copy()
+
+
+def _load_data(workingdir):
 
     # load the data
-    path = os.path.join(workingdir, 'users.pkl')
-    df = pandas.read_pickle(path)
+    df = utilities.load_dataset(workingdir, 'users')
 
     # convert dates
     df['date'] = pandas.to_datetime(df.usr_created_date).dt.normalize()
     df.usr_created_date = pandas.to_datetime(df.usr_created_date) \
                                 .dt.normalize()
-    df.usr_last_login_date = pandas.to_datetime(df.usr_last_login_date) \
-                                   .dt.normalize()
-    df.report_date = pandas.to_datetime(df.report_date).dt.normalize()
+    if 'usr_last_login_date' in df.columns:
+        df.usr_last_login_date = pandas.to_datetime(df.usr_last_login_date) \
+                                       .dt.normalize()
+    if 'report_date' in df.columns:
+        df.report_date = pandas.to_datetime(df.report_date).dt.normalize()
 
     # add another date column and make it the index
     df['Date'] = df['date']
@@ -87,7 +115,10 @@ def total(input_directory='.',
     print('--> calculating total distinct organizations')
 
     # load the data based on working directory and subset it if necessary
-    df = load_data(input_directory)
+    df = load_data(input_directory,
+                   columns=['usr_organization'],
+                   start_time=start_time,
+                   end_time=end_time)
     df = subset_by_date(df, start_time, end_time)
 
     # drop duplicates (except the first occurrence)
@@ -121,7 +152,10 @@ def us_universities(input_directory='.',
     print('--> calculating distinct US universities')
 
     # load the data based on working directory and subset it if necessary
-    df = load_data(input_directory)
+    df = load_data(input_directory,
+                   columns=['usr_organization'],
+                   start_time=start_time,
+                   end_time=end_time)
     df = subset_by_date(df, start_time, end_time)
 
     # drop duplicates (except the first occurrence)
@@ -161,7 +195,10 @@ def international_universities(input_directory='.',
     print('--> calculating distinct international universities')
 
     # load the data based on working directory and subset it if necessary
-    df = load_data(input_directory)
+    df = load_data(input_directory,
+                   columns=['usr_organization'],
+                   start_time=start_time,
+                   end_time=end_time)
     df = subset_by_date(df, start_time, end_time)
 
     # drop duplicates (except the first occurrence)
@@ -200,7 +237,10 @@ def cuahsi_members(input_directory='.',
     print('--> calculating CUAHSI members')
 
     # load the data based on working directory and subset it if necessary
-    df = load_data(input_directory)
+    df = load_data(input_directory,
+                   columns=['usr_organization'],
+                   start_time=start_time,
+                   end_time=end_time)
     df = subset_by_date(df, start_time, end_time)
 
     # drop duplicates (except the first occurrence)
@@ -105,6 +105,7 @@ def line(plotObjs_ax1,
 
     # save the figure and the data
     plt.savefig(filename)
+    plt.close(fig)
     print(f'--> figure saved to: {filename}')
 
 
@@ -167,6 +168,7 @@ def bar(plotObjs_ax1,
 
     # save the figure and the data
     plt.savefig(filename)
+    plt.close(fig)
     print(f'--> figure saved to: {filename}')
 
 
@@ -204,4 +206,5 @@ def pie(plotObjs_ax1,
 
     # save the figure and the data
     plt.savefig(filename)
+    plt.close(fig)
     print(f'--> figure saved to: {filename}')
@@ -13,18 +13,46 @@ import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 
 import plot
+import cache
+import store
 import utilities
 
 
-def load_data(workingdir):
+# fields of the collected datasets that are read by each series, see
+# collect_data.required_fields
+_count_fields = {'resources': ['res_date_created', 'res_size',
+                               'res_pub_status']}
+FIELDS = {'total': {'resources': ['res_date_created', 'res_size']},
+          'count_public': _count_fields,
+          'count_published': _count_fields,
+          'count_private': _count_fields,
+          'count_discoverable': _count_fields}
 
-    # load the activity data
-    path = os.path.join(workingdir, 'resources.pkl')
-    df = pandas.read_pickle(path)
 
-    # convert dates
-    df['date'] = pandas.to_datetime(df.res_date_created).dt.normalize()
-    df.res_date_created = pandas.to_datetime(df.res_date_created).dt.normalize()
+def load_data(workingdir, columns=None, start_time=None, end_time=None):
+    """
+    Loads resource data. The cleaned data are cached for the lifetime of
+    the process, and the columns and monthly partitions are selected
+    from a copy of them (see store.select).
+    """
+    key = ('resources', os.path.abspath(workingdir))
+    df = cache.get(key, lambda: _load_data(workingdir), copy=False)
+
+    # always include the creation date
+    if columns is not None:
+        columns = columns + ['res_date_created', 'date']
+    return store.select(df, 'resources', columns, start_time,
+                        end_time).copy()
+
+
+def _load_data(workingdir):
+
+    # load the resource data
+    df = utilities.load_dataset(workingdir, 'resources')
+
+    # dates are parsed when the data are stored
+    df['date'] = df.res_date_created.dt.normalize()
+    df.res_date_created = df.res_date_created.dt.normalize()
 
 #    # replace NaN to clean xls output
 #    df = df.fillna('')
@@ -67,7 +95,10 @@ def total(input_directory='.',
 
     # load the data based on working directory
     print('    .. loading dataset')
-    df = load_data(input_directory)
+    df = load_data(input_directory,
+                   columns=['res_size'],
+                   start_time=start_time,
+                   end_time=end_time)
     df = subset_by_date(df, start_time, end_time)
 
     print('    .. filling missing values')
@@ -111,7 +142,10 @@ def count(input_directory='.',
 
     # load the data based on working directory
     print('    .. loading dataset')
-    df = load_data(input_directory)
+    df = load_data(input_directory,
+                   columns=['res_size', 'res_pub_status'],
+                   start_time=start_time,
+                   end_time=end_time)
     df = subset_by_date(df, start_time, end_time)
 
     print('    .. filling missing values')
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+"""
+Daily rollup of the activity data: one row for each (date, user_id)
+with the number of records of each action on that day and their total
+(`events`). Active, new, and returning users only depend on the days on
+which each user was active, so the user metrics read the rollup instead
+of every activity record.
+
+The rollup is saved in the store as the daily_activity dataset, with the
+same monthly partitions as activity, e.g.
+
+    store/
+      daily_activity/
+        _state.json
+        month=2021-02.parquet
+
+It is built when activity is collected and updated incrementally: only
+the months whose activity partitions changed since the last update are
+rolled up again. The state file records the size and modification time
+of each activity partition that was rolled up.
+"""
+
+import os
+import pandas
+import pyarrow.parquet as pq
+from datetime import datetime
+
+import store
+import utilities
+
+
+DATASET = 'daily_activity'
+
+# columns identifying a row of the rollup
+KEYS = ['date', 'user_id']
+
+# total number of records of a user on a day
+EVENTS = 'events'
+
+# activity columns that are rolled up
+SOURCE_COLUMNS = ['session_timestamp', 'user_id', 'action']
+
+
+def daily(df):
+    """
+    Rolls up activity records into one row per (date, user_id) with a
+    column counting the records of each action. Records without a date
+    or user_id are not included.
+    """
+    date = df.session_timestamp.dt.normalize().rename('date')
+    keys = [date, df.user_id]
+
+    res = df.groupby(keys).size().to_frame(EVENTS)
+    if 'action' in df.columns:
+        actions = df.groupby(keys + [df.action], observed=True).size() \
+                    .unstack('action', fill_value=0)
+        actions.columns = pandas.Index([str(c) for c in actions.columns])
+        res = res.join(actions).fillna(0).astype('int64')
+
+    res = res.reset_index()
+    res.columns.name = None
+    return res
+
+
+def _signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def stale_months(store_dir):
+    """
+    Compares the activity partitions with the ones that were rolled up.
+
+    returns: (months that are new or changed, months that were removed)
+    """
+    sources = store.read_state(store_dir, DATASET).get('activity', {})
+    current = {store.partition_month(p): _signature(p)
+               for p in store.partitions(store_dir, 'activity')}
+    changed = sorted(m for m, sig in current.items()
+                     if sources.get(m) != sig)
+    removed = sorted(m for m in sources if m not in current)
+    return changed, removed
+
+
+def update(store_dir):
+    """
+    Rolls up the activity partitions that changed since the last update
+    and removes the rollup of partitions that no longer exist.
+
+    returns: list of months that were rolled up
+    """
+    changed, removed = stale_months(store_dir)
+    if len(changed) == 0 and len(removed) == 0:
+        return []
+
+    state = store.read_state(store_dir, DATASET)
+    sources = state.get('activity', {})
+    for month in removed + changed:
+        path = store.partition_path(store_dir, DATASET, month)
+        if os.path.exists(path):
+            os.remove(path)
+        sources.pop(month, None)
+
+    for month in changed:
+        src = store.partition_path(store_dir, 'activity', month)
+        names = pq.read_schema(src).names
+        df = pandas.read_parquet(src, columns=[c for c in SOURCE_COLUMNS
+                                               if c in names])
+        store.append(daily(store.apply_schema(df, 'activity')),
+                     store_dir, DATASET)
+        sources[month] = _signature(src)
+
+    state['activity'] = sources
+    state['last_update'] = datetime.utcnow().isoformat()
+    store.write_state(store_dir, DATASET, state)
+
+    if len(changed) > 0:
+        print(f'--> updated daily activity rollup: {", ".join(changed)}')
+    return changed
+
+
+def load(workingdir, columns=None, start_time=None, end_time=None):
+    """
+    Loads the daily rollup of the activity collected in `workingdir`. The
+    rollup in the store is brought up to date first. When activity is not
+    in the store, e.g. only activity.pkl was collected, the rollup is
+    computed from the activity records.
+
+    args:
+        workingdir (str): directory containing the collected data
+        columns (list): columns to load, all columns are loaded when None.
+                        Action columns are only present if that action
+                        occurs in the loaded months.
+        start_time (datetime): skip monthly partitions before this time
+        end_time (datetime): skip monthly partitions after this time
+    returns: DataFrame. Rows are not filtered by date, use subset_by_date.
+    """
+    store_dir = os.path.join(workingdir, 'store')
+    if store.exists(store_dir, 'activity'):
+        update(store_dir)
+        if not store.exists(store_dir, DATASET):
+            # none of the activity records has a date and user_id
+            df = pandas.DataFrame({'date': pandas.Series(
+                                       dtype='datetime64[ns, UTC]'),
+                                   'user_id': pandas.Series(dtype='Int64'),
+                                   EVENTS: pandas.Series(dtype='int64')})
+        else:
+            # action columns are missing from the partitions of months
+            # without that action, so they are selected after reading
+            read_columns = columns
+            if columns is not None and not set(columns) <= set(KEYS +
+                                                               [EVENTS]):
+                read_columns = None
+            df = store.read(store_dir, DATASET, columns=read_columns,
+                            start_time=start_time, end_time=end_time)
+    else:
+        df = daily(utilities.load_dataset(workingdir, 'activity',
+                                          columns=SOURCE_COLUMNS,
+                                          start_time=start_time,
+                                          end_time=end_time))
+
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+
+    # months without an action have no column for it
+    counts = [c for c in df.columns if c not in KEYS]
+    df[counts] = df[counts].fillna(0).astype('int64')
+    return df
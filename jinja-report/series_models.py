@@ -48,12 +48,18 @@ class Figure():
 
 
 class Base():
+    def time_range(self):
+        """
+        Returns the start and end time of the metric as UTC datetimes.
+        """
+        return (pytz.utc.localize(datetime.strptime(self.start_time, '%m-%d-%Y')),
+                pytz.utc.localize(datetime.strptime(self.end_time, '%m-%d-%Y')))
+
     def get_series(self):
         s = {}
 
         # set timezone to UTC
-        self.start_time = pytz.utc.localize(datetime.strptime(self.start_time, '%m-%d-%Y'))
-        self.end_time = pytz.utc.localize(datetime.strptime(self.end_time, '%m-%d-%Y'))
+        self.start_time, self.end_time = self.time_range()
 
         # get the class attributes that will be returned
         kwargs = self.__dict__
@@ -78,6 +84,25 @@ class user(Base):
     step: str = 1
     save_data: bool = False
     aggregation: str = '1D'
+    server_side: bool = False
+    approximate: bool = False
+    error_rate: float = 0.02
+
+    def windows(self):
+        """
+        Returns the (active_range, step, error_rate) windows of the series
+        that count active, new, or returning users, with the types of the
+        series of each window, see users.register_windows. error_rate is
+        None for exact counts.
+        """
+        windows = {}
+        for seri in self.series:
+            kwargs = {**self.__dict__, **seri}
+            if kwargs['type'] in ['active', 'new', 'returning']:
+                w = (kwargs['active_range'], kwargs['step'],
+                     kwargs['error_rate'] if kwargs['approximate'] else None)
+                windows.setdefault(w, set()).add(kwargs['type'])
+        return windows
 
 
 @dataclass
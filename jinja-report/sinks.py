@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+"""
+Writers that save downloaded data page by page, so that exporting an
+index does not need memory for the entire result set. The format of a
+sink is chosen by the extension of its path:
+
+    .csv       CSVSink
+    .csv.gz    CSVSink, gzip compressed
+    .parquet   ParquetSink
+
+Pages do not need to have the same columns. Columns that first appear
+in a later page are added to the output when the sink is closed, with
+empty values for the earlier rows.
+
+usage:
+    sink = sinks.open_sink('activity.parquet')
+    for page in pages:
+        sink.write(page)
+    sink.close()
+"""
+
+import os
+import gzip
+import pandas
+import pyarrow
+import pyarrow.parquet as pq
+
+import store
+
+
+EXTENSIONS = ['.csv', '.csv.gz', '.parquet']
+
+# rows read at a time when a sink output is read back, e.g. to merge
+# partitions
+CHUNKSIZE = 100000
+
+
+def extension(path):
+    for ext in sorted(EXTENSIONS, key=len, reverse=True):
+        if path.endswith(ext):
+            return ext
+    return os.path.splitext(path)[1]
+
+
+def open_sink(path):
+    """
+    Creates the sink for an output path based on its extension. Files
+    with other extensions are written as csv.
+    """
+    if extension(path) == '.parquet':
+        return ParquetSink(path)
+    return CSVSink(path)
+
+
+def part_paths(path, n):
+    """
+    Returns the paths of `n` temporary parts of an output, e.g. for
+    partitions that are downloaded concurrently. Parts have the same
+    format as the output.
+    """
+    ext = extension(path)
+    base = path[:len(path) - len(ext)]
+    return [f'{base}.part{i:05d}{ext}' for i in range(n)]
+
+
+class CSVSink(object):
+    """
+    Appends pages to a csv file. The index is numbered continuously across
+    pages, so the file matches writing the concatenated pages with
+    DataFrame.to_csv.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.columns = None
+        self.rows = 0
+        self._f = None
+        self._drifted = False
+
+    def _open(self, path, mode):
+        if self.path.endswith('.gz'):
+            return gzip.open(path, mode + 't', newline='')
+        return open(path, mode, newline='')
+
+    def write(self, df):
+        if len(df) == 0:
+            return
+
+        header = self.columns is None
+        if header:
+            self.columns = list(df.columns)
+            self._f = self._open(self.path, 'w')
+        else:
+            new = [c for c in df.columns if c not in self.columns]
+            if len(new) > 0:
+                # rows are written with the new columns at the end. the
+                # header is rewritten when the sink is closed.
+                self.columns.extend(new)
+                self._drifted = True
+
+        if list(df.columns) != self.columns:
+            df = df.reindex(columns=self.columns)
+        df.index = pandas.RangeIndex(self.rows, self.rows + len(df))
+        df.to_csv(self._f, header=header)
+        self.rows += len(df)
+
+    def close(self):
+        if self._f is None:
+            pandas.DataFrame().to_csv(self.path)
+            return self.rows
+        self._f.close()
+
+        if self._drifted:
+            # rewrite the file with the complete header, filling the
+            # columns that are missing from earlier rows
+            tmp = self.path + '.tmp'
+            with self._open(tmp, 'w') as out:
+                header = True
+                for chunk in read_pages(self.path, names=self.columns):
+                    chunk.to_csv(out, header=header)
+                    header = False
+            os.replace(tmp, self.path)
+        return self.rows
+
+
+def _arrow_types(df):
+    """
+    Converts object columns holding mixed types to strings, so the page
+    can be written to Parquet.
+    """
+    try:
+        return pyarrow.Table.from_pandas(df, preserve_index=False)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        return pyarrow.Table.from_pandas(store.stringify(df.copy()),
+                                         preserve_index=False)
+
+
+def _common_type(types):
+    types = [t for t in types if not pyarrow.types.is_null(t)]
+    if len(types) == 0:
+        return pyarrow.null()
+    if all(t == types[0] for t in types):
+        return types[0]
+    if all(pyarrow.types.is_integer(t) or pyarrow.types.is_floating(t)
+           for t in types):
+        return pyarrow.float64()
+    return pyarrow.string()
+
+
+def unify_schemas(schemas):
+    """
+    Combines the schemas of several Parquet files. Columns are ordered by
+    first appearance, numbers of different types become float64 and any
+    other conflicting types become strings.
+    """
+    types = {}
+    for schema in schemas:
+        for field in schema:
+            types.setdefault(field.name, []).append(field.type)
+    return pyarrow.schema([(name, _common_type(t))
+                           for name, t in types.items()])
+
+
+def conform(table, schema):
+    """
+    Casts a table to a schema, adding the columns it is missing as nulls.
+    Returns None if the table has other columns or cannot be cast.
+    """
+    if not set(table.column_names) <= set(schema.names):
+        return None
+    columns = []
+    for field in schema:
+        if field.name not in table.column_names:
+            columns.append(pyarrow.nulls(len(table), field.type))
+            continue
+        try:
+            columns.append(table.column(field.name).cast(field.type))
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowNotImplementedError,
+                pyarrow.ArrowTypeError):
+            return None
+    return pyarrow.Table.from_arrays(columns, schema=schema)
+
+
+class ParquetSink(object):
+    """
+    Appends pages to a Parquet file as row groups. The schema is taken
+    from the first page. A page that does not fit the schema, e.g. one
+    with new columns, starts a new part file and the parts are combined
+    with a unified schema when the sink is closed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self.parts = []
+        self._writer = None
+
+    def write(self, df):
+        if len(df) == 0:
+            return
+
+        table = _arrow_types(df)
+        if self._writer is not None:
+            conformed = conform(table, self._writer.schema)
+            if conformed is None:
+                self._writer.close()
+                self._writer = None
+            else:
+                table = conformed
+
+        if self._writer is None:
+            self.parts.append(f'{self.path}.{len(self.parts):05d}.part')
+            self._writer = pq.ParquetWriter(self.parts[-1], table.schema)
+
+        self._writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+        if len(self.parts) == 0:
+            pq.write_table(pyarrow.table({}), self.path)
+        elif len(self.parts) == 1:
+            os.replace(self.parts[0], self.path)
+        else:
+            schema = unify_schemas([pq.read_schema(p) for p in self.parts])
+            with pq.ParquetWriter(self.path, schema) as writer:
+                for part in self.parts:
+                    f = pq.ParquetFile(part)
+                    for i in range(f.num_row_groups):
+                        writer.write_table(conform(f.read_row_group(i),
+                                                   schema))
+                    os.remove(part)
+        self.parts = []
+        return self.rows
+
+
+def read_pages(path, names=None):
+    """
+    Reads a sink output in chunks. Csv values are read as text so that
+    they are written back unchanged.
+
+    args:
+        path (str): output file
+        names (list): csv column names, used instead of the header
+    """
+    if extension(path) == '.parquet':
+        f = pq.ParquetFile(path)
+        for i in range(f.num_row_groups):
+            yield f.read_row_group(i).to_pandas()
+        return
+
+    kwargs = dict(index_col=0, dtype=str, keep_default_na=False,
+                  chunksize=CHUNKSIZE)
+    if names is not None:
+        kwargs.update(header=None, skiprows=1, names=[''] + list(names))
+    try:
+        for chunk in pandas.read_csv(path, **kwargs):
+            chunk.index.name = None
+            yield chunk
+    except pandas.errors.EmptyDataError:
+        return
+
+
+def concat(paths, path):
+    """
+    Combines sink outputs into a single output of the same format, in the
+    order of `paths`, and removes them.
+
+    returns: number of rows written
+    """
+    sink = open_sink(path)
+    for p in paths:
+        for df in read_pages(p):
+            sink.write(df)
+    rows = sink.close()
+    for p in paths:
+        os.remove(p)
+    return rows
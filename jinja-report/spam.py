@@ -9,6 +9,7 @@ related to known spam users from the historical data
 import os
 import json
 import requests
+import numpy as np
 import pandas as pd
 
 
@@ -63,23 +64,85 @@ def gather_spam_user_ids(
 
     if cache:
         print('.... saving cache')
-#        # save spam resources
-#        df = pd.DataFrame(spam_data["resources"], columns=["resource_id"])
-#        df.to_csv(os.path.join(working_dir, "spam-resources.csv"))
+        # save spam resources
+        df = pd.DataFrame(spam_data["resources"], columns=["resource_id"])
+        df.to_csv(os.path.join(working_dir, "spam-resources.csv"))
 
         # save spam users
-        #df = pd.DataFrame(spam_data["users"], columns=["user_id"])
-        df = pd.DataFrame(spam_data, columns=["user_id"])
+        df = pd.DataFrame(spam_data["users"], columns=["user_id"])
         df.to_csv(os.path.join(working_dir, "spam-users.csv"))
 
     print('.... completed successfully')
     return spam_data
 
 
+class SpamFilter(object):
+    """
+    Holds the spam user and resource ids for a working directory as
+    sorted integer arrays (or a string index for non-numeric ids) so that
+    records can be matched with a single vectorized lookup. The number of
+    records removed from each dataset is saved in `dropped`.
+    """
+    def __init__(self, spam_data):
+        self.ids = {k: self._index(v) for k, v in spam_data.items()}
+        self.dropped = {}
+
+    @staticmethod
+    def _index(values):
+        ids = pd.Series(values, dtype=object)
+        numeric = pd.to_numeric(ids, errors='coerce')
+        if numeric.notnull().all() and (numeric % 1 == 0).all():
+            return np.unique(numeric.values.astype(np.int64))
+        return pd.Index(ids.astype(str).unique())
+
+    def keys(self):
+        return self.ids.keys()
+
+    def mask(self, values, spam_col='users'):
+        """
+        Returns a boolean array that is True where `values` is a spam id.
+        """
+        ids = self.ids[spam_col]
+        values = pd.Series(values)
+        if isinstance(ids, np.ndarray):
+            # compare as floats so that missing values of nullable
+            # integer ids become NaN
+            numeric = pd.to_numeric(values, errors='coerce')
+            return np.isin(numeric.astype('float64').values, ids)
+        return values.astype(str).isin(ids).values
+
+    def filter(self, df, input_col, spam_col='users', dataset=None):
+        """
+        Removes the records of `df` whose `input_col` is a spam id.
+        """
+        mask = self.mask(df[input_col], spam_col)
+        dropped = int(mask.sum())
+        name = dataset if dataset is not None else input_col
+        self.dropped[name] = self.dropped.get(name, 0) + dropped
+        print(f'.. removed {dropped} spam records from {name}')
+        return df[~mask]
+
+
+# spam filters that have been loaded in this process, by working directory
+_filters = {}
+
+
+def get_filter(working_dir: str) -> SpamFilter:
+    """
+    Returns the SpamFilter for a working directory. Spam ids are gathered
+    the first time a working directory is used and reused afterwards.
+    """
+    key = os.path.abspath(working_dir)
+    if key not in _filters:
+        _filters[key] = SpamFilter(gather_spam_user_ids(working_dir))
+    return _filters[key]
+
+
 def filter_dataframe(df: pd.DataFrame,
                      working_dir: str,
                      input_col: str = 'usr_id',
-                     spam_col: str = 'usr_id') -> list:
+                     spam_col: str = 'usr_id',
+                     dataset: str = None) -> list:
     """
     filters users, resources, and activities from the input dataframe based
     on spam user ids collected by `gather_spam_user_ids`.
@@ -90,6 +153,7 @@ def filter_dataframe(df: pd.DataFrame,
                            save cache files.
         input_col (str): name of the column to filter in the input dataframe.
         spam_col (str): name of the spam column to filter with.
+        dataset (str): name used to report the number of removed records.
     returns: DataFrame without records related to spam users
     """
 
@@ -100,18 +164,16 @@ def filter_dataframe(df: pd.DataFrame,
         raise Exception(msg)
 
     # load spam data
-    spam_data = gather_spam_user_ids(working_dir)
+    spam_filter = get_filter(working_dir)
 
     # check that spam_col exists in the spam data
-    if spam_col not in spam_data.keys():
+    if spam_col not in spam_filter.keys():
         msg = (f'Column ({spam_col}) does not exist in spam dataset.\n',
-               f'Available spam columns: {",".join(spam_data.keys())}')
+               f'Available spam columns: {",".join(spam_filter.keys())}')
         raise Exception(msg)
 
     # filter data based on the input and spam columns.
-    dat = df[~df[input_col].isin(spam_data[spam_col])]
-
-    return dat
+    return spam_filter.filter(df, input_col, spam_col, dataset)
 
 
 if __name__ == '__main__':
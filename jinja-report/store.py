@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+"""
+A simple on-disk store for collected HydroShare metrics. Each dataset
+(users, resources, activity, doi, and the daily_activity rollup of
+rollup.py) is saved as a directory of monthly Parquet partitions with
+compact column types (see SCHEMA), so that new data can be appended
+without rewriting the entire history and readers can load only the
+columns and months they need, e.g.
+
+    store/
+      activity/
+        _state.json
+        month=2021-02.parquet
+        month=2021-03.parquet
+"""
+
+import os
+import json
+import glob
+import pandas
+
+
+# column used to assign records to a monthly partition
+PARTITION_COLUMNS = {'users': 'usr_created_date',
+                     'resources': 'res_date_created',
+                     'activity': 'session_timestamp',
+                     'daily_activity': 'date',
+                     'doi': 'Date Published'}
+
+# columns that are saved as datetime64[ns, UTC]
+DATE_COLUMNS = {'users': ['usr_created_date',
+                          'usr_last_login_date',
+                          'report_date'],
+                'resources': ['res_date_created',
+                              'report_date'],
+                'activity': ['session_timestamp'],
+                'daily_activity': ['date'],
+                'doi': ['created_dt',
+                        'last_modified_dt',
+                        'Date Published']}
+
+# compact types of other columns, by dataset. strings with few distinct
+# values are saved as categories and ids as nullable integers. columns
+# that cannot be converted without losing values keep their type.
+SCHEMA = {'users': {'usr_id': 'Int64',
+                    'usr_type': 'category'},
+          'resources': {'usr_id': 'Int64',
+                        'usr_type': 'category',
+                        'res_type': 'category',
+                        'res_pub_status': 'category',
+                        'res_size': 'float64'},
+          'activity': {'user_id': 'Int64',
+                       'session_id': 'Int64',
+                       'action': 'category',
+                       'user_type': 'category',
+                       'user_email_domain': 'category',
+                       'http_method': 'category',
+                       'http_code': 'category'},
+          'daily_activity': {'user_id': 'Int64'}}
+
+# name of the partition holding records without a partition date
+UNKNOWN = 'unknown'
+
+
+def dataset_dir(store_dir, dataset):
+    return os.path.join(store_dir, dataset)
+
+
+def partition_path(store_dir, dataset, month):
+    return os.path.join(dataset_dir(store_dir, dataset),
+                        f'month={month}.parquet')
+
+
+def partition_month(path):
+    return os.path.basename(path)[len('month='):-len('.parquet')]
+
+
+def partitions(store_dir, dataset, start_time=None, end_time=None):
+    """
+    Returns the paths of the partitions of a dataset, sorted by month.
+    When start_time or end_time are given, only the partitions that can
+    contain records in that range are returned.
+    """
+    pattern = os.path.join(dataset_dir(store_dir, dataset), 'month=*.parquet')
+    paths = sorted(glob.glob(pattern))
+
+    if start_time is None and end_time is None:
+        return paths
+
+    st, et = _month_range(start_time, end_time)
+    return [p for p in paths
+            if partition_month(p) != UNKNOWN and
+            st <= partition_month(p) <= et]
+
+
+def _month_range(start_time, end_time):
+    st = start_time.strftime('%Y-%m') if start_time is not None else ''
+    et = end_time.strftime('%Y-%m') if end_time is not None else '9999-12'
+    return st, et
+
+
+def select(df, dataset, columns=None, start_time=None, end_time=None):
+    """
+    Selects the records and columns of a loaded dataset that `read` would
+    return for the same arguments, i.e. the records of the monthly
+    partitions that overlap the time range. Columns that are not in the
+    dataframe are ignored.
+    """
+    if start_time is not None or end_time is not None:
+        st, et = _month_range(start_time, end_time)
+        months = _months(df, dataset)
+        df = df[(months != UNKNOWN) & (months >= st) & (months <= et)]
+    if columns is not None:
+        df = df[[c for c in dict.fromkeys(columns) if c in df.columns]]
+    return df
+
+
+def exists(store_dir, dataset):
+    return len(partitions(store_dir, dataset)) > 0
+
+
+def read_state(store_dir, dataset):
+    """
+    Reads the sync state (e.g. the high-water mark) of a dataset.
+    """
+    path = os.path.join(dataset_dir(store_dir, dataset), '_state.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_state(store_dir, dataset, state):
+    path = os.path.join(dataset_dir(store_dir, dataset), '_state.json')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(state, f, indent=2)
+
+
+def prepare(df, dataset):
+    """
+    Converts a dataframe into the types that are saved in the store.
+    Date columns are parsed to UTC datetimes, object columns holding
+    mixed types are converted to strings so they can be written to
+    Parquet, and the SCHEMA types are applied.
+    """
+    df = df.reset_index(drop=True)
+    for col in DATE_COLUMNS.get(dataset, []):
+        if col in df.columns and \
+                not isinstance(df[col].dtype, pandas.DatetimeTZDtype):
+            df[col] = pandas.to_datetime(df[col], utc=True, errors='coerce')
+
+    return apply_schema(stringify(df), dataset)
+
+
+def _convert(s, dtype):
+    """
+    Converts a series to a SCHEMA type, or returns it unchanged if some
+    values cannot be represented, e.g. ids that are not integers.
+    """
+    if s.dtype == dtype:
+        return s
+    if dtype == 'category':
+        return s.astype('category')
+
+    numeric = pandas.to_numeric(s, errors='coerce')
+    if (numeric.isnull() != s.isnull()).any():
+        return s
+    if dtype == 'Int64':
+        if (numeric.dropna() % 1 != 0).any():
+            return s
+        return numeric.astype('Int64')
+    return numeric.astype(dtype)
+
+
+def apply_schema(df, dataset):
+    """
+    Converts the columns of a dataset to their SCHEMA types. Categories
+    are recreated when partitions with different categories are combined.
+    """
+    for col, dtype in SCHEMA.get(dataset, {}).items():
+        if col in df.columns:
+            df[col] = _convert(df[col], dtype)
+    return df
+
+
+def stringify(df):
+    """
+    Converts the values of object columns holding mixed types to strings,
+    leaving missing values unchanged.
+    """
+    for col in df.columns[df.dtypes == object]:
+        notnull = df[col].notnull()
+        if not df.loc[notnull, col].map(type).eq(str).all():
+            df.loc[notnull, col] = df.loc[notnull, col].astype(str)
+
+    return df
+
+
+def _months(df, dataset):
+    col = PARTITION_COLUMNS[dataset]
+    return df[col].dt.strftime('%Y-%m').fillna(UNKNOWN)
+
+
+def append(df, store_dir, dataset, key=None):
+    """
+    Appends records to the monthly partitions of a dataset. Only the
+    partitions that receive new records are rewritten.
+
+    args:
+        df (dataframe): records to append
+        store_dir (str): root directory of the store
+        dataset (str): name of the dataset, e.g. activity
+        key (str): column that uniquely identifies a record. When given,
+                   records that already exist in a partition are replaced.
+    returns: list of months that were written
+    """
+    if len(df) == 0:
+        return []
+
+    os.makedirs(dataset_dir(store_dir, dataset), exist_ok=True)
+
+    df = prepare(df, dataset)
+    written = []
+    for month, part in df.groupby(_months(df, dataset).values, sort=True):
+        path = partition_path(store_dir, dataset, month)
+        if os.path.exists(path):
+            part = pandas.concat([pandas.read_parquet(path), part],
+                                 sort=False)
+            if key is not None:
+                part = part.drop_duplicates(subset=key, keep='last')
+            part = apply_schema(part, dataset)
+        part.reset_index(drop=True).to_parquet(path, index=False)
+        written.append(month)
+
+    return written
+
+
+def overwrite(df, store_dir, dataset):
+    """
+    Replaces all partitions of a dataset, e.g. for the users and resources
+    snapshots that are downloaded in full.
+    """
+    for path in partitions(store_dir, dataset):
+        os.remove(path)
+    return append(df, store_dir, dataset)
+
+
+def read(store_dir, dataset, columns=None, start_time=None, end_time=None):
+    """
+    Reads a dataset from the store.
+
+    args:
+        store_dir (str): root directory of the store
+        dataset (str): name of the dataset, e.g. activity
+        columns (list): columns to read, all columns are read when None
+        start_time (datetime): skip partitions that end before this time
+        end_time (datetime): skip partitions that begin after this time
+    returns: dataframe containing the records of the selected partitions.
+             Rows are not filtered within a partition.
+    """
+    if not exists(store_dir, dataset):
+        raise Exception(f'No partitions found for {dataset} in {store_dir}')
+
+    paths = partitions(store_dir, dataset, start_time, end_time)
+
+    if len(paths) == 0:
+        # no partitions overlap the requested range, return an empty
+        # frame with the schema of the dataset
+        paths = partitions(store_dir, dataset)[:1]
+        return pandas.read_parquet(paths[0], columns=columns).iloc[0:0]
+
+    df = pandas.concat([pandas.read_parquet(p, columns=columns)
+                        for p in paths], sort=False)
+    return apply_schema(df.reset_index(drop=True), dataset)
@@ -11,46 +11,85 @@ import matplotlib.dates as mdates
 from matplotlib.pyplot import cm
 from pandas.plotting import register_matplotlib_converters
 
+import hll
 import spam
+import cache
+import store
+import rollup
+import aggregate
 import plot
 import utilities
 
 
 register_matplotlib_converters()
-def load_data(workingdir, pickle_file='users.pkl'):
 
-    # load the activity data
-    path = os.path.join(workingdir, pickle_file)
-    df = pandas.read_pickle(path)
 
-    types = {'users.pkl': {'from': 'usr_id',
-                           'to': 'users'},
-             'resources.pkl': {'from': 'resource_id',
-                               'to': 'resources'},
-             'activity.pkl': {'from': 'user_id',
-                              'to': 'users'}}
+# fields of the collected datasets that are read by each series. None
+# means that all fields are needed. see collect_data.required_fields
+FIELDS = {'total': {'users': ['usr_id', 'usr_created_date']},
+          'active': {'activity': ['user_id', 'session_timestamp']},
+          'new': {'users': ['usr_id', 'usr_created_date']},
+          'returning': {'users': ['usr_id', 'usr_created_date'],
+                        'activity': ['user_id', 'session_timestamp']},
+          'usertype': {'users': None},
+          'usertypes_cumulative': {'users': None}}
+
+
+# column used to filter spam from each file, and the type of its ids
+SPAM_FILTERS = {'users.pkl': {'from': 'usr_id',
+                              'to': 'users'},
+                'resources.pkl': {'from': 'resource_id',
+                                  'to': 'resources'},
+                'activity.pkl': {'from': 'user_id',
+                                 'to': 'users'}}
+
+
+def load_data(workingdir, pickle_file='users.pkl', columns=None,
+              start_time=None, end_time=None):
+    """
+    Loads users, resources, or activity data and removes records related
+    to spam users. `columns`, `start_time`, and `end_time` select the
+    columns and monthly partitions of the data store that are returned.
+    The cleaned data are cached for the lifetime of the process, and the
+    selection is made on a copy of them.
+    """
+    key = ('users', os.path.abspath(workingdir), pickle_file)
+    df = cache.get(key, lambda: _load_data(workingdir, pickle_file),
+                   copy=False)
+    typ = os.path.basename(pickle_file)
+    if columns is not None:
+        columns = columns + [SPAM_FILTERS[typ]['from'], 'date']
+    return store.select(df, os.path.splitext(typ)[0], columns,
+                        start_time, end_time).copy()
+
+
+def _load_data(workingdir, pickle_file='users.pkl'):
 
-    # filter spam users
     typ = os.path.basename(pickle_file)
+
+    # load the data
+    df = utilities.load_dataset(workingdir, os.path.splitext(typ)[0])
+
+    # filter spam users
     df = spam.filter_dataframe(df,
                                workingdir,
-                               types[typ]['from'],
-                               types[typ]['to'])
+                               SPAM_FILTERS[typ]['from'],
+                               SPAM_FILTERS[typ]['to'],
+                               dataset=typ)
 
     columns = df.columns
 
     # parse users
     if 'usr_created_date' in columns:
 
-        # convert dates
-        df['date'] = pandas.to_datetime(df.usr_created_date).dt.normalize()
+        # dates are parsed when the data are stored, see store.SCHEMA
+        df['date'] = df.usr_created_date.dt.normalize()
 
-        df.usr_created_date = pandas.to_datetime(df.usr_created_date) \
-                                    .dt.normalize()
-        df.usr_last_login_date = pandas.to_datetime(df.usr_last_login_date) \
-                                       .dt.normalize()
-        df.report_date = pandas.to_datetime(df.report_date) \
-                               .dt.normalize()
+        df.usr_created_date = df.usr_created_date.dt.normalize()
+        if 'usr_last_login_date' in columns:
+            df.usr_last_login_date = df.usr_last_login_date.dt.normalize()
+        if 'report_date' in columns:
+            df.report_date = df.report_date.dt.normalize()
 
 
 #        # fill NA values.  This happens when a user never logs in
@@ -68,9 +107,8 @@ def load_data(workingdir, pickle_file='users.pkl'):
     # parse activity
     elif 'session_timestamp' in columns:
 
-        # convert dates
-        df['date'] = pandas.to_datetime(df.session_timestamp) \
-                           .dt.normalize()
+        # dates are parsed when the data are stored
+        df['date'] = df.session_timestamp.dt.normalize()
 
         # add another date column and make it the index
         df['Date'] = df['date']
@@ -81,6 +119,177 @@ def load_data(workingdir, pickle_file='users.pkl'):
     return df
 
 
+def load_rollup(workingdir, columns=None, start_time=None, end_time=None):
+    """
+    Loads the daily activity rollup, i.e. one row per (date, user_id),
+    and removes the rows of spam users. See rollup.load for the
+    arguments. The entire rollup is cached for the lifetime of the
+    process, and the selection is made on a copy of it.
+    """
+    key = ('rollup', os.path.abspath(workingdir))
+    df = cache.get(key, lambda: _load_rollup(workingdir), copy=False)
+    if columns is not None:
+        columns = columns + rollup.KEYS
+    return store.select(df, rollup.DATASET, columns, start_time,
+                        end_time).copy()
+
+
+def _load_rollup(workingdir):
+
+    df = rollup.load(workingdir)
+    df = spam.filter_dataframe(df,
+                               workingdir,
+                               'user_id',
+                               'users',
+                               dataset='daily_activity')
+    return df.set_index(df.date.rename('Date'))
+
+
+# series of the (active_range, step, error_rate) windows that are computed
+# together, by input directory and time range. see register_windows
+_windows = {}
+
+# series counted by user_counts
+SERIES = ['active', 'new', 'returning']
+
+
+def register_windows(input_directory, start_time, end_time, windows):
+    """
+    Declares the (active_range, step, error_rate) windows that the figures
+    of a report will request for a time range, and the series requested
+    for each of them, so that the first request computes all of them in
+    one pass, see window_counts.
+
+    args:
+        windows (dict): {(active_range, step, error_rate): set of series}
+    """
+    key = (os.path.abspath(input_directory), start_time, end_time)
+    registered = _windows.setdefault(key, {})
+    for w, series in windows.items():
+        registered.setdefault(w, set()).update(series)
+
+
+def user_counts(input_directory, windows, start_time, end_time,
+                series=SERIES):
+    """
+    Computes the active, new, and returning users of several windows in
+    one pass. Users and the daily activity rollup are loaded once, and
+    their records are sorted and deduplicated once for all windows.
+    Users are only loaded when new or returning users are requested.
+    Windows with an error_rate count active users approximately from
+    HyperLogLog sketches of each day (see hll.py), which are built once
+    for each error rate. New users are always counted exactly.
+
+    args:
+        input_directory (str): directory containing the collected data
+        windows (list): (active_range, step, error_rate) tuples. The range
+                        and step are given in days, error_rate is None for
+                        exact counts.
+        start_time (datetime): first date of the records that are counted
+        end_time (datetime): windows end before this date
+        series (list): series to compute, a subset of SERIES
+    returns: dict of {(active_range, step, error_rate): {series: Series}}
+             with the requested series of each window. Each series is
+             indexed by window end date.
+    """
+    windows = list(set(windows))
+    with_users = 'new' in series or 'returning' in series
+
+    dfa = load_rollup(input_directory,
+                      columns=['date', 'user_id'],
+                      start_time=start_time,
+                      end_time=end_time)
+    dfa = utilities.subset_by_date(dfa, start_time, end_time)
+    if with_users:
+        df = load_data(input_directory, 'users.pkl',
+                       columns=['usr_id', 'usr_created_date'],
+                       start_time=start_time,
+                       end_time=end_time)
+        df = utilities.subset_by_date(df, start_time, end_time)
+
+    # active and returning users are counted from the earliest activity
+    # date plus the active range, new users from the first account
+    x_active, x_new = {}, {}
+    for w in windows:
+        active_range, step = w[:2]
+        x_active[w] = utilities.window_endpoints(
+                dfa.date.min() + timedelta(days=active_range),
+                end_time, step)
+        if with_users:
+            x_new[w] = utilities.window_endpoints(
+                    df.usr_created_date.min(), end_time, step)
+
+    active = {}
+    for error_rate in set(w[2] for w in windows):
+        group = [w for w in windows if w[2] == error_rate]
+        requests = [(x_active[w], timedelta(days=w[0])) for w in group]
+        if error_rate is None:
+            res = utilities.windowed_distinct_counts(dfa.date, dfa.user_id,
+                                                     requests)
+        else:
+            res = hll.windowed_distinct_counts(dfa.date, dfa.user_id,
+                                               requests, error_rate)
+        active.update(zip(group, res))
+
+    if with_users:
+        new = utilities.windowed_distinct_counts(
+                df.usr_created_date, df.usr_id,
+                [(x, timedelta(days=w[0])) for w in windows
+                 for x in (x_new[w], x_active[w])])
+
+    counts = {}
+    for i, w in enumerate(windows):
+        counts[w] = {'active': pandas.Series(active[w], index=x_active[w],
+                                             dtype='int64')}
+        if with_users:
+            # Users who were active, but obtained an account prior to the
+            # active period are users who continue to return to and work
+            # with HydroShare.
+            counts[w]['new'] = pandas.Series(new[2 * i], index=x_new[w],
+                                             dtype='int64')
+            counts[w]['returning'] = pandas.Series(
+                    active[w] - new[2 * i + 1], index=x_active[w],
+                    dtype='int64')
+        counts[w] = {k: v for k, v in counts[w].items() if k in series}
+    return counts
+
+
+def window(active_range, step, approximate=False,
+           error_rate=hll.ERROR_RATE):
+    """
+    Returns the key of a window in user_counts.
+    """
+    return (active_range, step, error_rate if approximate else None)
+
+
+def window_counts(input_directory, start_time, end_time, series,
+                  active_range, step, approximate=False,
+                  error_rate=hll.ERROR_RATE):
+    """
+    Returns one series ('active', 'new', or 'returning') of one window
+    (see user_counts). On the first request for a time range, the windows
+    and series registered for it that have not been computed yet are
+    computed in the same pass and cached.
+    """
+    prefix = ('user_counts', os.path.abspath(input_directory),
+              start_time, end_time)
+    key = window(active_range, step, approximate, error_rate)
+
+    def compute():
+        # registered windows are removed once they are computed
+        pending = _windows.pop(prefix[1:], {})
+        pending.setdefault(key, set()).add(series)
+        names = set().union(*pending.values())
+        counts = user_counts(input_directory, pending, start_time,
+                             end_time, [s for s in SERIES if s in names])
+        for w, c in counts.items():
+            for name, ds in c.items():
+                cache.put(prefix + w + (name,), ds)
+        return counts[key][series]
+
+    return cache.get(prefix + key + (series,), compute)
+
+
 #def subset_by_date(dat, st, et):
 #
 #    if type(dat) == pandas.DataFrame:
@@ -109,7 +318,8 @@ def total(input_directory='.',
     print('--> calculating total users')
 
     # load the data based on working directory
-    df = load_data(input_directory)
+    df = load_data(input_directory,
+                   columns=['usr_id', 'usr_created_date'])
 
     # group and cumsum
     df = df.sort_index()
@@ -135,42 +345,42 @@ def active(input_directory='',
            label='Active Users',
            color='b',
            linestyle='-',
+           server_side=False,
+           es=None,
+           approximate=False,
+           error_rate=hll.ERROR_RATE,
            **kwargs):
     """
     Calculates the number of active users for any given time frame.
     An active user is a user that has performed a HydroShare action 
-    (as defined in activity.pkl) within the specified active range.
+    (as defined in activity.pkl) within the specified active range. The
+    active days of each user are read from the daily activity rollup.
+    When server_side is True, the values are computed by Elasticsearch
+    aggregations (see aggregate.py) and the local data is only used if
+    the aggregation fails. When approximate is True, the users are
+    counted with HyperLogLog sketches whose relative standard error is
+    error_rate (see hll.py).
     """
 
     print('--> calculating active users')
 
-    # load the data based on working directory
-    df = load_data(input_directory, 'activity.pkl')
-    df = utilities.subset_by_date(df, start_time, end_time)
-    df = df.sort_index()
-
-    dfu = load_data(input_directory, 'users.pkl')
-    dfu = utilities.subset_by_date(dfu, start_time, end_time)
-
-    x, y = [], []
-
-    # set the start date as the earliest available date plus the
-    # active date range
-    t = df.date.min() + timedelta(days=active_range)
-    while t < end_time:
-
-        min_active_date = t - timedelta(days=active_range)
-
-        # isolate users that performed an action
-        subdf = df[(df.date <= t) &
-                   (df.date > min_active_date)]
-        total_active_users = subdf.user_id.nunique()
-
-        # save the results
-        x.append(t)
-        y.append(total_active_users)
-
-        t += timedelta(days=step)
+    if server_side:
+        try:
+            x, y = aggregate.active_users(input_directory, start_time,
+                                          end_time, active_range, step,
+                                          es=es)
+            return plot.PlotObject(x, y, label=label,
+                                   color=color, linestyle=linestyle)
+        except Exception as e:
+            print(f'--> aggregation failed, using local data: {e}')
+
+    # count the users that performed an action within the active range
+    # of every date, starting from the earliest available date plus the
+    # active range
+    ds = window_counts(input_directory, start_time, end_time, 'active',
+                       active_range, step, approximate, error_rate)
+    x = ds.index.tolist()
+    y = ds.tolist()
 
     # create plot object
     plot_obj = plot.PlotObject(x, y, label=label,
@@ -187,29 +397,19 @@ def new(input_directory='.',
         label='New Users',
         color='g',
         linestyle='-',
+        approximate=False,
+        error_rate=hll.ERROR_RATE,
         **kwargs):
 
-    # load the data based on working directory
-    df = load_data(input_directory)
-    df = utilities.subset_by_date(df, start_time, end_time)
-
     print('--> calculating new users')
-    x = []
-    y = []
-
-    t = df['usr_created_date'].min()
-    while t < end_time:
-
-        earliest_date = t - timedelta(days=active_range)
 
-        subdfn = df[(df.usr_created_date <= t) &
-                    (df.usr_created_date > earliest_date)]
-        new = subdfn.usr_id.nunique()
-
-        y.append(new)
-        x.append(t)
-
-        t += timedelta(days=step)
+    # count the users that created an account within the active range
+    # of every date. new users are counted exactly, approximate only
+    # selects the window that is computed with the other series.
+    ds = window_counts(input_directory, start_time, end_time, 'new',
+                       active_range, step, approximate, error_rate)
+    x = ds.index.tolist()
+    y = ds.tolist()
 
     # create plot object
     return plot.PlotObject(x,
@@ -227,45 +427,24 @@ def returning(input_directory='.',
               color='r',
               label='Returning Users',
               linestyle='-',
+              approximate=False,
+              error_rate=hll.ERROR_RATE,
               **kwargs):
-
-    # load the data based on working directory
-    df = load_data(input_directory, 'users.pkl')
-    df = utilities.subset_by_date(df, start_time, end_time)
-    dfa = load_data(input_directory, 'activity.pkl')
-    dfa = utilities.subset_by_date(dfa, start_time, end_time)
+    """
+    Calculates the number of returning users, i.e. active users that
+    created their account before the active range. When approximate is
+    True, the active users are counted with HyperLogLog sketches whose
+    relative standard error is error_rate (see hll.py).
+    """
 
     print('--> calculating returning users')
-    x = []
-    y = []
-
-    # set the start date as the earliest available date plus the
-    # active date range
-    t = dfa.date.min() + timedelta(days=active_range)
-#    n = []
-#    a = []
-    while t < end_time:
-        earliest_date = t - timedelta(days=active_range)
 
-        ## subset all users to those that exist up to the current time, t
-        #subdf = df[df.usr_created_date <= t]
-
-        subdfn = df[(df.usr_created_date <= t) &
-                    (df.usr_created_date > earliest_date)]
-        new = subdfn.usr_id.nunique()
-
-        # calculate active users for this range
-        subdfa = dfa[(dfa.date <= t) &
-                     (dfa.date > earliest_date)]
-        active = subdfa.user_id.nunique()
-
-        # Users who were active, but obtained an account prior to the
-        # active period are users who continue to return to and work
-        # with HydroShare.
-        y.append(active - new)
-        x.append(t)
-
-        t += timedelta(days=step)
+    # users that were active within the active range of every date, less
+    # the users that created an account within it
+    ds = window_counts(input_directory, start_time, end_time, 'returning',
+                       active_range, step, approximate, error_rate)
+    x = ds.index.tolist()
+    y = ds.tolist()
 
     # create plot object
     return plot.PlotObject(x,
@@ -275,66 +454,115 @@ def returning(input_directory='.',
                            linestyle=linestyle)
 
 
-def usertype(input_directory='.',
-             start_time=datetime(2000, 1, 1),
-             end_time=datetime(2030, 1, 1),
-             aggregation='1D',
-             linestyle='-',
-             usertypes=[],
-             **kwargs):
+# HydroShare user types. other types are displayed as Other
+USER_TYPES = ['Unspecified',
+              'Post-Doctoral Fellow',
+              'Commercial/Professional',
+              'University Faculty',
+              'Government Official',
+              'University Graduate Student',
+              'Professional',
+              'University Professional or Research Staff',
+              'Local Government',
+              'University Undergraduate Student',
+              'School Student Kindergarten to 12th Grade',
+              'School Teacher Kindergarten to 12th Grade',
+              'Other']
+
+
+def usertype_counts(input_directory, start_time, end_time, aggregation,
+                    usertypes=[]):
+    """
+    Counts the accounts created in each `aggregation` interval for every
+    user type with one grouped aggregation (date x usr_type).
 
+    returns: (DataFrame of counts indexed by interval with one column for
+             each user type, list of user types). The user types are the
+             ones given, or all types in order of appearance.
+    """
     # load the data based on working directory
     df = load_data(input_directory, 'users.pkl')
     df = utilities.subset_by_date(df, start_time, end_time)
 
-    # define HS user types
-    ut_vocab = ['Unspecified',
-                'Post-Doctoral Fellow',
-                'Commercial/Professional',
-                'University Faculty',
-                'Government Official',
-                'University Graduate Student',
-                'Professional',
-                'University Professional or Research Staff',
-                'Local Government',
-                'University Undergraduate Student',
-                'School Student Kindergarten to 12th Grade',
-                'School Teacher Kindergarten to 12th Grade',
-                'Other']
-
     # clean the data
-    df.loc[~df.usr_type.isin(ut_vocab), 'usr_type'] = 'Other'
-
-    # loop through each of the user types
-    plots = []
+    utypes = df.usr_type.astype(object)
+    utypes = utypes.where(utypes.isin(USER_TYPES), 'Other')
 
     # plot only the provided user types
     if len(usertypes) == 0:
         # select all unique user types
-        usertypes = df.usr_type.unique()
+        usertypes = list(pandas.unique(utypes))
 
-    colors = iter(cm.jet(numpy.linspace(0, 1, len(usertypes))))
-    for utype in usertypes:
+    # remove records with null values
+    complete = df.notnull().all(axis=1)
+    utypes = utypes[complete].rename('usr_type')
 
-        # group by user type
-        du = df.loc[df.usr_type == utype]
+    # group by date frequency and user type
+    counts = utypes.groupby([pandas.Grouper(freq=aggregation), utypes]) \
+                   .size().unstack(fill_value=0)
+    counts = counts.reindex(columns=usertypes, fill_value=0)
+    counts.columns = pandas.Index(list(counts.columns))
+    return counts, usertypes
 
-        # remove null values
-        du = du.dropna()
 
-        # group by date frequency
-        ds = du.groupby(pandas.Grouper(freq=aggregation)).count().usr_type.cumsum()
-        x = ds.index
-        y = ds.values
+def usertype(input_directory='.',
+             start_time=datetime(2000, 1, 1),
+             end_time=datetime(2030, 1, 1),
+             aggregation='1D',
+             linestyle='-',
+             usertypes=[],
+             **kwargs):
+    """
+    Calculates the cumulative number of accounts of each user type. Each
+    series spans the intervals from the first to the last account of its
+    type.
+    """
+    counts, usertypes = usertype_counts(input_directory, start_time,
+                                        end_time, aggregation, usertypes)
+
+    # select the intervals between the first and last account of each type
+    cumulative = counts.cumsum()
+    remaining = counts[::-1].cumsum()[::-1]
+    spans = (cumulative > 0) & (remaining > 0)
+
+    plots = []
+    colors = iter(cm.jet(numpy.linspace(0, 1, len(usertypes))))
+    for utype in usertypes:
+        ds = cumulative.loc[spans[utype].values, utype]
         c = next(colors)
 
         # create plot object
-        plots.append(plot.PlotObject(x, y, label=utype, color=c, linestyle='-'))
+        plots.append(plot.PlotObject(ds.index, ds.values, label=utype,
+                                     color=c, linestyle='-'))
 
     return plots
 
-def usertypes_cumulative():
-    pass
+
+def usertypes_cumulative(input_directory='.',
+                         start_time=datetime(2000, 1, 1),
+                         end_time=datetime(2030, 1, 1),
+                         aggregation='1D',
+                         linestyle='-',
+                         usertypes=[],
+                         **kwargs):
+    """
+    Calculates the cumulative number of accounts of each user type stacked
+    on the types before it, i.e. each series is the total of its type and
+    all preceding types, so the last series is the total of all types.
+    All series share the same intervals.
+    """
+    counts, usertypes = usertype_counts(input_directory, start_time,
+                                        end_time, aggregation, usertypes)
+    stacked = counts.cumsum().cumsum(axis=1)
+
+    plots = []
+    colors = iter(cm.jet(numpy.linspace(0, 1, len(usertypes))))
+    for utype in usertypes:
+        plots.append(plot.PlotObject(stacked.index, stacked[utype].values,
+                                     label=utype, color=next(colors),
+                                     linestyle=linestyle))
+
+    return plots
 
 
 #
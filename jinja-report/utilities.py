@@ -6,7 +6,13 @@
 Utility functions
 """
 
+import os
+import numpy
 import pandas
+from datetime import timedelta
+
+import cache
+import store
 
 
 def save_data_to_csv(data_dict, index='date'):
@@ -45,3 +51,130 @@ def subset_by_date(dat, st, et, date_column='date'):
         mask = (dat.index >= st) & (dat.index <= et)
         return dat.loc[mask]
 
+
+def load_dataset(workingdir, dataset, columns=None,
+                 start_time=None, end_time=None):
+    """
+    Loads a collected dataset (users, resources, activity, doi) from the
+    partitioned store in `workingdir`/store. If the store does not exist,
+    the dataset is loaded from `workingdir`/<dataset>.pkl instead.
+
+    args:
+        workingdir (str): directory containing the collected data
+        dataset (str): name of the dataset
+        columns (list): columns to load, all columns are loaded when None
+        start_time (datetime): skip monthly partitions before this time
+        end_time (datetime): skip monthly partitions after this time
+    returns: DataFrame. Rows are not filtered by date, use subset_by_date.
+
+    The entire dataset is read once per process and cached, and the
+    columns and months are selected from it (see store.select).
+    """
+    key = ('dataset', os.path.abspath(workingdir), dataset)
+    df = cache.get(key, lambda: _load_dataset(workingdir, dataset),
+                   copy=False)
+    return store.select(df, dataset, columns, start_time,
+                        end_time).copy()
+
+
+def _load_dataset(workingdir, dataset):
+    store_dir = os.path.join(workingdir, 'store')
+    if store.exists(store_dir, dataset):
+        return store.read(store_dir, dataset)
+    df = pandas.read_pickle(os.path.join(workingdir, f'{dataset}.pkl'))
+    return store.prepare(df, dataset)
+
+
+def _to_ns(dates):
+    """
+    Converts dates to UTC nanoseconds since epoch as an int64 array.
+    """
+    idx = pandas.DatetimeIndex(dates)
+    if idx.tz is not None:
+        idx = idx.tz_convert('UTC').tz_localize(None)
+    return idx.asi8
+
+
+def window_endpoints(start, end, step):
+    """
+    Returns the dates start, start + step, start + 2*step, ... that are
+    less than end. `step` is given in days.
+    """
+    if pandas.isnull(start):
+        return []
+
+    x = []
+    t = start
+    while t < end:
+        x.append(t)
+        t += timedelta(days=step)
+    return x
+
+
+def windowed_distinct_count(dates, ids, endpoints, window):
+    """
+    Counts the number of distinct ids that occur within the window
+    (t - window, t] for every endpoint t, i.e. the value of
+
+        ids[(dates <= t) & (dates > t - window)].nunique()
+
+    for all endpoints at once, see windowed_distinct_counts.
+
+    args:
+        dates (Series): date of each record
+        ids (Series): id of each record, e.g. user_id
+        endpoints (list): window end dates
+        window (timedelta): length of the window
+    returns: numpy array of counts, one for each endpoint
+    """
+    return windowed_distinct_counts(dates, ids, [(endpoints, window)])[0]
+
+
+def windowed_distinct_counts(dates, ids, windows):
+    """
+    Computes windowed_distinct_count for several windows in one pass.
+    The records are sorted by id and date, and repeated (id, date) pairs
+    are removed, once for all windows. Each id's dates are then turned
+    into non-overlapping intervals [date, date + window), so the count
+    for an endpoint is the number of intervals that started minus the
+    number that ended on or before it, which is found using searchsorted.
+
+    args:
+        dates (Series): date of each record
+        ids (Series): id of each record, e.g. user_id
+        windows (list): (endpoints, window) tuples, where endpoints is a
+                        list of window end dates and window a timedelta
+    returns: list of numpy arrays of counts, one for each window
+    """
+    # drop missing values, NaN ids are not counted by nunique
+    codes, _ = pandas.factorize(pandas.Series(ids).values)
+    t = _to_ns(dates)
+    valid = (codes >= 0) & (t != pandas.NaT.value)
+    codes, t = codes[valid], t[valid]
+
+    # sort by id and date, and remove repeated (id, date) pairs
+    order = numpy.lexsort((t, codes))
+    codes, t = codes[order], t[order]
+    keep = numpy.ones(len(t), dtype=bool)
+    keep[1:] = (codes[1:] != codes[:-1]) | (t[1:] != t[:-1])
+    codes, t = codes[keep], t[keep]
+
+    # the next date of the same id, which ends the interval of a date
+    # when it is closer than the window
+    same = codes[1:] == codes[:-1]
+    following = numpy.full(len(t), numpy.iinfo(numpy.int64).max)
+    following[:-1] = numpy.where(same, t[1:], following[:-1])
+    starts = numpy.sort(t)
+
+    counts = []
+    for endpoints, window in windows:
+        if len(endpoints) == 0:
+            counts.append(numpy.zeros(0, dtype=int))
+            continue
+
+        e = _to_ns(endpoints)
+        ends = numpy.sort(numpy.minimum(t + pandas.Timedelta(window).value,
+                                        following))
+        counts.append(numpy.searchsorted(starts, e, side='right') -
+                      numpy.searchsorted(ends, e, side='right'))
+    return counts
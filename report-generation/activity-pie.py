@@ -2,6 +2,7 @@
 
 import os
 import pytz
+import cache
 import pandas
 import argparse
 import numpy as np
@@ -13,7 +14,7 @@ def load_data(workingdir, pickle_file='activity.pkl'):
 
     # load the activity data
     path = os.path.join(workingdir, pickle_file)
-    df = pandas.read_pickle(path)
+    df = cache.read_pickle(path)
 
     # convert dates
     df['date'] = pandas.to_datetime(df.session_timestamp) \
@@ -2,14 +2,25 @@
 
 
 import sys
+import json
+import glob
+import runpy
 import shutil
-from os import remove, makedirs
-from os.path import abspath, join, exists
-from subprocess import Popen, PIPE
+import hashlib
+import warnings
+import traceback
+import matplotlib
+from os import remove, makedirs, stat, getcwd, chdir
+from os.path import abspath, basename, dirname, join, exists, isfile, \
+    relpath
 from datetime import datetime
 from pylatex import Document, Figure, Command
 from pylatex.utils import NoEscape
 
+# figures are only saved to file, render them without a display
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
 
 # OUTPUT FIGURE NAMES
 users_all_30 = 'hs-users-all-30.png'
@@ -169,7 +180,7 @@ def generate_figures(wrkdir, figdir):
         sys.exit(1)
 
 
-def output_exists(cmd):
+def output_path(cmd):
     fname = None
     wrk = ''
     for c in cmd:
@@ -179,26 +190,137 @@ def output_exists(cmd):
             wrk = c.split('=')[-1]
 
     if fname is not None:
-        if exists(join(wrk, fname)):
-            return True
-    return False
+        return join(wrk, fname), wrk
+    return None, wrk
 
 
-def run(command):
-    if output_exists(command):
-        print('.. skipping bc output already exists')
-        return
+# digests of files that have been hashed in this process, by path, size,
+# and modification time
+_digests = {}
 
-    cmd = [sys.executable] + command
 
-    p = Popen(cmd, stderr=PIPE)
-    while True:
-        out = p.stderr.read(1).decode('utf-8')
-        if out == '' and p.poll() is not None:
-            break
-        if out != '':
-            sys.stdout.write(out)
-            sys.stdout.flush()
+def file_digest(path):
+    """
+    Returns the sha256 digest of a file's content. A file is only read
+    again when its size or modification time changes.
+    """
+    st = stat(path)
+    key = (abspath(path), st.st_size, st.st_mtime_ns)
+    if key not in _digests:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+
+def cache_key(cmd, wrk):
+    """
+    Computes a hash of the command arguments, the content of the input
+    data in the working directory and in dat/, and the source of the
+    scripts that create the figures. The outputs of a command can be
+    reused when none of these have changed.
+    """
+    code_dir = dirname(abspath(__file__))
+    data = sorted(glob.glob(join(code_dir, 'dat', '*.csv')))
+    content = {'command': cmd,
+               'inputs': [[basename(p), file_digest(p)]
+                          for p in sorted(glob.glob(join(wrk, '*.pkl')))],
+               'data': [[basename(p), file_digest(p)] for p in data],
+               'code': [[basename(p), file_digest(p)]
+                        for p in sorted(glob.glob(join(code_dir, '*.py')))]}
+    encoded = json.dumps(content, sort_keys=True)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def run_script(command):
+    """
+    Runs a figure script in this process, as if it was called from the
+    command line with the given arguments. Modules such as pandas and
+    matplotlib are imported once and the pickled datasets are shared
+    between scripts through cache.read_pickle. Errors are printed and do
+    not stop the remaining figures from being created.
+
+    Each script runs in a fresh __main__ namespace, and the state that a
+    script can change is reset when it exits: sys.argv, the working
+    directory, matplotlib rcParams and figures, warning filters, and the
+    local modules that it imported (other than cache), so that a script
+    behaves as it does when it is run on its own.
+    """
+    here = dirname(abspath(__file__))
+    script = join(here, command[0])
+    argv, cwd = sys.argv, getcwd()
+    modules = set(sys.modules)
+    sys.argv = [script] + command[1:]
+    try:
+        with matplotlib.rc_context(), warnings.catch_warnings():
+            runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            print(f'.. {command[0]} exited with status {e.code}')
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+    finally:
+        sys.argv = argv
+        chdir(cwd)
+        plt.close('all')
+        for name in set(sys.modules) - modules:
+            path = getattr(sys.modules[name], '__file__', None)
+            if path and dirname(abspath(path)) == here and name != 'cache':
+                del sys.modules[name]
+        sys.stdout.flush()
+
+
+def snapshot(dirs):
+    """
+    Returns the modification time of the files in each directory, by
+    path. Input pickles are not outputs and are not listed.
+    """
+    files = {}
+    for d in dirs:
+        for p in glob.glob(join(d, '*')):
+            if isfile(p) and not p.endswith('.pkl'):
+                files[abspath(p)] = stat(p).st_mtime_ns
+    return files
+
+
+def run(command):
+    outpath, wrk = output_path(command)
+    cached, before = None, None
+    if outpath is not None:
+        cached = join(wrk, '.build-cache', cache_key(command, wrk))
+        manifest = join(cached, 'outputs.json')
+
+        # restore every file that the command created, e.g. the figure
+        # and the csv files written by users.py
+        if exists(manifest):
+            print('.. reusing outputs from the build cache')
+            with open(manifest, 'r') as f:
+                outputs = json.load(f)
+            for name, rel in outputs.items():
+                shutil.copyfile(join(cached, name), join(wrk, rel))
+            return
+        dirs = {abspath(wrk or '.'), abspath(dirname(outpath) or '.')}
+        before = snapshot(dirs)
+
+    run_script(command)
+
+    # save the outputs so that they can be reused when the inputs do not
+    # change. files that were not written by the script are not saved,
+    # and nothing is saved if the script did not write its figure.
+    if cached is not None:
+        written = [p for p, t in snapshot(dirs).items()
+                   if before.get(p) != t]
+        if abspath(outpath) in written:
+            makedirs(cached, exist_ok=True)
+            outputs = {}
+            for i, p in enumerate(sorted(written)):
+                name = f'{i}-{basename(p)}'
+                shutil.copyfile(p, join(cached, name))
+                outputs[name] = relpath(p, abspath(wrk or '.'))
+            with open(manifest, 'w') as f:
+                json.dump(outputs, f, indent=2)
 
 
 def create_report(wrkdir, figdir='.', report_fn='hs-metrics-report'):
@@ -410,6 +532,9 @@ def create_report(wrkdir, figdir='.', report_fn='hs-metrics-report'):
 
 if __name__ == '__main__':
 
+    # write output line by line, as it is created by the figure scripts
+    sys.stdout.reconfigure(line_buffering=True)
+
     wrkdir = datetime.strftime(datetime.today(), '%m.%d.%Y')
     report_dir = join(wrkdir, 'tex')
     data_dir = join(wrkdir, 'data')
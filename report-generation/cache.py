@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+"""
+In-process cache of the pickled datasets read by the figure scripts.
+When build-report.py runs the scripts in a single process, each pickle is
+read from disk once and shared by every figure that uses it.
+"""
+
+import os
+import pandas
+
+
+_datasets = {}
+
+
+def read_pickle(path):
+    """
+    Reads a pickled dataframe, or returns a copy of it if it has already
+    been read in this process. Files that are modified after they are
+    cached, e.g. by collect_data.py, are read again.
+    """
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if key not in _datasets:
+        _datasets[key] = pandas.read_pickle(path)
+    return _datasets[key].copy()
+
+
+def clear():
+    """
+    Removes all cached datasets.
+    """
+    _datasets.clear()
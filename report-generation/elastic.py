@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import re
+import ast
 import sys
 import os
 import argparse
@@ -14,23 +16,67 @@ DEFAULT_TRIM = ['@version', 'beat.hostname', 'beat.name', 'count', 'fields',
                 'source', 'syslog_facility', 'syslog_facility_code',
                 'syslog_severity', 'syslog_severity_code', 'tags', 'type']
 
+# bytes literals written by str(bytes), e.g. b'University Faculty'
+BYTES_LITERAL = r"b'.*'|b\".*\""
+
+# bytes literals of printable ascii without escape sequences. these are
+# decoded by removing the b'' wrapper.
+SIMPLE_BYTES_LITERAL = (r"b'[\t\x20-\x26\x28-\x5b\x5d-\x7e]*'|"
+                        r"b\"[\t\x20-\x21\x23-\x5b\x5d-\x7e]*\"")
+
 
 def convert_binary_string(value):
     """
-    This function removes the string encapsulated bytestrings that 
-    HydroShare sends to ElasticSearch.
-
-    usage: df.applymap(convert_binary_string)
+    This function removes the string encapsulated bytestrings that
+    HydroShare sends to ElasticSearch. The literal is parsed with
+    ast.literal_eval so the content of the cell is never executed.
+    Values that are not bytes literals are returned unchanged.
     """
     try:
         if type(value) == str:
-            return eval(value).decode('utf-8')
-        else:
-            return value
+            decoded = ast.literal_eval(value)
+            if type(decoded) == bytes:
+                return decoded.decode('utf-8')
+        return value
     except Exception:
         return value
 
 
+def decode_binary_strings(df):
+    """
+    Decodes the string encapsulated bytestrings in a dataframe. Each
+    object column is scanned once with vectorized string matching and
+    columns without bytes literals are skipped. Literals of plain ascii
+    are unwrapped with a string slice, all others are parsed with
+    convert_binary_string.
+
+    returns: number of cells that were rewritten
+    """
+    rewritten = 0
+    for col in df.columns[df.dtypes == object]:
+        s = df[col]
+        try:
+            literal = s.str.fullmatch(BYTES_LITERAL, flags=re.DOTALL,
+                                      na=False)
+        except AttributeError:
+            # object column without strings
+            continue
+        if not literal.any():
+            continue
+
+        simple = s.str.fullmatch(SIMPLE_BYTES_LITERAL, na=False)
+        decoded = s.copy()
+        decoded[simple] = s[simple].str.slice(2, -1)
+        escaped = literal & ~simple
+        decoded[escaped] = s[escaped].map(convert_binary_string)
+
+        changed = simple | (escaped & (decoded != s))
+        rewritten += int(changed.sum())
+        df[col] = decoded
+
+    return rewritten
+
+
 def print_progress(iteration, total, prefix='', suffix='',
                    decimals=1, length=100, fill='█'):
     percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
@@ -71,9 +117,9 @@ def get_es_data(host, port='8080', index='*', query='*', outfile=None,
     response = es.search(index=index, q=query, scroll='10m', size=scroll_size)
     doc_size += len(response['hits']['hits'])
 
-    # save the results in a pandas dataframe
-    df = json_normalize(response['hits']['hits'])
-    df = df.applymap(convert_binary_string)
+    # save the results of each page in a list, these are combined
+    # into a single dataframe once all pages have been downloaded
+    pages = [json_normalize(response['hits']['hits'])]
 
     while 1:
         try:
@@ -87,9 +133,7 @@ def get_es_data(host, port='8080', index='*', query='*', outfile=None,
             if scroll_size > 0:
                 # save the results in a pandas dataframe and append
                 # to previous results
-                new_df = json_normalize(response['hits']['hits'])
-                new_df = new_df.applymap(convert_binary_string)
-                df = pandas.concat([df, new_df], sort=False)
+                pages.append(json_normalize(response['hits']['hits']))
             else:
                 break
 
@@ -111,6 +155,12 @@ def get_es_data(host, port='8080', index='*', query='*', outfile=None,
             print('\nFailed to normalize elasticsearch response.')
             sys.exit(1)
 
+    # combine all pages and decode bytestrings once
+    df = pandas.concat(pages, sort=False)
+    del pages
+    decoded = decode_binary_strings(df)
+    print('--> decoded %d bytestring values' % decoded)
+
     # clean and trim the pandas table
     for col in df.columns.values:
         for pre in prefix:
@@ -2,6 +2,7 @@
 
 import os
 import pytz
+import cache
 import pandas
 import argparse
 from datetime import datetime, timedelta
@@ -29,7 +30,7 @@ def load_data(workingdir):
 
     # load the data
     path = os.path.join(workingdir, 'users.pkl')
-    df = pandas.read_pickle(path)
+    df = cache.read_pickle(path)
 
     # convert dates
     df['date'] = pandas.to_datetime(df.usr_created_date).dt.normalize()
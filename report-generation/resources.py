@@ -3,6 +3,7 @@
 import os
 import csv
 import pytz
+import cache
 import pandas
 import argparse
 import numpy as np
@@ -29,7 +30,7 @@ def load_data(workingdir):
 
     # load the activity data
     path = os.path.join(workingdir, 'resources.pkl')
-    df = pandas.read_pickle(path)
+    df = cache.read_pickle(path)
 
     # convert dates
     df['date'] = pandas.to_datetime(df.res_date_created).dt.normalize()
@@ -3,6 +3,7 @@
 import os
 import pytz
 import numpy
+import cache
 import pandas
 import argparse
 from datetime import datetime, timedelta
@@ -27,7 +28,7 @@ def load_data(workingdir, pickle_file='users.pkl'):
 
     # load the activity data
     path = os.path.join(workingdir, pickle_file)
-    df = pandas.read_pickle(path)
+    df = cache.read_pickle(path)
 
     columns = df.columns
 
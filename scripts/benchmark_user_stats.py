@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+Compares the sweep used by Users.get_active_users, get_new_users, and
+get_returning_users (user_stats.activity_sweep) against the original
+day-by-day loops on synthetic activity logs. The script exits with an
+error if the results differ and reports the runtime of each.
+
+The loops compare the record timestamps with the midnight of each day,
+as older versions of pandas did when comparing with a date.
+
+usage:
+    ./benchmark_user_stats.py --rows 50000 --users 2000 --days 730
+"""
+
+import sys
+import time
+import numpy as np
+import pandas
+import argparse
+from datetime import timedelta
+
+import user_stats
+
+
+def loop_counts(df, n=90):
+    """
+    The original implementation of get_active_users, get_new_users, and
+    get_returning_users, which subset the logs and build sets of users
+    for every day.
+    """
+    curr_dt = df.date.min().date()
+    end_dt = df.date.max().date()
+    dates, active, new, returning = ([], [], [], [])
+    while curr_dt < end_dt:
+        t = pandas.Timestamp(curr_dt)
+        dt_n = t - timedelta(days=n)
+        d = df[(df['date'] <= t) &
+               (df['date'] >= dt_n)]
+        d_old = df[(df['date'] < dt_n)]
+        old_users = set(d_old.user_id.unique())
+        curr_users = set(d.user_id.unique())
+
+        dates.append(curr_dt)
+        active.append(d.user_id.nunique())
+        new.append(len(curr_users - old_users))
+        returning.append(len(curr_users & old_users))
+
+        curr_dt += timedelta(days=1)
+
+    return dates, active, new, returning
+
+
+def synthetic_logs(rows, users, days, seed=0):
+    rng = np.random.default_rng(seed)
+    start = pandas.Timestamp('2019-01-01')
+    offsets = rng.integers(0, days * 86400, rows)
+
+    # some records are exactly at midnight, which is the boundary of the
+    # windows
+    midnight = rng.random(rows) < 0.05
+    offsets[midnight] = offsets[midnight] // 86400 * 86400
+    return pandas.DataFrame({
+        'date': start + pandas.to_timedelta(offsets, unit='s'),
+        'user_id': rng.zipf(1.5, rows) % users})
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='compare and benchmark '
+                                                 'user activity statistics')
+    parser.add_argument('--rows', type=int, default=50000,
+                        help='number of synthetic activity records')
+    parser.add_argument('--users', type=int, default=2000,
+                        help='number of distinct users')
+    parser.add_argument('--days', type=int, default=730,
+                        help='number of days of activity')
+    parser.add_argument('--n', type=int, nargs='+', default=[30, 90],
+                        help='window lengths in days')
+    args = parser.parse_args()
+
+    df = synthetic_logs(args.rows, args.users, args.days)
+
+    failed = False
+    for n in args.n:
+        st = time.time()
+        expected = loop_counts(df, n)
+        loop_time = time.time() - st
+
+        st = time.time()
+        result = user_stats.activity_sweep(df, n)
+        sweep_time = time.time() - st
+
+        match = all(list(a) == list(b) for a, b in zip(expected, result))
+        failed |= not match
+        print(f'--> n={n} days={len(result[0])} loop={loop_time:.2f}s '
+              f'sweep={sweep_time:.3f}s match={match}')
+
+    if failed:
+        print('--> sweep results do not match the original loops')
+        sys.exit(1)
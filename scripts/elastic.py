@@ -55,8 +55,9 @@ def get_es_data(host, port='8080', index='*', query='*', outfile=None,
     response = es.search(index=index, q=query, scroll='2m', size=scroll_size)
     doc_size += len(response['hits']['hits'])
 
-    # save the results in a pandas dataframe
-    df = json_normalize(response['hits']['hits'])
+    # save the results of each page in a list, these are combined
+    # into a single dataframe once all pages have been downloaded
+    pages = [json_normalize(response['hits']['hits'])]
 
     while 1:
         try:
@@ -70,7 +71,7 @@ def get_es_data(host, port='8080', index='*', query='*', outfile=None,
             if scroll_size > 0:
                 # save the results in a pandas dataframe and append
                 # to previous results
-                df = pandas.concat([df, json_normalize(response['hits']['hits'])])
+                pages.append(json_normalize(response['hits']['hits']))
             else:
                 break
 
@@ -91,6 +92,10 @@ def get_es_data(host, port='8080', index='*', query='*', outfile=None,
             print('\nFailed to normalize elasticsearch response.')
             sys.exit(-1)
 
+    # combine all pages into a single dataframe
+    df = pandas.concat(pages)
+    del pages
+
     # clean and trim the pandas table
     for col in df.columns.values:
         for pre in prefix:
@@ -20,6 +20,64 @@ class PlotObject(object):
         self.style = style
 
 
+def activity_sweep(df, n=90):
+    """
+    Counts the active, new, and returning users of every day of the
+    activity logs in a single sweep. Day t covers the records between
+    t - n days and t (inclusive), where t is midnight, for each day from
+    the first up to the last day of the logs.
+
+    Each user's records are sorted once. A user is active at t if a
+    record falls in [t - n, t], i.e. if t is within [ts, ts + n] of one
+    of their records. Records that are less than n days apart are joined
+    into a single run, so the active users of a day are the runs that
+    started minus the runs that ended before it. New users are the users
+    whose first record is in the window, and returning users are the
+    active users that have records before it.
+
+    df: activity records with date and user_id columns
+    n: length of the window in days
+    returns: (dates, active, new, returning)
+    """
+    t = pandas.to_datetime(df.date)
+    curr_dt = t.min().date()
+    end_dt = t.max().date()
+    dates = [curr_dt + timedelta(days=i)
+             for i in range(max((end_dt - curr_dt).days, 0))]
+
+    # day boundaries, in the time zone of the records
+    e = pandas.DatetimeIndex([pandas.Timestamp(d) for d in dates])
+    if t.dt.tz is not None:
+        e = e.tz_localize(t.dt.tz)
+    e = e.asi8
+    w = pandas.Timedelta(days=n).value
+
+    # sort the records of each user by time
+    valid = (df.user_id.notnull() & t.notnull()).values
+    codes, _ = pandas.factorize(df.user_id.values[valid])
+    ts = t.values[valid].astype('int64')
+    order = np.lexsort((ts, codes))
+    codes, ts = codes[order], ts[order]
+
+    # first record of each user, and first and last record of each run
+    first = np.ones(len(ts), dtype=bool)
+    first[1:] = codes[1:] != codes[:-1]
+    run_start = first.copy()
+    run_start[1:] |= (ts[1:] - ts[:-1]) > w
+    run_end = np.ones(len(ts), dtype=bool)
+    run_end[:-1] = run_start[1:]
+
+    starts = np.sort(ts[run_start])
+    ends = np.sort(ts[run_end] + w)
+    firsts = np.sort(ts[first])
+
+    active = (np.searchsorted(starts, e, side='right') -
+              np.searchsorted(ends, e, side='left'))
+    new = (np.searchsorted(firsts, e, side='right') -
+           np.searchsorted(firsts, e - w, side='left'))
+    return dates, active.tolist(), new.tolist(), (active - new).tolist()
+
+
 class Users(object):
 
     def __init__(self, workingdir, outxls, st, et):
@@ -62,57 +120,56 @@ class Users(object):
         Calculate total users over time
         """
         output = OrderedDict()
-        df = self.df.sort_index()
-
 
         print('--> calculating rolling statistics... ', end='', flush=True)
-        res = []
-        t = df['usr_created_date'].min()
 
         activerange = 90
-        output['dates'] = []
-        output['total-users'] = []
-        output['active-users'] = []
-        output['new-users'] = []
-        output['returning-users'] = []
-
-        while t < self.et:
-
-            output['dates'].append(t)
-
-            # subset all users to those that exist up to the current time, t
-            subdf = df[df.usr_created_date <= t]
-
-            # total users up to time, t
-            output['total-users'].append(subdf.usr_created_date.count())
-
-            # The number of new users in activerange up to time dateJoined[i] (i.e. the range 1:i) are users who 
-            # created their account after dateJoine[i]-activerange
-            earliest_date = t - timedelta(days=activerange)
-            output['new-users'].append(np.where((subdf.usr_created_date >= earliest_date) &
-                                                (subdf.usr_created_date <= t),
-                                                1, 0).sum())
-
-            account_age = (t - subdf.usr_created_date).astype('timedelta64[D]')
-#            output['new-users'].append(np.where((account_age <= activerange) &
-#                                                (account_age >= 0),
-#                                                1, 0).sum())
-
-            # The number of users active at time dateJoined[i] is all who created an account before dateJoined[i]
-            # i.e. the range 1:i, who have logged in after dateJoine[i]-activerange
-            output['active-users'].append((subdf.usr_last_login_date > (t - timedelta(days=activerange))).sum())
-#            days_since_login = (t - subdf.usr_last_login_date).astype('timedelta64[D]')
-
-
-            # Users who were active on the site in the last 90 days,
-            # but obtained an account prior to the last 90 days are people who
-            # continue to return to and work with HydroShare.
-            output['returning-users'].append(output['active-users'][-1] - output['new-users'][-1])
-#        output['returning-users'].append(np.where((days_since_login <= activerange) &
-#                                                      (days_since_login >= 0) &
-#                                                      (account_age > activerange),
-#                                                      1, 0).sum())
-            t += timedelta(days=1)
+        window = timedelta(days=activerange)
+
+        # users that never logged in have a last login date of 0, which
+        # becomes NaT and is never within the active range
+        created = pandas.to_datetime(self.df.usr_created_date,
+                                     errors='coerce')
+        login = pandas.to_datetime(self.df.usr_last_login_date,
+                                   errors='coerce')
+        valid = created.notnull()
+        created, login = created[valid], login[valid]
+
+        # a user is counted as active at time t if the account exists and
+        # the last login is after t - activerange, i.e. from the creation
+        # date until the last login plus the active range. the counts of
+        # each day are found by searching the sorted dates.
+        inactive = pandas.concat([created, login + window], axis=1).max(axis=1)
+
+        # one row for each day from the first account until self.et
+        t0 = created.min()
+        days = max(int(np.ceil((self.et - t0) / timedelta(days=1))), 0)
+        dates = t0 + pandas.to_timedelta(np.arange(days), unit='D')
+        created = np.sort(created.values)
+        inactive = np.sort(inactive.values)
+
+        # total users up to time, t
+        total = np.searchsorted(created, dates.values, side='right')
+
+        # The number of new users in activerange up to time t are users
+        # who created their account on or after t - activerange
+        new = total - np.searchsorted(created, (dates - window).values,
+                                      side='left')
+
+        # The number of users active at time t is all who created an
+        # account before t, who have logged in after t - activerange
+        active = total - np.searchsorted(inactive, dates.values,
+                                         side='right')
+
+        output['dates'] = list(dates)
+        output['total-users'] = total.tolist()
+        output['active-users'] = active.tolist()
+        output['new-users'] = new.tolist()
+
+        # Users who were active on the site in the last 90 days,
+        # but obtained an account prior to the last 90 days are people who
+        # continue to return to and work with HydroShare.
+        output['returning-users'] = (active - new).tolist()
 
         opath = os.path.join(self.workingdir, 'user-stats.csv')
         with open(opath, 'w') as f:
@@ -446,21 +503,7 @@ class Users(object):
         """
 
         print('--> calculating active users, n=%d' % n)
-
-        curr_dt = df.date.min().date()
-        end_dt = df.date.max().date()
-        dates, active_count = ([], [])
-        while curr_dt < end_dt:
-            print('.', end='', flush=True)
-            dt_n = curr_dt - timedelta(days=n)
-            d = df[(df['date'] <= curr_dt) &
-                   (df['date'] >= dt_n)]
-            dates.append(curr_dt)
-            active_count.append(d.user_id.nunique())
-
-            curr_dt += timedelta(days=1)
-
-        print('\n')
+        dates, active_count, _, _ = activity_sweep(df, n)
 
         # create plot object
         plotObj = PlotObject(dates,
@@ -468,42 +511,16 @@ class Users(object):
                              label='Total Active Users',
                              style='k.-')
         return plotObj
-    
+
     def get_new_users(self, df, n=90):
 
         """
-        Calculate total new users based on activity logs
+        Calculate total new users based on activity logs, i.e. the users
+        whose first activity is within the last "n" days
         """
 
         print('--> calculating new users, n=%d' % n)
-        curr_dt = df.date.min().date()
-        end_dt = df.date.max().date()
-        dates, new_count = ([], [])
-        while curr_dt < end_dt:
-            print('.', end='', flush=True)
-            dt_n = curr_dt - timedelta(days=n)
-            d = df[(df['date'] <= curr_dt) &
-                   (df['date'] >= dt_n)]
-
-            # isolate the records that are older than "n" days, i.e.
-            # < dt_n
-            d_old = df[(df['date'] < dt_n)]
-
-            # isolate the users that have been active before the
-            # current time period
-            old_users = set(d_old.user_id.unique())
-
-            # isolate the users that have been active in the
-            # current time period, i.e. dt_n <= dt <= curr_dt
-            curr_users = set(d.user_id.unique())
-
-            # calculate curr users that are not in old_users
-            new_count.append(len(curr_users - old_users))
-            dates.append(curr_dt)
-
-            curr_dt += timedelta(days=1)
-
-        print('\n')
+        dates, _, new_count, _ = activity_sweep(df, n)
 
         # create plot object
         plotObj = PlotObject(dates,
@@ -515,38 +532,12 @@ class Users(object):
     def get_returning_users(self, df, n=90):
 
         """
-        Calculate total returning users based on activity logs
+        Calculate total returning users based on activity logs, i.e. the
+        users active within the last "n" days that were also active before
         """
 
         print('--> calculating returning users, n=%d' % n)
-        curr_dt = df.date.min().date()
-        end_dt = df.date.max().date()
-        dates, ret_count = ([], [])
-        while curr_dt < end_dt:
-            print('.', end='', flush=True)
-            dt_n = curr_dt - timedelta(days=n)
-            d = df[(df['date'] <= curr_dt) &
-                   (df['date'] >= dt_n)]
-
-            # isolate the records that are older than "n" days, i.e.
-            # < dt_n
-            d_old = df[(df['date'] < dt_n)]
-
-            # isolate the users that have been active before the
-            # current time period
-            old_users = set(d_old.user_id.unique())
-
-            # isolate the users that have been active in the
-            # current time period, i.e. dt_n <= dt <= curr_dt
-            curr_users = set(d.user_id.unique())
-
-            # calculate curr users that are not in old_users
-            ret_count.append(len(curr_users & old_users))
-            dates.append(curr_dt)
-
-            curr_dt += timedelta(days=1)
-
-        print('\n')
+        dates, _, _, ret_count = activity_sweep(df, n)
 
         # create plot object
         plotObj = PlotObject(dates,